@@ -1,61 +1,192 @@
 from discord.discord import Bot
 from discord.contexts import InteractionContext as Context
 from discord.interaction_enums import InteractionType
+from discord.args import Arg
 from settings import YT_DL_LOCATION, FFMPEG_LOCATION, COOKIES
-
+from jobs import JobScheduler, SchedulerFull
+from dl_cache import DownloadCache, cache_key
+from discord import executors
+import ytdl
+import ffmpeg
+import filtergraph
+import frames
+import fetch
+
+import os
 import random
+import traceback
 import asyncio
-import aiofiles
 import settings
-from os import unlink
-
-
-
-async def _get_frame_pic(frame: int, ):
-    return ''
+from os.path import exists, getsize
+from contextlib import aclosing
+
+
+# imported in every shard process, so the pools are set up here
+executors.configure(
+    cpu_workers=settings.EXECUTOR_CPU_WORKERS,
+    io_workers=settings.EXECUTOR_IO_WORKERS,
+    max_queued=settings.EXECUTOR_MAX_QUEUED,
+)
+# every shard process imports this, machine wide limits are split
+# between them (see settings.per_process)
+yt_dl_jobs = JobScheduler(
+    max_jobs=settings.per_process(settings.YT_DL_MAX_JOBS),
+    max_guild_jobs=settings.YT_DL_MAX_GUILD_JOBS,
+    max_queued=settings.per_process(settings.YT_DL_MAX_QUEUED),
+    name="ytdl",
+)
+ffmpeg_farm = ffmpeg.WorkerFarm(
+    workers=settings.FFMPEG_WORKERS and settings.per_process(settings.FFMPEG_WORKERS),
+    threads=settings.FFMPEG_THREADS,
+    nice=settings.FFMPEG_NICE,
+    cpus=settings.per_process(os.cpu_count() or 1),
+)
+dl_cache = DownloadCache(
+    settings.process_dir(settings.DL_CACHE_DIR),
+    max_bytes=settings.per_process(settings.DL_CACHE_MAX_BYTES),
+    ttl=settings.DL_CACHE_TTL,
+)
+edit_cache = DownloadCache(
+    settings.process_dir(settings.EDIT_CACHE_DIR),
+    max_bytes=settings.per_process(settings.EDIT_CACHE_MAX_BYTES),
+    ttl=settings.DL_CACHE_TTL,
+)
+fetcher = fetch.MediaFetcher(dl_cache, max_bytes=settings.FETCH_MAX_BYTES)
+# left of the interaction token's 15 minutes to upload the result
+EDIT_UPLOAD_TIME = 60
+
+
+async def _get_frame_pic(src, frame: float, height=None):
+    """jpeg bytes of the frame at `frame` seconds into src (path or url)"""
+    return await ffmpeg_farm.submit(frames.grab, src, frame, height=height)
+
+
+def _option_value(ctx, name, default=None):
+    opt = ctx.get_option(name)
+    return opt['value'] if opt else default
 
 
 @Bot.on_interact(
    InteractionType.APPLICATION_COMMAND, 'edit')
 async def _edit_files(ctx: Context):
     """edit file(s) with ffmpeg"""
-    url = ctx.get_option('url')
-    atchment = ctx.get_option('file')
-    if not url or atchment:
+    url = _option_value(ctx, 'url')
+    atchment = _option_value(ctx, 'file')
+    if not url and not atchment:
         ctx.add_content('Please provide a url or an attachment!')
-        return ctx.send_msg_src()
-    if url and atchment:
-        #url takes priority
-        atchment = None
-             
+        return await ctx.send_msg_src()
+    info = None
+    if not url:
+        # attachment options only carry the id, the rest is in resolved
+        att = ctx.data['resolved']['attachments'][atchment]
+        url = att['url']
+        # the cdn takes range requests, no need to ask it
+        info = fetch.RemoteInfo(url, att.get('size'), att.get('content_type'), True)
+
+    try:
+        edit = filtergraph.Edit(
+            start=_option_value(ctx, 'start'),
+            end=_option_value(ctx, 'end'),
+            scale=_option_value(ctx, 'scale'),
+            speed=_option_value(ctx, 'speed', 1.0),
+            reverse=_option_value(ctx, 'reverse', False),
+            format=_option_value(ctx, 'format', 'mp4'),
+        ).validate()
+    except filtergraph.EditError as e:
+        ctx.add_content(str(e))
+        return await ctx.send_msg_src()
+
+    # rendering takes longer than the 3 seconds an answer may take
+    await ctx.defer_msg_with_src()
+    if not ctx.deferred:
+        # too late or rejected, nothing rendered could be sent
+        return
 
-@Bot.command("ytdl")
+    async def _render():
+        await ctx.progress("rendering..", force=True)
+        async with fetcher.open(url, info) as src:
+            dst = f"/tmp/{random.randint(0, 30000000000000)}.{edit.ext}"
+            return await ffmpeg_farm.submit(filtergraph.render, src, dst, edit,
+                key=ctx.guild_id)
+
+    async def render():
+        # one deadline for the download, the queue and ffmpeg, anything
+        # finishing after the token expired couldn't be sent anyway
+        return await asyncio.wait_for(_render(),
+            ctx.time_left() - EDIT_UPLOAD_TIME)
+
+    try:
+        info = await fetcher.inspect(url, info)
+        # urls without a validator may serve something else next time
+        tag = fetch.validator(url, info)
+        key = cache_key(fetch.stable_url(url), [*edit.key(), tag]) if tag else None
+        async with edit_cache.use(key, render) as flc:
+            ctx.add_content("")
+            return await ctx.respond(file=flc)
+    except (ffmpeg.FFmpegError, filtergraph.EditError) as e:
+        ctx.add_content(f"edit failed :( \n``{str(e)[-1800:]}``")
+    except fetch.FetchError as e:
+        ctx.add_content(str(e))
+    except SchedulerFull:
+        ctx.add_content("Too many edits right now, try again later")
+    except asyncio.TimeoutError:
+        ctx.add_content("edit took too long")
+    except Exception:
+        # the deferred "thinking.." must get an answer whatever broke
+        traceback.print_exc()
+        ctx.add_content("edit failed :(")
+    return await ctx.respond()
+
+
+@Bot.command("ytdl", args=[
+    Arg("link", error="Needs a link"),
+    Arg("-f", dest="format", error="need format option after the -f flag.."),
+])
 async def _yt_dl(ctx):
-    s = ctx.data['content'].split()
-    cmds = []
     await ctx.trigger_typing()
-    cmd_opts = ['-f']
-    if len(s) < 2:
-        await ctx.send_msg("Needs a link")
-        return
-    
-    format = None
+    try:
+        await yt_dl_jobs.run(ctx.guild_id, _yt_dl_res,
+            ctx.send_msg, ctx.args['link'], format=ctx.args['format'])
+    except SchedulerFull:
+        await ctx.send_msg("Too many downloads right now, try again later")
 
-    if len(s) > 2:
-        for i in range(2+(len(s)-2)):
-            if s[i] in cmd_opts:
-                try:
-                    if s[i] == '-f':
-                        format = s[i+1]                    
-                except IndexError:
-                    return await ctx.send_msg(
-                        f"need format option after the {s[i]} flag.."
-                    )
 
-    await _yt_dl_res(ctx.send_msg, s[1], format=format)
+MANAGE_GUILD = 1 << 5
 
 
-async def _yt_dl_res(response_func, link, format=None):
+@Bot.on_interact(
+   InteractionType.APPLICATION_COMMAND, 'prefix')
+async def _set_prefix(ctx: Context):
+    """set the guild's command prefix, no value goes back to the default"""
+    member = ctx.d.get('member')
+    if not ctx.guild_id or not member:
+        ctx.add_content('Prefixes are per server')
+        return await ctx.send_msg_src()
+    if not int(member.get('permissions', 0)) & MANAGE_GUILD:
+        ctx.add_content('You need the Manage Server permission')
+        return await ctx.send_msg_src()
+    prefix = _option_value(ctx, 'prefix')
+    if prefix and (len(prefix) > 8 or any(c.isspace() for c in prefix)):
+        ctx.add_content('Prefixes are up to 8 characters without spaces')
+        return await ctx.send_msg_src()
+    ctx.bot.set_prefix(ctx.guild_id, prefix)
+    ctx.add_content(f"Prefix set to ``{ctx.bot.get_prefix(ctx.guild_id)}``")
+    return await ctx.send_msg_src()
+
+
+@Bot.command("ping")
+async def _ping(ctx):
+    stats = ctx.bot.latency_stats()
+    if stats["last"] is None:
+        return await ctx.send_msg("no heartbeat ack yet")
+    await ctx.send_msg(
+        f"pong! {stats['last'] * 1000:.0f}ms "
+        f"(p50 {stats['p50'] * 1000:.0f}ms, p99 {stats['p99'] * 1000:.0f}ms, "
+        f"last beat {stats['beat_lag'] * 1000:.0f}ms late)")
+
+
+async def _yt_dl_res(response_func, link, format=None,
+        spawn=asyncio.create_subprocess_exec):
     options = ['-f',]
     
     if format:
@@ -67,41 +198,56 @@ async def _yt_dl_res(response_func, link, format=None):
         options.append('-S')
         options.append('vcodec:h264')
 
+    async def download():
+        return await _yt_dl_run(response_func, link, options, spawn)
+
+    async with dl_cache.use(cache_key(link, options), download) as flc:
+        if not flc:
+            return
+        c, m = await response_func(file=flc)
+        if c == 413:
+            await response_func("file too large it failed")
+
+
+async def _yt_dl_run(response_func, link, options, spawn):
+    """ run yt-dlp and return the path of the first downloaded file, only
+        the first playlist entry is sent so yt-dlp is stopped once it's done
+    """
     file_id = random.randint(0, 30000000000000) 
     file_name = f"/tmp/{file_id}%(playlist_index)s.%(ext)s"
-    proc = await asyncio.create_subprocess_exec(
+    proc = await spawn(
             YT_DL_LOCATION, link, '--force-overwrites', '--ffmpeg-location',
-            FFMPEG_LOCATION, '--no-warnings', *options, '--cookies', COOKIES, '-o', file_name,
+            FFMPEG_LOCATION, '--no-warnings', '--newline', *options, '--cookies', COOKIES, '-o', file_name,
             stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
 
-    stdout, stderr = await proc.communicate()
-
-    if stdout:
-        dst = stdout.decode().split('\n')
-        if stderr:
-            await response_func(stderr.decode())
-        vids = 0
-        for ln in dst:
-            flc = None
-            if ln[1:9] == 'download' and ln[11:22] == 'Destination':
-                flc = ln.split(':')[1][1:]
-            if ln[1:7] == 'Merger':
-                flc = ln.split()[-1][1:-1]
-            if ln.find('Aborting') > -1:
-                await response_func(f"Sorry :( \n``{ln}``")
-            if not flc: continue
-            try:
-                if vids >= 1:
-                    return
-                async with aiofiles.open(flc, mode='rb') as f:
-                    c, m = await response_func(file=await f.read(), file_name=flc)
-                    if c == 413:
-                        await response_func("file too large it failed")
-                    if c == 200:
-                        vids+=1
-
-                unlink(flc)
-            except FileNotFoundError:
-                continue
-    elif stderr:
-        return await response_func("internal error :(")
\ No newline at end of file
+    errors = []
+    found = None
+    async with aclosing(ytdl.events(proc)) as evs:
+        async for ev in evs:
+            if ev.type == ytdl.EventType.ERROR:
+                errors.append(ev.line)
+            elif ev.type == ytdl.EventType.ABORT:
+                await response_func(f"Sorry :( \n``{ev.line}``")
+            elif ev.type == ytdl.EventType.FINISHED and exists(ev.path):
+                found = ev.path
+                break
+
+    if proc.returncode is None:
+        proc.terminate()
+        await proc.wait()
+    if errors:
+        await response_func('\n'.join(errors)[:1900])
+    elif not found and proc.returncode:
+        await response_func("internal error :(")
+
+    if found and getsize(found) > settings.UPLOAD_LIMIT:
+        # shrink it here so the cache keeps the version that can be sent
+        await response_func("file too large, shrinking it..")
+        try:
+            found = await ffmpeg_farm.submit(
+                ffmpeg.fit_to_size, found, settings.UPLOAD_LIMIT)
+        except ffmpeg.FFmpegError as e:
+            await response_func(f"couldn't shrink it :( \n``{str(e)[-1800:]}``")
+        except SchedulerFull:
+            await response_func("too busy to shrink it right now")
+    return found
@@ -0,0 +1,83 @@
+"""
+    Declarative arguments for prefix commands, compiled once when the
+    command is registered
+"""
+
+
+class ArgError(Exception):
+    """bad invocation, the message is sent back to the user"""
+    pass
+
+
+class Arg:
+    """ A positional argument, or a flag when the name starts with '-'.
+        bool flags take no value.
+    """
+
+    def __init__(self, name, type=str, default=None, required=None,
+        choices=None, dest=None, error=None):
+        self.name = name
+        self.type = type
+        self.default = default
+        self.flag = name.startswith('-')
+        self.required = (not self.flag) if required is None else required
+        self.choices = choices
+        self.dest = dest or name.lstrip('-').replace('-', '_')
+        self.error = error
+
+    def convert(self, value):
+        try:
+            value = self.type(value)
+        except (TypeError, ValueError):
+            raise ArgError(self.error or
+                f"``{value}`` isn't a valid {self.type.__name__} for {self.name}")
+        if self.choices and value not in self.choices:
+            raise ArgError(self.error or
+                f"{self.name} has to be one of {', '.join(map(str, self.choices))}")
+        return value
+
+
+class ArgSpec:
+    """compiled list of Args, parse() turns the text after the command into a dict"""
+
+    def __init__(self, args):
+        self.flags = {}
+        self.positionals = []
+        for arg in args:
+            if arg.flag:
+                self.flags[arg.name] = arg
+            else:
+                self.positionals.append(arg)
+        self.defaults = {arg.dest: arg.default for arg in args}
+
+    def parse(self, rest):
+        parsed = dict(self.defaults)
+        seen = set()
+        tokens = rest.split()
+        pos = 0
+        i = 0
+        while i < len(tokens):
+            tok = tokens[i]
+            arg = self.flags.get(tok)
+            if arg:
+                if arg.type is bool:
+                    parsed[arg.dest] = True
+                else:
+                    i += 1
+                    if i >= len(tokens):
+                        raise ArgError(arg.error or
+                            f"need a value after the {arg.name} flag..")
+                    parsed[arg.dest] = arg.convert(tokens[i])
+            else:
+                if pos >= len(self.positionals):
+                    raise ArgError(f"unexpected argument ``{tok}``")
+                arg = self.positionals[pos]
+                pos += 1
+                parsed[arg.dest] = arg.convert(tok)
+            seen.add(arg.dest)
+            i += 1
+
+        for arg in self.positionals + list(self.flags.values()):
+            if arg.required and arg.dest not in seen:
+                raise ArgError(arg.error or f"missing {arg.name}")
+        return parsed
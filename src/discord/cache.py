@@ -0,0 +1,208 @@
+"""
+    Bounded caches for gateway state, entries are small slotted records
+    instead of the raw gateway payloads
+"""
+import sys
+import time
+from collections import OrderedDict
+
+# entry caps, a record is ~100 bytes so these are the memory caps too
+VOICE_STATES_MAX = 100_000
+USERS_MAX = 50_000
+USERS_TTL = 60 * 60
+PREFIXES_MAX = 10_000
+
+
+def snowflake(value):
+    """ids as ints, a fraction of the size of the strings"""
+    return int(value) if value is not None else None
+
+
+class VoiceState:
+    __slots__ = ("guild_id", "channel_id", "user_id", "session_id",
+        "mute", "deaf", "self_mute", "self_deaf")
+
+    def __init__(self, guild_id, channel_id, user_id, session_id,
+        mute=False, deaf=False, self_mute=False, self_deaf=False):
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.user_id = user_id
+        self.session_id = session_id
+        self.mute = mute
+        self.deaf = deaf
+        self.self_mute = self_mute
+        self.self_deaf = self_deaf
+
+    @property
+    def key(self):
+        # shares the ints with the record
+        return (self.guild_id, self.user_id)
+
+    @classmethod
+    def from_data(cls, d):
+        return cls(snowflake(d.get("guild_id")), snowflake(d.get("channel_id")),
+            snowflake(d["user_id"]), d.get("session_id"),
+            d.get("mute", False), d.get("deaf", False),
+            d.get("self_mute", False), d.get("self_deaf", False))
+
+
+class User:
+    __slots__ = ("id", "username", "global_name", "avatar", "bot")
+
+    def __init__(self, id, username, global_name=None, avatar=None, bot=False):
+        self.id = id
+        self.username = username
+        self.global_name = global_name
+        self.avatar = avatar
+        self.bot = bot
+
+    @classmethod
+    def from_data(cls, d):
+        return cls(snowflake(d["id"]), d.get("username"), d.get("global_name"),
+            d.get("avatar"), d.get("bot", False))
+
+
+class BoundedCache:
+    """ LRU cache with an entry cap and an optional ttl in seconds,
+        reads refresh the order, expired entries are dropped on read
+    """
+
+    def __init__(self, max_entries, ttl=None, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        try:
+            item = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if self.ttl:
+            item, expires = item
+            if expires <= self.clock():
+                del self.data[key]
+                self.expired += 1
+                self.misses += 1
+                return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return item
+
+    def set(self, key, value):
+        self.data[key] = (value, self.clock() + self.ttl) if self.ttl else value
+        self.data.move_to_end(key)
+        while len(self.data) > self.max_entries:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        item = self.data.pop(key, None)
+        if item is None:
+            return default
+        return item[0] if self.ttl else item
+
+    def remove_where(self, pred):
+        """drop every key pred(key) is true for, scans the whole cache"""
+        keys = [k for k in self.data if pred(k)]
+        for k in keys:
+            del self.data[k]
+        return len(keys)
+
+    def clear(self):
+        self.data.clear()
+
+    def approx_bytes(self):
+        """dict overhead plus the newest entry's size times the entry count"""
+        size = sys.getsizeof(self.data)
+        if self.data:
+            key = next(reversed(self.data))
+            size += len(self.data) * (sys.getsizeof(key) + _sizeof(self.data[key]))
+        return size
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.data),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expired": self.expired,
+            "approx_bytes": self.approx_bytes(),
+        }
+
+
+def _sizeof(obj):
+    size = sys.getsizeof(obj)
+    if isinstance(obj, tuple):
+        return size + sum(_sizeof(o) for o in obj)
+    for name in getattr(type(obj), "__slots__", ()):
+        value = getattr(obj, name, None)
+        # ints below 256, bools and None are shared
+        if not isinstance(value, (bool, type(None))):
+            size += sys.getsizeof(value)
+    return size
+
+
+def benchmark(n=100_000, users=20_000, guilds=500):
+    """ memory of n simulated voice state updates, kept as raw payloads
+        keyed by user (the old cache) and as records in a BoundedCache
+    """
+    import random
+    import tracemalloc
+
+    def updates():
+        rnd = random.Random(0)
+        for i in range(n):
+            user = rnd.randrange(users)
+            # a user is in one voice channel at a time
+            guild = 10**17 + user % guilds
+            leave = rnd.random() < 0.3
+            yield {"t": "VOICE_STATE_UPDATE", "s": i, "op": 0, "d": {
+                "guild_id": str(guild),
+                "channel_id": None if leave else str(guild + rnd.randrange(20)),
+                "user_id": str(2 * 10**17 + user),
+                "session_id": "%032x" % rnd.getrandbits(128),
+                "deaf": False, "mute": False,
+                "self_deaf": False, "self_mute": rnd.random() < 0.2,
+                "member": {"user": {"id": "1", "username": "x"}, "roles": []},
+            }}
+
+    tracemalloc.start()
+    raw = {}
+    for msg in updates():
+        raw[msg["d"]["user_id"]] = msg
+    raw_bytes = tracemalloc.get_traced_memory()[0]
+    raw_entries = len(raw)
+    del raw
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    cache = BoundedCache(VOICE_STATES_MAX)
+    for msg in updates():
+        state = VoiceState.from_data(msg["d"])
+        if state.channel_id is None:
+            cache.pop(state.key)
+        else:
+            cache.set(state.key, state)
+    cache_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return {"updates": n, "raw_bytes": raw_bytes, "raw_entries": raw_entries,
+        "cache_bytes": cache_bytes, "cache_entries": len(cache)}
+
+
+if __name__ == "__main__":
+    print(benchmark())
@@ -0,0 +1,114 @@
+"""
+    JSON codec for gateway and REST payloads, uses orjson or msgspec
+    when installed and falls back to the stdlib
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+if orjson:
+    NAME = "orjson"
+    loads = orjson.loads
+
+    def dumps(obj):
+        # websockets sends str as text frames, the gateway wants those
+        return orjson.dumps(obj).decode()
+
+    dumps_bytes = orjson.dumps
+elif msgspec:
+    NAME = "msgspec"
+    _encoder = msgspec.json.Encoder()
+    _decoder = msgspec.json.Decoder()
+    loads = _decoder.decode
+
+    def dumps(obj):
+        return _encoder.encode(obj).decode()
+
+    dumps_bytes = _encoder.encode
+else:
+    NAME = "json"
+    loads = json.loads
+
+    def dumps(obj):
+        return json.dumps(obj, separators=(",", ":"))
+
+    def dumps_bytes(obj):
+        return dumps(obj).encode()
+
+
+def _codecs():
+    """name -> (loads, dumps to bytes) of every codec installed"""
+    codecs = {"json": (json.loads,
+        lambda obj: json.dumps(obj, separators=(",", ":")).encode())}
+    if orjson:
+        codecs["orjson"] = (orjson.loads, orjson.dumps)
+    if msgspec:
+        codecs["msgspec"] = (msgspec.json.Decoder().decode,
+            msgspec.json.Encoder().encode)
+    return codecs
+
+
+def benchmark(members=5000, channels=200, rounds=20):
+    """ microseconds per loads/dumps of gateway style READY, GUILD_CREATE
+        and MESSAGE_CREATE payloads for every installed codec
+    """
+    import random
+    import time
+
+    rnd = random.Random(0)
+    user = lambda i: {"id": str(10**17 + i), "username": f"user{i}",
+        "global_name": f"User {i}", "avatar": "%032x" % rnd.getrandbits(128),
+        "discriminator": "0", "public_flags": 0, "bot": False}
+    ready = {"op": 0, "s": 1, "t": "READY", "d": {"v": 8, "user": user(0),
+        "session_id": "%032x" % rnd.getrandbits(128),
+        "resume_gateway_url": "wss://gateway-us-east1-b.discord.gg",
+        "guilds": [{"id": str(10**17 + i), "unavailable": True}
+            for i in range(100)],
+        "application": {"id": "1", "flags": 0}, "shard": [0, 1]}}
+    guild_create = {"op": 0, "s": 2, "t": "GUILD_CREATE", "d": {
+        "id": "1", "name": "a guild", "member_count": members,
+        "channels": [{"id": str(10**16 + i), "type": i % 3, "name": f"chan-{i}",
+            "position": i, "permission_overwrites": [], "nsfw": False}
+            for i in range(channels)],
+        "members": [{"user": user(i), "roles": [str(i % 20)], "deaf": False,
+            "mute": False, "joined_at": "2021-01-01T00:00:00.000000+00:00"}
+            for i in range(members)],
+        "voice_states": [], "presences": []}}
+    message = {"op": 0, "s": 3, "t": "MESSAGE_CREATE", "d": {
+        "id": "1", "channel_id": "5", "guild_id": "1", "author": user(7),
+        "content": ".ytdl https://example.com/watch?v=abc", "tts": False,
+        "timestamp": "2024-01-01T00:00:00.000000+00:00", "mentions": [],
+        "embeds": [], "attachments": [], "member": {"roles": ["3"]}}}
+    payloads = {"READY": ready, "GUILD_CREATE": guild_create,
+        "MESSAGE_CREATE": message}
+
+    def per_call(func, arg, n):
+        start = time.perf_counter()
+        for _ in range(n):
+            func(arg)
+        return (time.perf_counter() - start) / n * 1e6
+
+    results = {}
+    for name, (c_loads, c_dumps) in _codecs().items():
+        results[name] = {}
+        for event, obj in payloads.items():
+            raw = c_dumps(obj)
+            # small events come by the thousand, time more of them
+            n = rounds if event == "GUILD_CREATE" else rounds * 100
+            results[name][event] = {"bytes": len(raw),
+                "loads_us": per_call(c_loads, raw, n),
+                "dumps_us": per_call(c_dumps, obj, n)}
+    return results
+
+
+if __name__ == "__main__":
+    print(benchmark())
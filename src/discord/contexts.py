@@ -1,21 +1,60 @@
-import json
+import time
+from os import PathLike
+from os.path import basename, getsize
 from aiohttp import FormData
 from discord.links import API_LINK
-from discord.network import _network
+from discord.rest import rest
+from discord import codec
+from discord import metrics
 
 from discord.interaction_enums import InteractionType, InteractionCallbackType, ComponentTypes, \
     ButtonStyles, AutocompleteChoices, message_flag
 
+# seconds between progress edits of a deferred response
+PROGRESS_INTERVAL = 2.0
+# interaction tokens stop working this long after the interaction
+TOKEN_LIFETIME = 15 * 60
 
-async def _send_msg(url=None, file=None, filename=None, data=None, headers=None):
-    pload = FormData()
-    if file:
-        pload.add_field('file', file, filename=filename,
-            content_type="multipart/formdata")
-    pload.add_field('payload_json', json.dumps(data), content_type="multipart/formdata")
-    return await _network.network_se.post(
-        url, data=pload, headers=headers
-    )
+
+async def _send_msg(url=None, file=None, filename=None, data=None, headers=None,
+    method='POST'):
+    """ post a multipart message, file can be bytes, a path or an async
+        iterable of bytes. paths and streams are uploaded in chunks so
+        memory use doesn't grow with the file size. returns (status, body)
+    """
+    opened = []
+    if isinstance(file, (str, PathLike)):
+        filename = filename or basename(file)
+
+    def form():
+        # rebuilt for every attempt, FormData can't be sent twice
+        pload = FormData()
+        body = file
+        if isinstance(file, (str, PathLike)):
+            # aiohttp reads open files chunk by chunk and knows their length
+            body = open(file, 'rb')
+            opened.append(body)
+        if body:
+            pload.add_field('file', body, filename=filename,
+                content_type="multipart/formdata")
+        pload.add_field('payload_json', codec.dumps(data), content_type="multipart/formdata")
+        return pload
+
+    try:
+        # a stream is drained by the first attempt, resending it would
+        # upload an empty or truncated file
+        replayable = not file or isinstance(file, (str, PathLike, bytes, bytearray))
+        status, body = await rest.request(method, url, data=form, headers=headers,
+            retry=replayable)
+        if status and status < 300 and file:
+            if isinstance(file, (str, PathLike)):
+                metrics.UPLOAD_BYTES.inc(amount=getsize(file))
+            elif isinstance(file, (bytes, bytearray)):
+                metrics.UPLOAD_BYTES.inc(amount=len(file))
+        return status, body
+    finally:
+        for fp in opened:
+            fp.close()
 
 
 class InteractionContext:
@@ -29,6 +68,12 @@ class InteractionContext:
         self.data = self.d.get('data')
         self.id = self.d.get('id')
         self.token = self.d.get('token')
+        self.application_id = self.d.get('application_id')
+        self.received = time.monotonic()
+        # set once the callback was sent, later replies go to the webhook
+        self.deferred = False
+        self.responded = False
+        self.last_progress = 0.0
         self.options = None
         if not self.data:
             return self
@@ -98,24 +143,70 @@ class InteractionContext:
     def make_link(self, *args):
         return f"{API_LINK}interactions/{'/'.join(args)}" 
 
-    async def send_msg_src(self, file=None, filename=None):
+    def time_left(self):
+        """seconds until the token expires, counted from when it arrived"""
+        return TOKEN_LIFETIME - (time.monotonic() - self.received)
+
+    def webhook_link(self, *args):
+        """follow-up webhook of the interaction, valid for 15 minutes"""
+        return f"{API_LINK}webhooks/{'/'.join((self.application_id, self.token, *args))}"
+
+    def payload(self):
         pload = {}
-        if self.content:
+        if self.content is not None:
+            # "" clears the text of an edited message
             pload['content'] = self.content
         if self.flags:
             pload['flags'] = self.flags
         if len(self.components) > 0:
             pload['components'] = self.components
+        return pload
+
+    async def send_msg_src(self, file=None, filename=None):
+        self.responded = True
         return await _send_msg(
             self.make_link(self.id, self.token, 'callback'),
             file=file, filename=filename,
             data={"type": InteractionCallbackType.CHANNEL_MESSAGE_WITH_SOURCE.value,
-                  "data": pload
+                  "data": self.payload()
             }
         )
+
+    async def respond(self, file=None, filename=None):
+        """ answer with the content/components/flags added so far, edits
+            the "thinking.." message if the interaction was deferred,
+            otherwise answers the callback. returns (status, body)
+        """
+        if self.deferred:
+            return await self.edit_original(file=file, filename=filename)
+        return await self.send_msg_src(file=file, filename=filename)
+
+    async def edit_original(self, file=None, filename=None, data=None):
+        return await _send_msg(self.webhook_link('messages', '@original'),
+            file=file, filename=filename, data=data or self.payload(),
+            method='PATCH')
+
+    async def followup(self, file=None, filename=None, data=None):
+        """send another message, only after the interaction was answered"""
+        return await _send_msg(self.webhook_link(),
+            file=file, filename=filename, data=data or self.payload())
+
+    async def progress(self, content: str, force=False):
+        """ show progress on a deferred response, edits closer than
+            PROGRESS_INTERVAL apart are dropped so a chatty job doesn't
+            eat the webhook's rate limit. returns whether it was sent
+        """
+        if not self.deferred:
+            return False
+        now = time.monotonic()
+        if not force and now - self.last_progress < PROGRESS_INTERVAL:
+            return False
+        self.last_progress = now
+        await self.edit_original(data={'content': content})
+        return True
     
     async def send_autocomplete(self, arr: list[AutocompleteChoices]):
-        return await _network.network_se.post(self.make_link(
+        return await rest.request('POST', self.make_link(
             self.d['id'], self.d['token'], 'callback'
         ), json={
             "type": InteractionCallbackType.APPLICATION_COMMAND_AUTOCOMPLETE_RESULT.value,
@@ -123,16 +214,29 @@ class InteractionContext:
         })
 
     async def defer_msg_with_src(self):
-        """ Ack an interaction, user sees a loading state """
-        return await _network.network_se.post(self.make_link(
-            self.application_id, self.token
-        ), data={'type': InteractionCallbackType.DEFERRED_CHANNEL_MESSAGE_WITH_SOURCE.value})
+        """ Ack an interaction, user sees a loading state. has to happen
+            within 3 seconds, the response can then take 15 minutes
+        """
+        pload = {'type': InteractionCallbackType.DEFERRED_CHANNEL_MESSAGE_WITH_SOURCE.value}
+        if self.flags:
+            # only ephemeral can be set here, it sticks to the response
+            pload['data'] = {'flags': self.flags}
+        status, body = await rest.request('POST', self.make_link(
+            self.id, self.token, 'callback'), json=pload)
+        # a late or rejected ack leaves no @original to edit, respond()
+        # tries the callback itself then
+        if status and status < 300:
+            self.deferred = self.responded = True
+        return status, body
     
     async def defer_update_msg(self):
         """ Ack an interaction, but user does not see a loading state """
-        return await _network.network_se.post(self.make_link(
+        status, body = await rest.request('POST', self.make_link(
             self.d['id'], self.d['token'], 'callback'
-        ), data={'type': InteractionCallbackType.DEFERRED_UPDATE_MESSAGE.value})
+        ), json={'type': InteractionCallbackType.DEFERRED_UPDATE_MESSAGE.value})
+        if status and status < 300:
+            self.deferred = self.responded = True
+        return status, body
     
 
 class MessageContext:
@@ -141,6 +245,11 @@ class MessageContext:
         self.bot = bot
         self.data = msg.get('d')
         self.channel_id = self.data.get('channel_id')
+        self.guild_id = self.data.get('guild_id')
+        # filled in by the bot when a command matches
+        self.invoked_with = None
+        self.rest = None
+        self.args = {}
 
     def get_headers(self):
         return {
@@ -153,10 +262,10 @@ class MessageContext:
         }
         return await _send_msg(
             url = f"{API_LINK}channels/{self.channel_id}/messages",
-            data=data, headers=self.get_headers(), file=file, filename=None)
+            data=data, headers=self.get_headers(), file=file, filename=file_name)
 
     async def trigger_typing(self):
-        return await _send_msg(
-            url = f"{API_LINK}channels/{self.channel_id}/typing",
+        return await rest.request('POST',
+            f"{API_LINK}channels/{self.channel_id}/typing",
             headers=self.get_headers()
         )
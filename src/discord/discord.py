@@ -1,12 +1,27 @@
 """
     Module for discord connections
 """
-import json
 import asyncio
+import random
+import time
+import traceback
+from enum import Enum
+
+import websockets
 
 from discord.contexts import InteractionContext, MessageContext
 from discord.network import _network, _websocket
+from discord.rest import rest
 from discord.intents import intents
+from discord.interaction_enums import InteractionType
+from discord.args import ArgSpec, ArgError
+from discord.latency import LatencyHistogram
+from discord import cache
+from discord.prefix_store import PrefixStore
+from discord import metrics
+from discord.profiler import HandlerProfiler, LoopWatchdog, StackSampler
+from discord import executors
+from discord import codec
 
 RECV_TIMEOUT = 40
 PING_TIMEOUT = 0.5
@@ -15,127 +30,472 @@ ZLIB_SUFFIX = b"\x00\x00\xff\xff"
 CND_LINK = "https://cdn.discordapp.com/"
 
 # Close code events
+NORMAL_CLOSE = 1000
 ATTEMPT_RESUMING = 1002
 INVALID_SEQ = 4007
 
+# what to do after the gateway closed with a code, anything missing
+# (network drops included) resumes
+RESUME = "resume"
+IDENTIFY = "identify"
+FATAL = "fatal"
+CLOSE_ACTIONS = {
+    ATTEMPT_RESUMING: RESUME,
+    4000: RESUME,  # unknown error
+    4001: RESUME,  # unknown opcode
+    4002: RESUME,  # decode error
+    4003: IDENTIFY,  # not authenticated
+    4004: FATAL,  # authentication failed
+    4005: RESUME,  # already authenticated
+    INVALID_SEQ: IDENTIFY,
+    4008: RESUME,  # rate limited
+    4009: IDENTIFY,  # session timed out
+    4010: FATAL,  # invalid shard
+    4011: FATAL,  # sharding required
+    4012: FATAL,  # invalid api version
+    4013: FATAL,  # invalid intents
+    4014: FATAL,  # disallowed intents
+}
+
+# reconnect backoff in seconds, full jitter up to min(cap, base * 2**n)
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+# discord asks for a 1-5 second wait before identifying after op 9
+INVALID_SESSION_WAIT = (1.0, 5.0)
+
+# payloads bigger than this are parsed on the cpu pool
+PARSE_OFFLOAD_BYTES = 1024 * 1024
+
+# Dispatch workers, events of one guild/channel always go to the same worker
+DISPATCH_WORKERS = 4
+DISPATCH_QUEUE_SIZE = 256
+
 # Http status codes
 HTTP_OK = 200
 HTTP_PUT_OK = 204
 
 
+class State(Enum):
+    DISCONNECTED = 0
+    CONNECTING = 1
+    IDENTIFYING = 2
+    RESUMING = 3
+    CONNECTED = 4
+    CLOSED = 5
+
+
+class GatewayError(Exception):
+    """the gateway closed with a code that reconnecting won't fix"""
+
+    def __init__(self, code):
+        super().__init__(f"gateway closed with {code}")
+        self.code = code
+
+
+def backoff(attempt):
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt))
+
+
 class Bot(_websocket):
     """Main bot class"""
 
-    def __init__(self, intents, token="", cmd_prefix="!"):
+    def __init__(self, intents, token="", cmd_prefix="!", shard=None,
+        prefix_db=None, profiling=None):
         super().__init__()
+        # (shard_id, shard_count) or None for a single connection
+        self.shard = shard
+        # awaited with the shard id before identifying, see discord.shards
+        self.identify_gate = None
         self.token = token
         self.intents = intents
         self.prefix = cmd_prefix
         self.seq_num = None
         self.session = None
+        self.resume_url = None
+        self.gateway = GATE_WAY
+        self.state = State.DISCONNECTED
         self.socket = None
         self.heart_task = None
         self.ack = False
+        # perf_counter of the last heartbeat still waiting for its ack
+        self.beat_sent = None
+        # seconds between heartbeat and ack, the ack is read on the event
+        # loop so a handler blocking the loop shows up here
+        self.latencies = LatencyHistogram()
+        # how late the last heartbeat was sent, same story
+        self.beat_lag = 0.0
         self.user_id = None
-        # Used for caching voice states for bot
+        # Used for caching voice states for bot, (guild_id, user_id) ->
+        # cache.VoiceState, ids are ints
         self.cache = {}
-        self.cache["voice_states"] = {}
+        self.cache["voice_states"] = cache.BoundedCache(cache.VOICE_STATES_MAX)
         self.cache["voice_connections"] = {}
-        self.cache["users"] = {}
-        # Used for caching guild prefix
-        self.cache_prefix = {}
-
-    async def err_code_handler(self, err, uri):
-        """handle err code"""
-        code = err.code
-        if code == INVALID_SEQ:
-            self.session = None
-            self.seq_num = None
-        await self._connect(uri)
+        self.cache["users"] = cache.BoundedCache(
+            cache.USERS_MAX, ttl=cache.USERS_TTL)
+        # Used for caching guild prefix, backed by sqlite with prefix_db
+        self.prefix_store = PrefixStore(prefix_db) if prefix_db else None
+        if self.prefix_store:
+            self.cache_prefix = self.prefix_store.cache
+        else:
+            self.cache_prefix = cache.BoundedCache(cache.PREFIXES_MAX)
+        # t -> tuple of handlers, built when the bot starts
+        self.handlers = {}
+        self.dispatch_queues = []
+        self.dispatch_tasks = []
+        self.command_tasks = set()
+        # discord.profiler.ProfileConfig, everything off without it
+        self.profiling = profiling
+        self.profiler = None
+        self.watchdog = None
+        self.sampler = None
+
+    def reset_session(self):
+        """forget the session, the next connection identifies"""
+        self.session = None
+        self.seq_num = None
+        self.resume_url = None
+
+    def connect_url(self):
+        """resumes go to the url READY gave, with the same query"""
+        if self.session and self.resume_url:
+            query = self.gateway.partition("?")[2]
+            return f"{self.resume_url.rstrip('/')}/?{query}"
+        return self.gateway
+
+    def close_action(self, err):
+        return CLOSE_ACTIONS.get(self.close_code(err), RESUME)
+
+    async def run(self, gateway):
+        """ Connect and keep reconnecting until close() or a fatal close
+            code. Each connection returns here instead of recursing, the
+            close code picks between resuming and a fresh identify, the
+            wait before the next attempt grows while connections keep
+            failing before READY/RESUMED.
+        """
+        self.gateway = gateway
+        attempt = 0
+        while self.state is not State.CLOSED:
+            self.state = State.CONNECTING
+            err = None
+            try:
+                err = await self._connect(self.connect_url())
+            except (OSError, asyncio.TimeoutError,
+                    websockets.exceptions.WebSocketException) as e:
+                print(f"gateway connect failed: {e!r}")
+            finally:
+                if self.heart_task:
+                    self.heart_task.cancel()
+                    self.heart_task = None
+            if self.state is State.CLOSED:
+                break
+            if self.state is State.CONNECTED:
+                attempt = 0
+            self.state = State.DISCONNECTED
+            metrics.GATEWAY_DISCONNECTS.inc(str(self.close_code(err)))
+            action = self.close_action(err)
+            if action == FATAL:
+                self.state = State.CLOSED
+                raise GatewayError(self.close_code(err))
+            if action == IDENTIFY:
+                self.reset_session()
+            await asyncio.sleep(backoff(attempt))
+            attempt += 1
 
     async def on_message(self, msg):
-        """decode and send to correct"""
+        """decode and send to correct op handler, runs on the receive loop
+        so frames are handled in the order they arrive"""
         data = await super().decode(msg)
-        data = json.loads(data)
-        op = data["op"]
-        try:
-            await self.ops[op](self, data)
-        except KeyError:
-            # traceback.print_exc()
-            pass
-
-    async def start(self):
+        if data is None:
+            # partial zlib frame, wait for the rest
+            return
+        if len(data) > PARSE_OFFLOAD_BYTES:
+            data = await self.run_blocking(codec.loads, data, kind="cpu")
+        else:
+            data = codec.loads(data)
+        handler = self.ops.get(data["op"])
+        if handler:
+            await handler(self, data)
+
+    async def run_blocking(self, func, *args, kind="io"):
+        """ run func(*args) on the io or cpu thread pool and await it, for
+            anything that would block the loop (file work, big parses)
+        """
+        return await executors.get().pool(kind).run(func, *args)
+
+    def build_handlers(self):
+        """precompute the handlers for every event type"""
+        handlers = {}
+        for typ, funcs in Bot.listeners.items():
+            handlers[typ] = tuple(funcs)
+        for typ, func in self.ts.items():
+            handlers[typ] = handlers.get(typ, ()) + (func,)
+        return handlers
+
+    def start_dispatch(self):
+        """start the worker pool that runs event handlers"""
+        self.stop_dispatch()
+        self.handlers = self.build_handlers()
+        self.dispatch_queues = [
+            asyncio.Queue(DISPATCH_QUEUE_SIZE) for _ in range(DISPATCH_WORKERS)
+        ]
+        self.dispatch_tasks = [
+            asyncio.create_task(self.dispatch_worker(q))
+            for q in self.dispatch_queues
+        ]
+
+    def stop_dispatch(self):
+        for task in self.dispatch_tasks:
+            task.cancel()
+        self.dispatch_tasks = []
+
+    async def dispatch_worker(self, queue):
+        """run handlers one event at a time, errors don't stop the worker"""
+        observe = metrics.HANDLER_SECONDS.observe
+        while True:
+            handlers, msg = await queue.get()
+            for func in handlers:
+                start = time.perf_counter()
+                try:
+                    coro = func(self, msg)
+                    if self.profiler:
+                        coro = self.profiler.wrap(coro, func.__qualname__)
+                    await coro
+                except Exception:
+                    traceback.print_exc()
+                observe(time.perf_counter() - start, msg["t"], func.__name__)
+
+    def spawn(self, coro, name=None):
+        """ run a command as its own task, commands can take minutes
+        (downloads, ffmpeg) and would otherwise hold up a dispatch worker.
+        named ones are profiled when that's on
+        """
+        if name and self.profiler:
+            coro = self.profiler.wrap(coro, name)
+        task = asyncio.create_task(coro)
+        self.command_tasks.add(task)
+        task.add_done_callback(self._command_done)
+        return task
+
+    def _command_done(self, task):
+        self.command_tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            traceback.print_exception(task.exception())
+
+    async def start(self, gateway=GATE_WAY):
         """Start the bot session"""
-        asyncio.create_task(_network.create_session())
-        await self._connect(GATE_WAY)
+        # ready before the gateway can trigger any sends
+        await _network.create_session()
+        if self.prefix_store:
+            await self.prefix_store.open()
+        self.start_dispatch()
+        self.start_profiling()
+        shard = str(self.shard[0]) if self.shard else "0"
+        metrics.GATEWAY_LATENCY.track(lambda: self.latency, shard)
+        try:
+            await self.run(gateway)
+        finally:
+            metrics.GATEWAY_LATENCY.untrack(shard)
+            self.stop_profiling()
+            self.stop_dispatch()
+            if self.prefix_store:
+                await self.prefix_store.close()
+            # the session belongs to this event loop, main.py starts a new
+            # one. shards of one process share both, the last one out resets
+            if await _network.close_session():
+                rest.reset()
+
+    def start_profiling(self):
+        cfg = self.profiling
+        if not cfg:
+            return
+        if cfg.handlers:
+            self.profiler = HandlerProfiler(cfg.sample_rate)
+        if cfg.stall_ms:
+            self.watchdog = LoopWatchdog(cfg.stall_ms / 1000).start()
+        if cfg.stack_sample_ms:
+            self.sampler = StackSampler(cfg.stack_sample_ms / 1000).start()
+
+    def stop_profiling(self):
+        if self.watchdog:
+            self.watchdog.stop()
+        if self.sampler:
+            self.sampler.stop()
+
+    def profile_stats(self, top=20):
+        """slowest handlers, loop stalls and the hottest sampled frames"""
+        return {
+            "handlers": self.profiler.stats(top) if self.profiler else None,
+            "loop": self.watchdog.stats() if self.watchdog else None,
+            "hot": self.sampler.top(top) if self.sampler else None,
+        }
 
     async def close(self):
-        """Close the bot session"""
-        if self.heatr_task:
+        """Close the bot session, run() returns instead of reconnecting"""
+        self.state = State.CLOSED
+        if self.heart_task:
             self.heart_task.cancel()
+        self.stop_dispatch()
         if self.socket:
-            await self.socket.close()
+            await self.socket.close(code=NORMAL_CLOSE)
+
+    async def send_heartbeat(self):
+        op1 = {"op": 1, "d": self.seq_num}
+        self.beat_sent = time.perf_counter()
+        await self.socket.send(codec.dumps(op1))
 
     async def heart_beat(self, interval):
-        """start beat interval"""
+        """ Beat on a fixed schedule of the loop's monotonic clock, the
+            first one after interval * jitter as discord asks. Deadlines
+            are added to, not measured from the last send, so time spent
+            sending doesn't pile up; after a stall longer than an interval
+            the schedule restarts from now instead of beating in a burst.
+        """
+        interval /= 1000
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + interval * random.random()
+        self.ack = True
         while self.socket:
-            op1 = {"op": 1, "d": self.seq_num}
-            await self.socket.send(json.dumps(op1))
-            await asyncio.sleep(interval / 1000)
-            if self.ack:
-                self.ack = False
-            else:
+            await asyncio.sleep(max(0.0, deadline - loop.time()))
+            if not self.ack:
                 # Attempt resuming
                 await self.socket.close(
                     code=ATTEMPT_RESUMING,
-                    reason="No heartack/zombied \
-                                       connection.",
+                    reason="No heartack/zombied connection.",
                 )
                 break
+            now = loop.time()
+            self.beat_lag = now - deadline
+            self.ack = False
+            await self.send_heartbeat()
+            deadline += interval
+            if deadline <= now:
+                deadline = now + interval
+
+    @property
+    def latency(self):
+        """last heartbeat round trip in seconds, None before the first ack"""
+        return self.latencies.last
+
+    def latency_stats(self):
+        stats = self.latencies.stats()
+        stats["beat_lag"] = self.beat_lag
+        return stats
 
     async def on_ready(self, msg):
         """update session id"""
         self.user_id = msg["d"]["user"]["id"]
         self.session = msg["d"]["session_id"]
+        self.resume_url = msg["d"].get("resume_gateway_url")
+        self.state = State.CONNECTED
 
     async def on_resume(self, msg):
         """keep resumed"""
-        pass
+        self.state = State.CONNECTED
+
+    def get_prefix(self, guild_id):
+        """cached prefix only, see resolve_prefix"""
+        if self.prefix_store:
+            return self.prefix_store.get(guild_id) or self.prefix
+        return self.cache_prefix.get(guild_id) or self.prefix
+
+    async def resolve_prefix(self, guild_id):
+        """ the guild's prefix, only the first message of a guild (or one
+            after its entry was evicted) waits for the store
+        """
+        if not self.prefix_store or not guild_id:
+            return self.get_prefix(guild_id)
+        prefix = self.prefix_store.get(guild_id)
+        if prefix is None:
+            prefix = await self.prefix_store.load(guild_id)
+        return prefix or self.prefix
+
+    def set_prefix(self, guild_id, prefix):
+        """set a guild's prefix, None/empty goes back to the default"""
+        if self.prefix_store:
+            self.prefix_store.set(guild_id, prefix)
+        elif prefix:
+            self.cache_prefix.set(guild_id, prefix)
+        else:
+            self.cache_prefix.pop(guild_id, None)
+
+    def match_command(self, content, prefix):
+        """ return (name, rest) if content invokes a registered command.
+            most messages fail the prefix check, nothing else is looked at
+            for those, the rest of the content is only split by the handler
+        """
+        if not content.startswith(prefix):
+            return None, None
+        body = content[len(prefix):]
+        if not body or body[0].isspace():
+            return None, None
+        parts = body.split(None, 1)
+        if parts[0] not in Bot.commands:
+            return None, None
+        return parts[0], parts[1] if len(parts) > 1 else ""
 
     async def on_message_crt(self, msg):
         """await couroutines and check for commands"""
         data = msg["d"]
-        try:
-            is_bot = data["author"]["bot"]
-        except KeyError:
-            is_bot = False
-        finally:
-            if is_bot:
-                return
-        ct = data["content"]
-        try:
-            p = self.cache_prefix[data["guild_id"]]
-            if p == None or p == "":
-                p = self.prefix
-        except KeyError:
-            p = self.prefix
-
-        p_len = len(p)
-        if not ct[:p_len] == p:
+        name, rest = self.match_command(
+            data["content"], await self.resolve_prefix(data.get("guild_id")))
+        if not name:
             return
-        ct = ct.split()[0]
-        for cmd_name, cmd_lst in Bot.commands.items():
-            if ct[p_len:] == cmd_name:
-                for cmd in cmd_lst:
-                    await cmd(MessageContext(self, msg))
-        pass
+        if data["author"].get("bot"):
+            return
+        self.cache_user(data["author"])
+        for cmd in Bot.commands[name]:
+            ctx = MessageContext(self, msg)
+            ctx.invoked_with = name
+            ctx.rest = rest
+            if cmd.arg_spec:
+                try:
+                    ctx.args = cmd.arg_spec.parse(rest)
+                except ArgError as e:
+                    # rejected before the command does any work
+                    self.spawn(ctx.send_msg(str(e)))
+                    continue
+            self.spawn(cmd(ctx), cmd.__qualname__)
 
     async def on_voice_state_update(self, msg):
-        """update cache or update bot"""
+        """update cache or update bot, leaving the channel drops the entry"""
         data = msg["d"]
         v_s = self.cache["voice_states"]
-        uid = data["user_id"]
-        v_s[uid] = msg
+        state = cache.VoiceState.from_data(data)
+        if state.channel_id is None:
+            v_s.pop(state.key)
+        else:
+            v_s.set(state.key, state)
+        user = (data.get("member") or {}).get("user")
+        if user:
+            self.cache_user(user)
+
+    async def on_guild_delete(self, msg):
+        """left the guild (or it went unavailable), forget its state"""
+        guild_id = msg["d"]["id"]
+        gid = cache.snowflake(guild_id)
+        self.cache["voice_states"].remove_where(lambda key: key[0] == gid)
+        self.cache["voice_connections"].pop(guild_id, None)
+        if not msg["d"].get("unavailable"):
+            # an outage isn't a leave, the prefix is still configured.
+            # only the memory copy goes, a re-invite finds it on disk
+            self.cache_prefix.pop(guild_id)
+
+    def cache_user(self, data):
+        user = cache.User.from_data(data)
+        self.cache["users"].set(user.id, user)
+
+    def get_user(self, user_id):
+        return self.cache["users"].get(cache.snowflake(user_id))
+
+    def get_voice_state(self, guild_id, user_id):
+        return self.cache["voice_states"].get(
+            (cache.snowflake(guild_id), cache.snowflake(user_id)))
+
+    def cache_stats(self):
+        stats = {name: c.stats() for name, c in self.cache.items()
+            if isinstance(c, cache.BoundedCache)}
+        stats["prefixes"] = self.cache_prefix.stats()
+        return stats
 
     async def on_voice_server_update(self, msg):
         """start the connect process"""
@@ -147,44 +507,49 @@ class Bot(_websocket):
 
     async def on_interact_crt(self, msg):
         data = msg['d']
-        for k, v in Bot.interactions.items():
-            if k == (data['type'], data['data'].get('name')):
-                await v(InteractionContext(self, msg))
+        func = Bot.interactions.get(
+            (InteractionType(data['type']), (data.get('data') or {}).get('name')))
+        if func:
+            self.spawn(func(InteractionContext(self, msg)), func.__qualname__)
 
     ts = {
         "INTERACTION_CREATE": on_interact_crt,
         "READY": on_ready,
+        "RESUMED": on_resume,
         "MESSAGE_CREATE": on_message_crt,
         "VOICE_STATE_UPDATE": on_voice_state_update,
         "VOICE_SERVER_UPDATE": on_voice_server_update,
+        "GUILD_DELETE": on_guild_delete,
     }
 
     async def op_0(self, msg):
-        """distribute types from op 0 type"""
-        typ = msg["t"]
-        self.seq_num = msg["s"]
-        try:
-            for func in Bot.listeners[typ]:
-                await func(self, msg)
-        except KeyError:
-            pass
+        """distribute types from op 0 type
 
-        try:
-            await self.ts[typ](self, msg)
-        except KeyError:
-            pass
+        Events are queued in gateway order. Every event of a guild (or
+        channel for DMs) goes to the same worker, so handlers see those in
+        order, events of different guilds can run concurrently. A full
+        queue blocks the receive loop instead of dropping events.
+        """
+        self.seq_num = msg["s"]
+        metrics.GATEWAY_EVENTS.inc(msg["t"])
+        handlers = self.handlers.get(msg["t"])
+        if not handlers:
+            return
+        d = msg["d"] or {}
+        key = d.get("guild_id") or d.get("channel_id")
+        queue = self.dispatch_queues[hash(key) % len(self.dispatch_queues)]
+        await queue.put((handlers, msg))
 
     async def op_1(self, msg):
         """send back heart beat"""
-        op1 = {"op": 1, "d": self.seq_num}
-        await self.socket.send(json.dumps(op1))
+        await self.send_heartbeat()
 
     async def send_resume(self):
         op6 = {
             "op": 6,
             "d": {"token": self.token, "session_id": self.session, "seq": self.seq_num},
         }
-        await self.socket.send(json.dumps(op6))
+        await self.socket.send(codec.dumps(op6))
 
     async def self_identify(self):
         op2 = {
@@ -206,7 +571,11 @@ class Bot(_websocket):
                 "intents": self.intents,
             },
         }
-        await self.socket.send(json.dumps(op2))
+        if self.shard:
+            op2["d"]["shard"] = list(self.shard)
+            if self.identify_gate:
+                await self.identify_gate(self.shard[0])
+        await self.socket.send(codec.dumps(op2))
 
     async def op_7(self, msg):
         """atempt reconnection"""
@@ -215,12 +584,14 @@ class Bot(_websocket):
     async def op_9(self, msg):
         """reconnect properly based on d"""
         resumable = msg["d"]
-        if not resumable:
-            self.session = None
-            self.seq_num = None
-            await self.self_identify()
-        else:
+        if resumable and self.session:
+            self.state = State.RESUMING
             await self.send_resume()
+        else:
+            self.reset_session()
+            await asyncio.sleep(random.uniform(*INVALID_SESSION_WAIT))
+            self.state = State.IDENTIFYING
+            await self.self_identify()
 
     async def op_10(self, msg):
         """send hello message back"""
@@ -228,28 +599,34 @@ class Bot(_websocket):
             print("heart task cancel")
             self.heart_task.cancel()
         hbt_int = msg["d"]["heartbeat_interval"]
+        # an ack for a beat of the old connection never comes
+        self.beat_sent = None
         self.heart_task = asyncio.create_task(self.heart_beat(hbt_int))
-        if not self.session:
+        if self.session and self.seq_num is not None:
+            self.state = State.RESUMING
+            await self.send_resume()
+        else:
             # send indentification
+            self.state = State.IDENTIFYING
             await self.self_identify()
-        else:
-            await self.send_resume()
 
     async def op_11(self, msg):
-        """set ack to true"""
+        """set ack to true, record the round trip"""
         self.ack = True
+        if self.beat_sent is not None:
+            self.latencies.record(time.perf_counter() - self.beat_sent)
+            self.beat_sent = None
 
     @staticmethod
-    def command(*args):
-        """decorator for adding commands"""
+    def command(*names, args=None):
+        """decorator for adding commands, args is a list of discord.args.Arg
+        that gets compiled now and parsed into ctx.args before the command runs"""
+        spec = ArgSpec(args) if args else None
 
         def add_command(func):
             """add command that looks for message"""
-            if len(args) == 0:
-                Bot.commands[func.__name__] = [
-                    func,
-                ]
-            for cmd in args:
+            func.arg_spec = spec
+            for cmd in names or (func.__name__,):
                 try:
                     # append if command already exist
                     arr = Bot.commands[cmd]
@@ -258,6 +635,7 @@ class Bot(_websocket):
                     Bot.commands[cmd] = [
                         func,
                     ]
+            return func
 
         return add_command
 
@@ -267,7 +645,8 @@ class Bot(_websocket):
         
         def add_interaction(func):
             Bot.interactions[(inter_type, name)] = func
-            
+            return func
+
         return add_interaction
 
     @staticmethod
@@ -284,6 +663,7 @@ class Bot(_websocket):
                     Bot.listeners[typ] = [
                         func,
                     ]
+            return func
 
         return add_listener
 
@@ -306,7 +686,7 @@ class Bot(_websocket):
             },
         }
 
-        await self.socket.send(json.dumps(data))
+        await self.socket.send(codec.dumps(data))
 
 
 class BotVoice(_websocket):
@@ -322,3 +702,122 @@ class BotVoice(_websocket):
         # wait for voice_status update
         print("Starying@")
 
+
+def benchmark(events=100_000, guilds=1000):
+    """ events/sec through Bot.on_message, from compressed frames to the
+        handlers returning: inflate, parse, queue and the dispatch workers
+    """
+    import json
+    from zlib import compressobj, decompressobj, Z_SYNC_FLUSH
+
+    deflate = compressobj()
+    frames = [deflate.compress(json.dumps({"op": 0, "t": "BENCH", "s": i, "d": {
+        "id": str(10**18 + i), "guild_id": str(10**17 + i % guilds),
+        "channel_id": "5", "content": f"message {i}"}}).encode())
+        + deflate.flush(Z_SYNC_FLUSH) for i in range(events)]
+
+    async def main():
+        bot = Bot(intents=0)
+        bot.inflator = decompressobj()
+        bot.buffer = bytearray()
+        bot.start_dispatch()
+        done = asyncio.Event()
+        handled = 0
+
+        async def handler(bot, msg):
+            nonlocal handled
+            handled += 1
+            if handled == events:
+                done.set()
+
+        bot.handlers["BENCH"] = (handler,)
+        start = time.perf_counter()
+        for frame in frames:
+            await bot.on_message(frame)
+        await done.wait()
+        took = time.perf_counter() - start
+        bot.stop_dispatch()
+        return {"events": events, "seconds": took, "events_per_sec": events / took}
+
+    return asyncio.run(main())
+
+
+
+def benchmark_commands(messages=200_000, commands=50, command_share=0.05,
+    guilds=100):
+    """ messages/sec of a busy channel's MESSAGE_CREATEs through
+        on_message_crt, against the old scan over every registered command
+        for every message that has the prefix
+    """
+    rnd = random.Random(0)
+    words = ["lol", "ok", "what", "nice", "gg", "yeah", "the", "video", "link"]
+
+    def content():
+        if rnd.random() < command_share:
+            return f".cmd{rnd.randrange(commands)} {rnd.choice(words)}"
+        if rnd.random() < 0.1:
+            # starts with the prefix but isn't a command
+            return "." * rnd.randint(1, 3) + " ".join(rnd.choices(words, k=3))
+        return " ".join(rnd.choices(words, k=rnd.randint(1, 12)))
+
+    stream = [{"op": 0, "t": "MESSAGE_CREATE", "s": i, "d": {
+        "id": str(10**18 + i), "channel_id": "5",
+        "guild_id": str(10**17 + rnd.randrange(guilds)), "content": content(),
+        "author": {"id": str(rnd.randrange(1000)), "username": "x"}}}
+        for i in range(messages)]
+
+    async def noop(ctx):
+        pass
+
+    # the old prefix cache was a plain dict
+    prefixes = {}
+
+    async def old_on_message_crt(bot, msg):
+        """the routing before match_command"""
+        data = msg["d"]
+        try:
+            is_bot = data["author"]["bot"]
+        except KeyError:
+            is_bot = False
+        if is_bot:
+            return
+        ct = data["content"]
+        try:
+            p = prefixes[data["guild_id"]]
+            if p is None or p == "":
+                p = bot.prefix
+        except KeyError:
+            p = bot.prefix
+        p_len = len(p)
+        if not ct[:p_len] == p:
+            return
+        ct = ct.split()[0]
+        for cmd_name, cmd_lst in Bot.commands.items():
+            if ct[p_len:] == cmd_name:
+                for cmd in cmd_lst:
+                    bot.spawn(cmd(MessageContext(bot, msg)))
+
+    async def measure(handler):
+        bot = Bot(intents=0, cmd_prefix=".")
+        start = time.perf_counter()
+        for msg in stream:
+            await handler(bot, msg)
+        await asyncio.gather(*bot.command_tasks)
+        took = time.perf_counter() - start
+        return {"seconds": took, "messages_per_sec": messages / took}
+
+    saved = dict(Bot.commands)
+    for i in range(commands):
+        Bot.command(f"cmd{i}")(noop)
+    try:
+        return {"messages": messages, "commands": len(Bot.commands),
+            "old": asyncio.run(measure(old_on_message_crt)),
+            "new": asyncio.run(measure(Bot.on_message_crt))}
+    finally:
+        Bot.commands.clear()
+        Bot.commands.update(saved)
+
+
+if __name__ == "__main__":
+    print(benchmark())
+    print(benchmark_commands())
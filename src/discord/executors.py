@@ -0,0 +1,185 @@
+"""
+    Thread pools for blocking work that would otherwise run on the event
+    loop, one for cpu bound work (inflating, parsing) and one for io
+    (file writes, unlinks). Shared by every bot in the process like the
+    http session
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from discord import metrics
+
+# 0 sizes from the cpu count
+CPU_WORKERS = 0
+IO_WORKERS = 0
+# calls waiting for a thread beyond which callers wait their turn
+MAX_QUEUED = 256
+
+EXECUTOR_QUEUED = metrics.registry.gauge("executor_queued",
+    "blocking calls waiting for a thread", ("pool",))
+EXECUTOR_SECONDS = metrics.registry.histogram("executor_seconds",
+    "blocking call time including the wait for a thread", ("pool",))
+
+
+class BoundedExecutor:
+    """ A thread pool that takes at most workers + max_queued calls, the
+        rest wait on the loop instead of piling up in the pool's queue
+    """
+
+    def __init__(self, name, workers, max_queued=MAX_QUEUED):
+        self.name = name
+        self.workers = workers
+        self.max_queued = max_queued
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix=name)
+        self.slots = None
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        EXECUTOR_QUEUED.track(lambda: max(0, self.pending - self.workers), name)
+
+    async def run(self, func, *args):
+        if self.slots is None:
+            # made on first use so it belongs to the running loop
+            self.slots = asyncio.Semaphore(self.workers + self.max_queued)
+        start = time.perf_counter()
+        async with self.slots:
+            self.pending += 1
+            try:
+                return await asyncio.get_running_loop().run_in_executor(
+                    self.pool, func, *args)
+            finally:
+                self.pending -= 1
+                self.completed += 1
+                EXECUTOR_SECONDS.observe(time.perf_counter() - start, self.name)
+
+    def fire(self, func, *args):
+        """run func without waiting for it, errors are counted and dropped"""
+        fut = self.pool.submit(func, *args)
+        fut.add_done_callback(self._fired)
+
+    def _fired(self, fut):
+        self.completed += 1
+        if fut.exception():
+            self.failed += 1
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False)
+
+    def stats(self):
+        return {"workers": self.workers, "pending": self.pending,
+            "completed": self.completed, "failed": self.failed}
+
+
+class Executors:
+
+    def __init__(self, cpu_workers=CPU_WORKERS, io_workers=IO_WORKERS,
+        max_queued=MAX_QUEUED):
+        cpus = os.cpu_count() or 1
+        self.cpu = BoundedExecutor("cpu", cpu_workers or max(1, cpus - 1),
+            max_queued)
+        # io threads mostly wait, more of them than cores is fine
+        self.io = BoundedExecutor("io", io_workers or min(32, cpus * 4),
+            max_queued)
+
+    def pool(self, kind):
+        return self.cpu if kind == "cpu" else self.io
+
+    def stats(self):
+        return {"cpu": self.cpu.stats(), "io": self.io.stats()}
+
+
+_executors = None
+_options = {}
+
+
+def configure(**options):
+    """cpu_workers/io_workers/max_queued, used when the pools are made"""
+    _options.update(options)
+
+
+def get():
+    """the process wide executors, made on first use"""
+    global _executors
+    if _executors is None:
+        _executors = Executors(**_options)
+    return _executors
+
+
+def unlink_quiet(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def benchmark(frame_mb=64, file_mb=256, tick=0.01):
+    """ worst heartbeat-style tick lag while a large frame is inflated and
+        a large download is written out and deleted, on the loop vs in
+        the pools
+    """
+    import tempfile
+    import zlib
+
+    raw = os.urandom(1024) * (frame_mb * 1024)
+    frame = zlib.compress(raw)
+    chunk = os.urandom(64 * 1024)
+    ex = Executors()
+
+    async def ticker(lags, stop):
+        loop = asyncio.get_running_loop()
+        while not stop.is_set():
+            start = loop.time()
+            await asyncio.sleep(tick)
+            lags.append(loop.time() - start - tick)
+
+    async def work(offload):
+        inflate = zlib.decompressobj()
+        if offload:
+            await ex.cpu.run(inflate.decompress, frame)
+        else:
+            inflate.decompress(frame)
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, "wb") as f:
+            for _ in range(file_mb * 16):
+                if offload:
+                    await ex.io.run(f.write, chunk)
+                else:
+                    f.write(chunk)
+                # the network hands over the next chunk
+                await asyncio.sleep(0)
+            if offload:
+                await ex.io.run(os.fsync, f.fileno())
+            else:
+                os.fsync(f.fileno())
+        if offload:
+            await ex.io.run(os.unlink, path)
+        else:
+            os.unlink(path)
+
+    async def measure(offload):
+        lags = []
+        stop = asyncio.Event()
+        t = asyncio.create_task(ticker(lags, stop))
+        await asyncio.sleep(tick * 2)
+        start = time.perf_counter()
+        await work(offload)
+        took = time.perf_counter() - start
+        stop.set()
+        await t
+        return {"max_lag_ms": max(lags) * 1000,
+            "avg_lag_ms": sum(lags) / len(lags) * 1000, "seconds": took}
+
+    async def main():
+        return {"on_loop": await measure(False), "offloaded": await measure(True)}
+
+    try:
+        return asyncio.run(main())
+    finally:
+        ex.cpu.shutdown()
+        ex.io.shutdown()
+
+
+if __name__ == "__main__":
+    print(benchmark())
@@ -0,0 +1,62 @@
+"""
+    Rolling latency histogram for the gateway heartbeat
+"""
+from bisect import bisect_left
+from collections import deque
+
+# bucket upper bounds in seconds, the last bucket takes everything above
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# heartbeats kept, ~40s apart so this is the last ~40 minutes
+LATENCY_SAMPLES = 64
+
+
+class LatencyHistogram:
+    """ Keeps the last `samples` measurements and bucket counts over the
+        same window, an old sample leaves its bucket when it drops out
+    """
+
+    def __init__(self, samples=LATENCY_SAMPLES, buckets=LATENCY_BUCKETS):
+        self.samples = deque(maxlen=samples)
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+
+    def _bucket(self, seconds):
+        return bisect_left(self.buckets, seconds)
+
+    def record(self, seconds):
+        if len(self.samples) == self.samples.maxlen:
+            self.counts[self._bucket(self.samples[0])] -= 1
+        self.samples.append(seconds)
+        self.counts[self._bucket(seconds)] += 1
+
+    @property
+    def last(self):
+        return self.samples[-1] if self.samples else None
+
+    def mean(self):
+        if not self.samples:
+            return None
+        return sum(self.samples) / len(self.samples)
+
+    def percentile(self, p):
+        """p in 0-100 over the window, None without samples"""
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        i = min(len(ordered) - 1, int(len(ordered) * p / 100))
+        return ordered[i]
+
+    def histogram(self):
+        """(upper bound, count) pairs, the last bound is None"""
+        return list(zip(self.buckets + (None,), self.counts))
+
+    def stats(self):
+        return {
+            "last": self.last,
+            "mean": self.mean(),
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "max": max(self.samples) if self.samples else None,
+            "count": len(self.samples),
+            "histogram": self.histogram(),
+        }
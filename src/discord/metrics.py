@@ -0,0 +1,201 @@
+"""
+    Prometheus style counters, gauges and histograms with a text /metrics
+    endpoint. Everything runs on the event loop, an update is a dict
+    lookup and an add, cheap enough to leave on
+"""
+from bisect import bisect_left
+
+# seconds, from a fast handler up to a long ffmpeg job
+DEFAULT_BUCKETS = (0.001, 0.005, 0.025, 0.1, 0.25, 1.0, 2.5, 10.0, 30.0,
+    120.0, 600.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=""):
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _num(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.label_names = tuple(labels)
+        # label values tuple -> value
+        self.values = {}
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield "", key, "", value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, extra, value in self.samples():
+            if value is None:
+                continue
+            lines.append(f"{self.name}{suffix}"
+                f"{_labels(self.label_names, key, extra)} {_num(value)}")
+        return lines
+
+    def snapshot(self):
+        return {key: value for _, key, _, value in self.samples()}
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    """ set() a value or track() a function read at collection time, the
+        latter costs nothing until something asks
+    """
+    kind = "gauge"
+
+    def __init__(self, name, doc, labels=()):
+        super().__init__(name, doc, labels)
+        self.funcs = {}
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+    def track(self, func, *labels):
+        self.funcs[labels] = func
+
+    def untrack(self, *labels):
+        self.funcs.pop(labels, None)
+        self.values.pop(labels, None)
+
+    def samples(self):
+        yield from super().samples()
+        for key, func in list(self.funcs.items()):
+            yield "", key, "", func()
+
+
+class _HistogramValue:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        h = self.values.get(labels)
+        if h is None:
+            h = self.values[labels] = _HistogramValue(len(self.buckets) + 1)
+        h.counts[bisect_left(self.buckets, value)] += 1
+        h.sum += value
+        h.count += 1
+
+    def samples(self):
+        for key, h in list(self.values.items()):
+            total = 0
+            for bound, n in zip(self.buckets + (float("inf"),), h.counts):
+                total += n
+                yield "_bucket", key, f'le="{_num(bound)}"', total
+            yield "_sum", key, "", h.sum
+            yield "_count", key, "", h.count
+
+    def snapshot(self):
+        return {key: {"count": h.count, "sum": h.sum,
+            "buckets": list(zip(self.buckets + (float("inf"),), h.counts))}
+            for key, h in self.values.items()}
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = {}
+
+    def _add(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"metric {metric.name} exists already")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, doc, labels=()):
+        return self._add(Counter(name, doc, labels))
+
+    def gauge(self, name, doc, labels=()):
+        return self._add(Gauge(name, doc, labels))
+
+    def histogram(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, doc, labels, buckets))
+
+    def render(self):
+        """text exposition format"""
+        lines = []
+        for metric in self.metrics.values():
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """name -> {label values: value}, for use in process"""
+        return {name: m.snapshot() for name, m in self.metrics.items()}
+
+
+registry = Registry()
+
+# gateway
+GATEWAY_EVENTS = registry.counter("gateway_events_total",
+    "dispatch events received", ("type",))
+GATEWAY_DISCONNECTS = registry.counter("gateway_disconnects_total",
+    "gateway connections closed", ("code",))
+GATEWAY_LATENCY = registry.gauge("gateway_latency_seconds",
+    "last heartbeat round trip", ("shard",))
+HANDLER_SECONDS = registry.histogram("handler_seconds",
+    "time spent in event handlers", ("event", "handler"))
+# rest
+REST_SECONDS = registry.histogram("rest_request_seconds",
+    "rest request time including retries and rate limit waits", ("route",))
+REST_RESPONSES = registry.counter("rest_responses_total",
+    "rest responses by status, error for network failures", ("route", "status"))
+UPLOAD_BYTES = registry.counter("upload_bytes_total", "bytes of files uploaded")
+# jobs (yt-dlp, ffmpeg)
+JOB_SECONDS = registry.histogram("job_seconds", "job run time", ("scheduler",))
+JOB_WAIT_SECONDS = registry.histogram("job_wait_seconds",
+    "time jobs waited for a slot", ("scheduler",))
+JOB_QUEUED = registry.gauge("job_queued", "jobs waiting for a slot", ("scheduler",))
+JOB_RUNNING = registry.gauge("job_running", "jobs running", ("scheduler",))
+
+
+async def serve(host="127.0.0.1", port=9100, reg=registry):
+    """ serve GET /metrics on the running loop, returns the runner to
+        cleanup() when done
+    """
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=reg.render(),
+            content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -1,22 +1,123 @@
 import websockets
-import asyncio
-from aiohttp import ClientSession, TCPConnector, FormData
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, TraceConfig
 from zlib import decompressobj
+from discord import codec
+from discord import executors
 
 ZLIB_SUFFIX = b"\x00\x00\xff\xff"
+# compressed frames bigger than this (GUILD_CREATE of big guilds) are
+# inflated on the cpu pool so heartbeats keep going meanwhile
+INFLATE_OFFLOAD_BYTES = 64 * 1024
+
+
+# http pool defaults
+HTTP_LIMIT = 100
+HTTP_LIMIT_PER_HOST = 30
+HTTP_KEEPALIVE = 30
+HTTP_DNS_TTL = 300
+HTTP_TIMEOUT_TOTAL = 300
+HTTP_TIMEOUT_CONNECT = 10
+HTTP_TIMEOUT_READ = 60
 
 
 class _network:
-    """abstract network class"""
+    """abstract network class, owns the shared http session"""
 
     network_se: ClientSession = None
+    # bots sharing the session (shards in one process)
+    users = 0
+    options = {}
+    # pool metrics, updated by trace hooks
+    metrics = {
+        "requests": 0,
+        "connections_created": 0,
+        "connections_reused": 0,
+        "queued": 0,
+    }
 
     def __init__(self):
         pass
 
+    @staticmethod
+    def configure(**options):
+        """override pool settings, used for the next session created"""
+        _network.options.update(options)
+
+    @staticmethod
+    def _trace():
+        m = _network.metrics
+
+        async def on_request(session, ctx, params):
+            m["requests"] += 1
+
+        async def on_create(session, ctx, params):
+            m["connections_created"] += 1
+
+        async def on_reuse(session, ctx, params):
+            m["connections_reused"] += 1
+
+        async def on_queued(session, ctx, params):
+            # every connection was busy, pool is saturated
+            m["queued"] += 1
+
+        trace = TraceConfig()
+        trace.on_request_start.append(on_request)
+        trace.on_connection_create_end.append(on_create)
+        trace.on_connection_reuseconn.append(on_reuse)
+        trace.on_connection_queued_start.append(on_queued)
+        return trace
+
     @staticmethod
     async def create_session():
-        _network.network_se = ClientSession(connector=TCPConnector())
+        """create the session unless an open one exists, every call
+        needs a matching close_session"""
+        _network.users += 1
+        se = _network.network_se
+        if se and not se.closed:
+            return se
+        o = _network.options
+        connector = TCPConnector(
+            limit=o.get("limit", HTTP_LIMIT),
+            limit_per_host=o.get("limit_per_host", HTTP_LIMIT_PER_HOST),
+            keepalive_timeout=o.get("keepalive", HTTP_KEEPALIVE),
+            ttl_dns_cache=o.get("dns_ttl", HTTP_DNS_TTL),
+            use_dns_cache=True,
+        )
+        timeout = ClientTimeout(
+            total=o.get("timeout_total", HTTP_TIMEOUT_TOTAL),
+            connect=o.get("timeout_connect", HTTP_TIMEOUT_CONNECT),
+            sock_read=o.get("timeout_read", HTTP_TIMEOUT_READ),
+        )
+        _network.network_se = ClientSession(connector=connector,
+            timeout=timeout, json_serialize=codec.dumps,
+            trace_configs=[_network._trace()])
+        return _network.network_se
+
+    @staticmethod
+    async def close_session():
+        """close the session once its last user is done, returns whether
+        that happened"""
+        _network.users = max(0, _network.users - 1)
+        if _network.users:
+            return False
+        se = _network.network_se
+        _network.network_se = None
+        if se and not se.closed:
+            await se.close()
+        return True
+
+    @staticmethod
+    def stats():
+        m = _network.metrics
+        conns = m["connections_created"] + m["connections_reused"]
+        stats = dict(m)
+        stats["reuse_rate"] = m["connections_reused"] / conns if conns else 0.0
+        se = _network.network_se
+        if se and not se.closed:
+            connector = se.connector
+            stats["limit"] = connector.limit
+            stats["in_use"] = len(getattr(connector, "_acquired", ()))
+        return stats
 
 
 class _websocket:
@@ -27,7 +128,8 @@ class _websocket:
         self.buffer = None
 
     async def _connect(self, uri):
-        """create a websocket connection with simple error handlers"""
+        """run one websocket connection until it closes, returns the
+        ConnectionClosed that ended it, reconnecting is up to the caller"""
         self.inflator = decompressobj()
         self.buffer = bytearray()
         async with websockets.connect(
@@ -36,19 +138,24 @@ class _websocket:
             while True:
                 try:
                     recv = await self.socket.recv()
-                    asyncio.create_task(self.on_message(recv))
+                    # decoded here, in order, the zlib stream is stateful
+                    await self.on_message(recv)
                 except websockets.exceptions.ConnectionClosed as err:
-                    await self.err_code_handler(err, uri)
-                    break
-                except websockets.exceptions.ConnectionClosedOK:
-                    print("socket closed normally")
-                    break
+                    return err
                 except Exception as x:
                     print(x)
 
-    async def err_code_handler(self, err, uri):
-        """handle err code properly"""
-        pass
+    @staticmethod
+    def close_code(err):
+        """code of the side that closed first, None if the connection
+        dropped without a close frame"""
+        if err is None:
+            return None
+        if err.rcvd and (err.sent is None or err.rcvd_then_sent):
+            return err.rcvd.code
+        if err.sent:
+            return err.sent.code
+        return None
 
     async def disconnect(self):
         pass
@@ -57,10 +164,107 @@ class _websocket:
         pass
 
     async def decode(self, msg):
-        """Compress out of zlib and start correct op"""
-        self.buffer.extend(msg)
-        if len(msg) < 4 or msg[-4:] != ZLIB_SUFFIX:
+        """Inflate a zlib-stream frame, returns the payload once complete.
+
+        Frames are fed to the inflator as they arrive instead of collecting
+        the compressed bytes first, a message that fits in one frame (most
+        of them) is returned straight from decompress without any copy.
+        Split messages collect their inflated parts in self.buffer which is
+        handed over as is, json parsers take bytearrays directly.
+        """
+        if len(msg) > INFLATE_OFFLOAD_BYTES:
+            # frames are decoded one at a time, the stream state is safe
+            out = await executors.get().cpu.run(self.inflator.decompress, msg)
+        else:
+            out = self.inflator.decompress(msg)
+        if not msg.endswith(ZLIB_SUFFIX):
+            self.buffer += out
             return
-        msg = self.inflator.decompress(self.buffer)
-        self.buffer = bytearray()
-        return msg
+        if self.buffer:
+            self.buffer += out
+            out = self.buffer
+            self.buffer = bytearray()
+        return out
+
+
+def benchmark(events=5000, guild_members=20000, frame_kb=16):
+    """ peak traced memory and time to inflate and parse a recorded style
+        zlib-stream session (a big GUILD_CREATE split over frames, then
+        small events), the old collect-then-inflate decode vs decode()
+    """
+    import asyncio
+    import json
+    import time
+    import tracemalloc
+    from zlib import compressobj, Z_SYNC_FLUSH
+
+    guild = {"op": 0, "t": "GUILD_CREATE", "s": 1, "d": {"id": "1", "members": [
+        {"user": {"id": str(10**17 + i), "username": f"user{i}"},
+         "roles": [str(i % 50)], "joined_at": "2021-01-01T00:00:00+00:00"}
+        for i in range(guild_members)]}}
+    messages = [guild] + [{"op": 0, "t": "MESSAGE_CREATE", "s": i + 2, "d": {
+        "id": str(10**18 + i), "channel_id": "5", "guild_id": "1",
+        "content": f"message {i}", "author": {"id": "9", "username": "x"}}}
+        for i in range(events)]
+    # the gateway's compressor, every message ends with a sync flush
+    deflate = compressobj()
+    frames = []
+    size = frame_kb * 1024
+    for msg in messages:
+        data = deflate.compress(json.dumps(msg).encode()) + deflate.flush(Z_SYNC_FLUSH)
+        frames += [data[i:i + size] for i in range(0, len(data), size)]
+
+    class Old:
+        """decode as it was, compressed bytes collected then inflated"""
+
+        def __init__(self):
+            self.inflator = decompressobj()
+            self.buffer = bytearray()
+
+        async def decode(self, msg):
+            self.buffer.extend(msg)
+            if len(msg) < 4 or msg[-4:] != ZLIB_SUFFIX:
+                return
+            msg = self.inflator.decompress(self.buffer)
+            self.buffer = bytearray()
+            return msg
+
+    async def measure(ws):
+        ws.inflator = decompressobj()
+        ws.buffer = bytearray()
+        parsed = 0
+        # most of the overall peak is the parsed GUILD_CREATE, the
+        # decode peak is what inflating a frame takes above what's live
+        decode_peak = peak = 0
+        tracemalloc.start()
+        start = time.perf_counter()
+        for frame in frames:
+            before, last_peak = tracemalloc.get_traced_memory()
+            peak = max(peak, last_peak)
+            tracemalloc.reset_peak()
+            data = await ws.decode(frame)
+            decode_peak = max(decode_peak,
+                tracemalloc.get_traced_memory()[1] - before)
+            if data is not None:
+                codec.loads(data)
+                parsed += 1
+        took = time.perf_counter() - start
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        assert parsed == len(messages)
+        return {"peak_bytes": peak, "decode_peak_bytes": decode_peak,
+            "seconds": took}
+
+    async def main():
+        return {"frames": len(frames),
+            "compressed_bytes": sum(map(len, frames)),
+            "old": await measure(Old()), "new": await measure(_websocket())}
+
+    try:
+        return asyncio.run(main())
+    finally:
+        executors.get().cpu.shutdown()
+
+
+if __name__ == "__main__":
+    print(benchmark())
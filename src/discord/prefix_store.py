@@ -0,0 +1,131 @@
+"""
+    Per-guild prefixes kept in sqlite, read through a memory cache and
+    written behind in batches
+"""
+import asyncio
+import sqlite3
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from discord.cache import BoundedCache, PREFIXES_MAX
+
+# seconds changes wait before being written, more changes join the batch
+FLUSH_DELAY = 2.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS guild_prefix (
+    guild_id INTEGER PRIMARY KEY,
+    prefix TEXT NOT NULL
+)
+"""
+
+
+class PrefixStore:
+    """ cache holds every guild looked up so far, "" for guilds without
+        a prefix so they aren't looked up again. sqlite only ever runs on
+        the store's own thread, the event loop never touches the file
+    """
+
+    def __init__(self, path, max_entries=PREFIXES_MAX, flush_delay=FLUSH_DELAY):
+        self.path = path
+        self.flush_delay = flush_delay
+        self.cache = BoundedCache(max_entries)
+        # guild_id -> prefix, None deletes, waiting for the next flush
+        self.pending = {}
+        # guild_id -> future of a load in flight
+        self.loading = {}
+        self.flush_task = None
+        self.executor = None
+        self.db = None
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, func, *args)
+
+    def _open(self):
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(SCHEMA)
+        self.db.commit()
+
+    def _select(self, guild_id):
+        row = self.db.execute("SELECT prefix FROM guild_prefix WHERE guild_id = ?",
+            (int(guild_id),)).fetchone()
+        return row[0] if row else ""
+
+    def _write(self, changes):
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO guild_prefix (guild_id, prefix) VALUES (?, ?)",
+                [(int(g), p) for g, p in changes if p])
+            self.db.executemany("DELETE FROM guild_prefix WHERE guild_id = ?",
+                [(int(g),) for g, p in changes if not p])
+
+    async def open(self):
+        # one thread, sqlite connections stay on the thread that made them
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="prefixes")
+        await self._run(self._open)
+
+    async def close(self):
+        if self.flush_task:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush()
+        if self.db:
+            await self._run(self.db.close)
+            self.db = None
+        self.executor.shutdown(wait=False)
+
+    def get(self, guild_id):
+        """the cached prefix, "" if the guild has none, None if not loaded"""
+        if guild_id in self.pending:
+            return self.pending[guild_id] or ""
+        return self.cache.get(guild_id)
+
+    async def load(self, guild_id):
+        """read a guild's prefix from disk once, concurrent callers share it"""
+        prefix = self.get(guild_id)
+        if prefix is not None:
+            return prefix
+        fut = self.loading.get(guild_id)
+        if fut is None:
+            fut = asyncio.ensure_future(self._run(self._select, guild_id))
+            self.loading[guild_id] = fut
+            try:
+                prefix = await fut
+            finally:
+                del self.loading[guild_id]
+            # a set() while loading wins over what was on disk
+            if guild_id not in self.pending:
+                self.cache.set(guild_id, prefix)
+            return self.get(guild_id)
+        await fut
+        return self.get(guild_id)
+
+    def set(self, guild_id, prefix):
+        """takes effect now, reaches the disk on the next flush"""
+        self.cache.set(guild_id, prefix or "")
+        self.pending[guild_id] = prefix or None
+        if not self.flush_task:
+            self.flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_delay)
+        self.flush_task = None
+        try:
+            await self.flush()
+        except Exception:
+            traceback.print_exc()
+
+    async def flush(self):
+        if not self.pending or not self.db:
+            return
+        changes = list(self.pending.items())
+        self.pending = {}
+        try:
+            await self._run(self._write, changes)
+        except Exception:
+            # keep them for the next flush, newer changes win
+            for guild_id, prefix in changes:
+                self.pending.setdefault(guild_id, prefix)
+            raise
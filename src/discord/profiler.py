@@ -0,0 +1,237 @@
+"""
+    Opt-in profiling: per handler loop time, a loop stall watchdog and a
+    sampling profiler for the loop thread
+"""
+import asyncio
+import random
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from dataclasses import dataclass
+
+from discord import metrics
+
+LOOP_STALLS = metrics.registry.counter("loop_stalls_total",
+    "times the event loop was blocked longer than the stall threshold")
+HANDLER_BLOCKED = metrics.registry.histogram("handler_blocked_seconds",
+    "longest stretch a handler held the event loop without yielding",
+    ("handler",))
+
+
+@dataclass
+class ProfileConfig:
+    """plain values so it can be handed to shard processes"""
+    # time every handler call, sample_rate of calls when below 1
+    handlers: bool = False
+    sample_rate: float = 1.0
+    # dump the loop thread's stack when it's blocked longer than this
+    stall_ms: int = 0
+    # sample the loop thread's stack this often
+    stack_sample_ms: int = 0
+
+
+class _Stats:
+    __slots__ = ("calls", "wall", "busy", "longest")
+
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.0
+        self.busy = 0.0
+        self.longest = 0.0
+
+
+class _Timed:
+    """ Drives a coroutine step by step, every send() is a stretch the
+        coroutine runs on the loop without yielding, so summing them is the
+        time it held the loop and the longest one is the stall it caused
+    """
+
+    def __init__(self, coro):
+        self.coro = coro
+        self.busy = 0.0
+        self.longest = 0.0
+
+    def _step(self, func, arg):
+        start = time.perf_counter()
+        try:
+            return func(arg)
+        finally:
+            spent = time.perf_counter() - start
+            self.busy += spent
+            if spent > self.longest:
+                self.longest = spent
+
+    def __await__(self):
+        coro = self.coro
+        send, arg = coro.send, None
+        while True:
+            try:
+                fut = self._step(send, arg)
+            except StopIteration as e:
+                return e.value
+            try:
+                arg = yield fut
+                send = coro.send
+            except GeneratorExit:
+                coro.close()
+                raise
+            except BaseException as e:
+                send, arg = coro.throw, e
+
+
+class HandlerProfiler:
+
+    def __init__(self, sample_rate=1.0):
+        self.sample_rate = sample_rate
+        self.handlers = {}
+
+    def wrap(self, coro, name):
+        """coro unchanged when this call isn't sampled"""
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return coro
+        return self._run(coro, name)
+
+    async def _run(self, coro, name):
+        timed = _Timed(coro)
+        start = time.perf_counter()
+        try:
+            return await timed
+        finally:
+            st = self.handlers.get(name)
+            if st is None:
+                st = self.handlers[name] = _Stats()
+            st.calls += 1
+            st.wall += time.perf_counter() - start
+            st.busy += timed.busy
+            st.longest = max(st.longest, timed.longest)
+            HANDLER_BLOCKED.observe(timed.longest, name)
+
+    def stats(self, top=None):
+        """handlers by time spent holding the loop, most first"""
+        rows = [{"handler": name, "calls": st.calls,
+            "wall_avg": st.wall / st.calls, "busy_avg": st.busy / st.calls,
+            "busy_total": st.busy, "longest": st.longest}
+            for name, st in self.handlers.items()]
+        rows.sort(key=lambda r: r["busy_total"], reverse=True)
+        return rows[:top] if top else rows
+
+
+class LoopWatchdog:
+    """ A task bumps a timestamp every interval, a thread checks it. When
+        the loop hasn't run the task for threshold seconds the loop thread
+        is stuck in something, its stack is printed once per stall
+    """
+
+    def __init__(self, threshold, interval=None, out=sys.stderr):
+        self.threshold = threshold
+        self.interval = interval or threshold / 4
+        self.out = out
+        self.stalls = 0
+        self.longest = 0.0
+        self.last_tick = 0.0
+        self.task = None
+        self.thread = None
+        self.stopped = threading.Event()
+        self.loop_thread = None
+
+    async def _tick(self):
+        while True:
+            now = time.monotonic()
+            lag = now - self.last_tick
+            if lag > self.longest and self.last_tick:
+                self.longest = lag
+            self.last_tick = now
+            await asyncio.sleep(self.interval)
+
+    def _watch(self):
+        reported = None
+        while not self.stopped.wait(self.interval):
+            last = self.last_tick
+            if time.monotonic() - last < self.threshold + self.interval:
+                continue
+            if reported == last:
+                # same stall, already dumped
+                continue
+            reported = last
+            self.stalls += 1
+            LOOP_STALLS.inc()
+            frame = sys._current_frames().get(self.loop_thread)
+            stack = "".join(traceback.format_stack(frame)) if frame else ""
+            print(f"event loop blocked for over {self.threshold * 1000:.0f}ms:\n"
+                f"{stack}", file=self.out)
+
+    def start(self):
+        self.loop_thread = threading.get_ident()
+        self.last_tick = time.monotonic()
+        self.stopped.clear()
+        self.task = asyncio.create_task(self._tick())
+        self.thread = threading.Thread(target=self._watch, daemon=True,
+            name="loop-watchdog")
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    def stats(self):
+        return {"stalls": self.stalls, "longest_lag": self.longest}
+
+
+class StackSampler:
+    """ Samples the loop thread's stack every interval from another thread,
+        counts the innermost frame (self) and every frame on the stack
+        (cumulative). Cheap enough to leave on at a few ms
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.own = Counter()
+        self.cumulative = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = None
+        self.loop_thread = None
+
+    @staticmethod
+    def _where(frame):
+        code = frame.f_code
+        return f"{code.co_filename}:{frame.f_lineno} {code.co_name}"
+
+    def _sample(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is None:
+                continue
+            self.samples += 1
+            self.own[self._where(frame)] += 1
+            seen = set()
+            while frame is not None:
+                code = frame.f_code
+                key = f"{code.co_filename} {code.co_name}"
+                if key not in seen:
+                    seen.add(key)
+                    self.cumulative[key] += 1
+                frame = frame.f_back
+
+    def start(self):
+        self.loop_thread = threading.get_ident()
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._sample, daemon=True,
+            name="stack-sampler")
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def top(self, n=20, cumulative=False):
+        """(frame, share of samples) pairs, the idle loop shows up as the
+        selector's select call"""
+        counts = self.cumulative if cumulative else self.own
+        total = self.samples or 1
+        return [(where, count / total) for where, count in counts.most_common(n)]
@@ -0,0 +1,256 @@
+"""
+    Discord REST requests with rate limit buckets, a global limit and retries
+"""
+import asyncio
+import random
+import time
+from collections import deque
+
+from aiohttp import ClientError
+
+from discord.links import API_LINK
+from discord.network import _network
+from discord import codec
+from discord import metrics
+
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+# discord allows 50 requests a second per bot
+GLOBAL_LIMIT = 50
+GLOBAL_PERIOD = 1.0
+# path segments whose id is part of the bucket (major parameters)
+MAJOR_PARAMS = ("channels", "guilds", "webhooks", "interactions")
+# these are followed by an id and a token, one route per interaction
+TOKEN_PARAMS = ("webhooks", "interactions")
+
+
+def route_key(method, url):
+    """ METHOD + path with minor ids replaced, ids after a major parameter
+        (and webhook/interaction tokens) are kept since discord buckets them
+        separately, and one interaction's slow upload or retries must not
+        hold up the callbacks of others
+    """
+    path = url[len(API_LINK):] if url.startswith(API_LINK) else url
+    parts = path.split("?")[0].strip("/").split("/")
+    key = []
+    keep = 0
+    for i, part in enumerate(parts):
+        if keep:
+            key.append(part)
+            keep -= 1
+        elif part in MAJOR_PARAMS:
+            key.append(part)
+            keep = 2 if part in TOKEN_PARAMS else 1
+        elif part.isdigit():
+            key.append(":id")
+        else:
+            key.append(part)
+    return f"{method} {'/'.join(key)}"
+
+
+def metric_route(key):
+    """route key with every id and token replaced, keeps metric labels few"""
+    method, path = key.split(" ", 1)
+    parts = path.split("/")
+    for i, part in enumerate(parts):
+        if part.isdigit():
+            parts[i] = ":id"
+        elif i == 2 and parts[0] in TOKEN_PARAMS:
+            parts[i] = ":token"
+    return f"{method} {'/'.join(parts)}"
+
+
+class _Bucket:
+    __slots__ = ("remaining", "reset_at")
+
+    def __init__(self):
+        self.remaining = 1
+        self.reset_at = 0.0
+
+
+class RestClient:
+    """ Requests to the same route are queued behind each other and wait
+        for their bucket to reset when it's used up. 429s and 5xx/network
+        errors are retried, 5xx with jittered exponential backoff.
+    """
+
+    def __init__(self, max_retries=MAX_RETRIES):
+        self.max_retries = max_retries
+        # route key -> bucket hash discord told us
+        self.route_buckets = {}
+        self.buckets = {}
+        self.locks = {}
+        # requests queued or running per route key
+        self.users = {}
+        # finished interaction/webhook route key -> its bucket name, kept
+        # until the bucket resets so the limit still holds meanwhile
+        self.idle = {}
+        self.global_reset = 0.0
+        self.sent = deque(maxlen=GLOBAL_LIMIT)
+        self.retries = 0
+        self.ratelimited = 0
+
+    def _bucket(self, key):
+        name = self.route_buckets.get(key, key)
+        bucket = self.buckets.get(name)
+        if not bucket:
+            bucket = self.buckets[name] = _Bucket()
+        return bucket
+
+    def _update(self, key, headers):
+        bucket_hash = headers.get("X-RateLimit-Bucket")
+        if bucket_hash:
+            # keep the major parameter so channels don't share a bucket
+            path = key.split(" ", 1)[1].split("/")
+            major = path[:3] if path[0] in TOKEN_PARAMS else path[:2]
+            name = f"{bucket_hash}:{'/'.join(major)}"
+            if self.route_buckets.get(key) != name:
+                self.route_buckets[key] = name
+                # the placeholder used before discord named the bucket
+                self.buckets.pop(key, None)
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset_after = headers.get("X-RateLimit-Reset-After")
+        if remaining is None or reset_after is None:
+            return
+        bucket = self._bucket(key)
+        bucket.remaining = int(remaining)
+        bucket.reset_at = time.monotonic() + float(reset_after)
+
+    async def _wait_limits(self, key):
+        now = time.monotonic()
+        if self.global_reset > now:
+            await asyncio.sleep(self.global_reset - now)
+        if len(self.sent) == GLOBAL_LIMIT:
+            wait = self.sent[0] + GLOBAL_PERIOD - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+        bucket = self._bucket(key)
+        now = time.monotonic()
+        if bucket.remaining <= 0 and bucket.reset_at > now:
+            await asyncio.sleep(bucket.reset_at - now)
+        self.sent.append(time.monotonic())
+        if bucket.remaining > 0:
+            bucket.remaining -= 1
+
+    @staticmethod
+    def _backoff(attempt):
+        return min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt) * random.uniform(0.5, 1.5)
+
+    @staticmethod
+    async def _read(resp):
+        if resp.content_type == "application/json":
+            return codec.loads(await resp.read())
+        return await resp.text()
+
+    async def request(self, method, url, data=None, json=None, headers=None,
+        retry=True):
+        """ send a request, returns (status, body). data can be a callable
+            that builds a fresh body, FormData can only be sent once so
+            retries need that. retry=False sends it once whatever happens,
+            for bodies that can't be read twice (streams)
+        """
+        key = route_key(method, url)
+        start = time.perf_counter()
+        status = "error"
+        try:
+            status, result = await self._request(key, method, url, data,
+                json, headers, retry)
+            return status, result
+        finally:
+            route = metric_route(key)
+            metrics.REST_SECONDS.observe(time.perf_counter() - start, route)
+            metrics.REST_RESPONSES.inc(route, str(status))
+
+    async def _request(self, key, method, url, data, json, headers, retry):
+        lock = self.locks.get(key)
+        if not lock:
+            lock = self.locks[key] = asyncio.Lock()
+        self.users[key] = self.users.get(key, 0) + 1
+        try:
+            return await self._send(lock, key, method, url, data, json,
+                headers, retry)
+        finally:
+            self._done(key)
+
+    def _done(self, key):
+        """ forget a route nobody is using, there's one per interaction
+            so they would pile up otherwise
+        """
+        left = self.users[key] - 1
+        if left:
+            self.users[key] = left
+            return
+        del self.users[key]
+        del self.locks[key]
+        if key.split(" ", 1)[1].split("/", 1)[0] in TOKEN_PARAMS:
+            self.idle[key] = self.route_buckets.get(key, key)
+        self._prune()
+
+    def _prune(self):
+        """drop buckets of finished interactions once they've reset"""
+        now = time.monotonic()
+        in_use = None
+        for key, name in list(self.idle.items()):
+            if key in self.users:
+                # used again, _done puts it back
+                del self.idle[key]
+                continue
+            bucket = self.buckets.get(name)
+            if bucket is not None and bucket.reset_at > now:
+                continue
+            if in_use is None:
+                in_use = {self.route_buckets.get(k, k) for k in self.users}
+            del self.idle[key]
+            self.route_buckets.pop(key, None)
+            if name not in in_use:
+                self.buckets.pop(name, None)
+
+    async def _send(self, lock, key, method, url, data, json, headers, retry):
+        max_retries = self.max_retries if retry else 0
+        async with lock:
+            attempt = 0
+            while True:
+                await self._wait_limits(key)
+                body = data() if callable(data) else data
+                try:
+                    async with _network.network_se.request(
+                        method, url, data=body, json=json, headers=headers
+                    ) as resp:
+                        self._update(key, resp.headers)
+                        result = await self._read(resp)
+                        status = resp.status
+                except (ClientError, asyncio.TimeoutError):
+                    if attempt >= max_retries:
+                        raise
+                    status, result = None, None
+
+                if status == 429:
+                    self.ratelimited += 1
+                    retry_after = float(result.get("retry_after", 1)) \
+                        if isinstance(result, dict) else 1.0
+                    if isinstance(result, dict) and result.get("global"):
+                        self.global_reset = time.monotonic() + retry_after
+                    if attempt < max_retries:
+                        attempt += 1
+                        self.retries += 1
+                        await asyncio.sleep(retry_after)
+                        continue
+                elif (status is None or status >= 500) and attempt < max_retries:
+                    await asyncio.sleep(self._backoff(attempt))
+                    attempt += 1
+                    self.retries += 1
+                    continue
+                return status, result
+
+    def reset(self):
+        """drop queues tied to a finished event loop"""
+        self.locks = {}
+        self.users = {}
+
+    def stats(self):
+        return {"buckets": len(self.buckets), "retries": self.retries,
+            "ratelimited": self.ratelimited}
+
+
+rest = RestClient()
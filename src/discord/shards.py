@@ -0,0 +1,198 @@
+"""
+    Run gateway shards over several processes
+"""
+import asyncio
+import importlib
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from multiprocessing.connection import wait
+
+from discord.discord import GATE_WAY, backoff
+from discord.links import API_LINK
+from discord.network import _network
+from discord.rest import rest
+from discord import metrics
+
+# discord allows max_concurrency identifies per 5 seconds
+IDENTIFY_INTERVAL = 5.0
+# same api version and encoding as a single connection
+GATEWAY_QUERY = "?" + GATE_WAY.partition("?")[2]
+# exit code of a shard process that must not be restarted
+FATAL_EXIT = 3
+# a process that ran this long before dying restarts without backoff
+STABLE_SECONDS = 60
+
+
+def shard_for(guild_id, shard_count):
+    """the shard discord sends a guild's events to"""
+    return (int(guild_id) >> 22) % shard_count
+
+
+class IdentifyGate:
+    """ Shared between processes, shards with the same
+        shard_id % max_concurrency wait for each other before identifying
+    """
+
+    def __init__(self, ctx, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self.locks = [ctx.Lock() for _ in range(max_concurrency)]
+        self.last = ctx.Array('d', max_concurrency, lock=False)
+
+    def _wait(self, shard_id):
+        bucket = shard_id % self.max_concurrency
+        with self.locks[bucket]:
+            wait = self.last[bucket] + IDENTIFY_INTERVAL - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            self.last[bucket] = time.time()
+
+    async def __call__(self, shard_id):
+        # the lock blocks, keep it off the event loop
+        await asyncio.get_running_loop().run_in_executor(
+            None, self._wait, shard_id)
+
+
+async def _run_shards(bot_cls, shard_ids, shard_count, gateway, gate, bot_kwargs,
+    metrics_addr=None):
+    bots = []
+    for shard_id in shard_ids:
+        bot = bot_cls(shard=(shard_id, shard_count), **bot_kwargs)
+        bot.identify_gate = gate
+        bots.append(bot)
+    runner = await metrics.serve(*metrics_addr) if metrics_addr else None
+    try:
+        await asyncio.gather(*(bot.start(gateway) for bot in bots))
+    finally:
+        if runner:
+            await runner.cleanup()
+
+
+def _process_main(setup_module, shard_ids, shard_count, gateway, gate, bot_kwargs,
+    metrics_addr=None, process=(0, 1)):
+    # read by settings, the setup module sizes its limits and caches for
+    # its share of the machine
+    os.environ["SHARD_PROCESS_INDEX"] = str(process[0])
+    os.environ["SHARD_PROCESS_COUNT"] = str(process[1])
+    # commands/listeners register themselves when their module is imported
+    if setup_module:
+        importlib.import_module(setup_module)
+    from discord.discord import Bot, GatewayError
+    # a crash leaves pools, caches and job queues tied to the dead loop,
+    # the manager starts a fresh process instead of reusing them
+    try:
+        asyncio.run(_run_shards(Bot, shard_ids, shard_count, gateway,
+            gate, bot_kwargs, metrics_addr))
+    except KeyboardInterrupt:
+        return
+    except GatewayError:
+        # bad token/intents/shard, restarting won't help
+        traceback.print_exc()
+        sys.exit(FATAL_EXIT)
+
+
+class ShardManager:
+    """ Splits shards over processes, each process runs its shards on its
+        own event loop so event handling uses more than one core.
+
+        discord sends every guild's events to shard_for(guild_id), so
+        commands and the download jobs they start stay in the process that
+        owns the guild without any extra routing.
+    """
+
+    def __init__(self, token, intents, cmd_prefix="!", shard_count=None,
+        processes=None, setup_module=None, prefix_db=None, metrics_addr=None,
+        profiling=None):
+        self.token = token
+        # every shard opens prefix_db itself, sqlite handles the processes
+        self.bot_kwargs = {"token": token, "intents": intents,
+            "cmd_prefix": cmd_prefix, "prefix_db": prefix_db,
+            "profiling": profiling}
+        self.shard_count = shard_count
+        self.processes = processes or multiprocessing.cpu_count()
+        self.setup_module = setup_module
+        # (host, port), every process serves /metrics on port + its index
+        self.metrics_addr = metrics_addr
+        # process index -> running process
+        self.procs = {}
+        self.process_count = 0
+        self.restarts = 0
+
+    async def fetch_gateway(self):
+        """GET /gateway/bot for the url, shard count and identify limits"""
+        await _network.create_session()
+        try:
+            status, data = await rest.request('GET', f"{API_LINK}gateway/bot",
+                headers={"Authorization": f"Bot {self.token}"})
+        finally:
+            if await _network.close_session():
+                rest.reset()
+        if status != 200:
+            raise RuntimeError(f"gateway/bot failed: {status} {data}")
+        return data
+
+    def plan(self, shard_count):
+        """shard ids for every process, round-robin"""
+        procs = min(self.processes, shard_count)
+        return [list(range(i, shard_count, procs)) for i in range(procs)]
+
+    def _start(self, ctx, i, shard_ids, shard_count, gateway, gate):
+        addr = None
+        if self.metrics_addr:
+            addr = (self.metrics_addr[0], self.metrics_addr[1] + i)
+        proc = ctx.Process(target=_process_main, args=(
+            self.setup_module, shard_ids, shard_count, gateway, gate,
+            self.bot_kwargs, addr, (i, self.process_count)), daemon=True)
+        proc.start()
+        self.procs[i] = proc
+
+    def run(self):
+        """ start the shard processes and restart any that crash, with a
+            backoff while they keep crashing right away
+        """
+        info = asyncio.run(self.fetch_gateway())
+        shard_count = self.shard_count or info["shards"]
+        max_concurrency = info["session_start_limit"]["max_concurrency"]
+        gateway = info["url"] + GATEWAY_QUERY
+        ctx = multiprocessing.get_context("spawn")
+        gate = IdentifyGate(ctx, max_concurrency)
+        plan = dict(enumerate(self.plan(shard_count)))
+        self.process_count = len(plan)
+        started = {}
+        attempts = dict.fromkeys(plan, 0)
+        # process index -> time.monotonic() to start it again
+        restart_at = {}
+        for i, shard_ids in plan.items():
+            self._start(ctx, i, shard_ids, shard_count, gateway, gate)
+            started[i] = time.monotonic()
+        try:
+            while self.procs or restart_at:
+                now = time.monotonic()
+                for i, at in list(restart_at.items()):
+                    if at <= now:
+                        del restart_at[i]
+                        self.restarts += 1
+                        self._start(ctx, i, plan[i], shard_count, gateway, gate)
+                        started[i] = time.monotonic()
+                timeout = None
+                if restart_at:
+                    timeout = max(0, min(restart_at.values()) - time.monotonic())
+                sentinels = {p.sentinel: i for i, p in self.procs.items()}
+                for sentinel in wait(list(sentinels), timeout):
+                    i = sentinels[sentinel]
+                    proc = self.procs.pop(i)
+                    proc.join()
+                    if proc.exitcode in (0, FATAL_EXIT):
+                        continue
+                    if time.monotonic() - started[i] > STABLE_SECONDS:
+                        attempts[i] = 0
+                    delay = backoff(attempts[i])
+                    attempts[i] += 1
+                    print(f"shard process {i} exited with {proc.exitcode}, "
+                        f"restarting in {delay:.1f}s")
+                    restart_at[i] = time.monotonic() + delay
+        except KeyboardInterrupt:
+            for proc in self.procs.values():
+                proc.terminate()
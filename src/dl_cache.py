@@ -0,0 +1,223 @@
+"""
+ On disk cache for downloaded media, keyed by normalized url + format options
+"""
+import asyncio
+import hashlib
+import os
+import stat
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from discord import executors
+
+# query params that never change what gets downloaded
+TRACKING_PARAMS = ("utm_", "si", "feature", "fbclid", "igshid", "is_from_webapp",
+    "sender_device", "_r", "_t")
+
+
+def normalize_url(url):
+    """lower case scheme/host, drop fragments and tracking params"""
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    if host.startswith("m."):
+        host = host[2:]
+    query = [
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if not any(k == p or (p.endswith("_") and k.startswith(p))
+                   for p in TRACKING_PARAMS)
+    ]
+    query.sort()
+    path = parts.path.rstrip("/") or "/"
+    return urlunsplit((parts.scheme.lower(), host, path, urlencode(query), ""))
+
+
+def cache_key(url, options):
+    h = hashlib.sha256(normalize_url(url).encode())
+    for opt in options:
+        h.update(b"\x00")
+        h.update(str(opt).encode())
+    return h.hexdigest()
+
+
+class _Entry:
+    __slots__ = ("path", "size", "created", "pins")
+
+    def __init__(self, path, size, created):
+        self.path = path
+        self.size = size
+        self.created = created
+        self.pins = 0
+
+
+class DownloadCache:
+    """LRU + TTL bounded file cache.
+
+        Concurrent requests for the same key share a single producer run,
+        entries in use are pinned so eviction won't delete them mid upload.
+    """
+
+    def __init__(self, root, max_bytes=2 * 1024**3, ttl=6 * 60 * 60):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_saved = 0
+        os.makedirs(root, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """pick up files left from a previous run, oldest first"""
+        found = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            key = name.split(".", 1)[0]
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                # shard processes' caches live in subdirectories
+                continue
+            found.append((st.st_mtime, key, path, st.st_size))
+        for mtime, key, path, size in sorted(found):
+            self.entries[key] = _Entry(path, size, mtime)
+            self.size += size
+        self._evict()
+
+    def _expired(self, entry):
+        return self.ttl and time.time() - entry.created > self.ttl
+
+    def _drop(self, key, wait=False):
+        entry = self.entries.pop(key)
+        self.size -= entry.size
+        self.evictions += 1
+        if wait:
+            executors.unlink_quiet(entry.path)
+        else:
+            # deleting a big file can take a while, nobody waits for it
+            executors.get().io.fire(executors.unlink_quiet, entry.path)
+
+    def _evict(self):
+        for key in list(self.entries):
+            if self.size <= self.max_bytes:
+                break
+            if self.entries[key].pins == 0:
+                self._drop(key)
+
+    def get(self, key):
+        """path of a cached file or None"""
+        entry = self.entries.get(key)
+        if not entry:
+            return None
+        if self._expired(entry) and entry.pins == 0:
+            self._drop(key)
+            return None
+        if not os.path.exists(entry.path):
+            self.size -= entry.size
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry.path
+
+    def put(self, key, src, pin=False):
+        """ move a finished download into the cache, pin=True hands it back
+            pinned so the eviction it causes can't take the new file
+        """
+        if key in self.entries and self.entries[key].pins == 0:
+            # the new file may land on the same path, can't race it
+            self._drop(key, wait=True)
+            self.evictions -= 1
+        ext = os.path.splitext(src)[1]
+        path = os.path.join(self.root, key + ext)
+        os.replace(src, path)
+        size = os.path.getsize(path)
+        entry = self.entries[key] = _Entry(path, size, time.time())
+        if pin:
+            entry.pins += 1
+        self.size += size
+        self._evict()
+        return path
+
+    async def _produce(self, key, producer):
+        """the new entry, pinned for whoever started the producer"""
+        src = await producer()
+        if not src:
+            return None
+        self.put(key, src, pin=True)
+        return self.entries[key]
+
+    def _release(self, task):
+        """unpin what a producer made after its caller went away"""
+        if not task.cancelled() and not task.exception() and task.result():
+            task.result().pins -= 1
+            self._evict()
+
+    @asynccontextmanager
+    async def use(self, key, producer):
+        """yield a cached path for key, running producer() on a miss.
+
+            producer should return the path of a downloaded file (or None),
+            the file is moved into the cache. key None bypasses the cache,
+            the file is deleted once the block is done with it
+        """
+        if key is None:
+            path = await producer()
+            try:
+                yield path
+            finally:
+                if path:
+                    executors.get().io.fire(executors.unlink_quiet, path)
+            return
+
+        entry = None
+        if self.get(key):
+            self.hits += 1
+            entry = self.entries[key]
+            entry.pins += 1
+            self.bytes_saved += entry.size
+        else:
+            task = self.pending.get(key)
+            joined = task is not None
+            if joined:
+                # someone is already downloading this
+                self.hits += 1
+            else:
+                self.misses += 1
+                task = asyncio.ensure_future(self._produce(key, producer))
+                self.pending[key] = task
+                task.add_done_callback(lambda _: self.pending.pop(key, None))
+            try:
+                entry = await asyncio.shield(task)
+            except asyncio.CancelledError:
+                if not joined:
+                    task.add_done_callback(self._release)
+                raise
+            if entry and joined:
+                entry.pins += 1
+                self.bytes_saved += entry.size
+        try:
+            yield entry.path if entry else None
+        finally:
+            if entry:
+                entry.pins -= 1
+                self._evict()
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "bytes_saved": self.bytes_saved,
+            "pending": len(self.pending),
+        }
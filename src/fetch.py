@@ -0,0 +1,245 @@
+"""
+ Fetches user supplied media (attachments, urls) with size/type checks
+ before any bytes are downloaded
+"""
+import asyncio
+import ipaddress
+import os
+import random
+import socket
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from urllib.parse import urlsplit, urlunsplit
+
+from aiohttp import ClientError
+from yarl import URL
+
+from discord.network import _network
+from discord import executors
+from dl_cache import cache_key
+
+CHUNK_SIZE = 64 * 1024
+# signed cdn urls, the query changes for the same file
+CDN_HOSTS = ("cdn.discordapp.com", "media.discordapp.net")
+MEDIA_TYPES = ("video/", "audio/", "image/")
+# servers that don't know better send these for media files too
+GENERIC_TYPES = ("application/octet-stream", "binary/octet-stream")
+# playlists make ffmpeg open whatever urls they list
+PLAYLIST_TYPES = ("mpegurl", "x-scpls", "dash+xml")
+PLAYLIST_EXTS = (".m3u", ".m3u8", ".pls", ".mpd")
+MAX_REDIRECTS = 5
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+
+class FetchError(Exception):
+    pass
+
+
+@dataclass
+class RemoteInfo:
+    url: str
+    size: int = None
+    content_type: str = None
+    ranges: bool = False
+    # tell whether the content behind the url changed
+    etag: str = None
+    last_modified: str = None
+
+
+def stable_url(url):
+    """cdn attachment urls without their expiring signature"""
+    parts = urlsplit(url)
+    if parts.netloc.lower() in CDN_HOSTS:
+        return urlunsplit((parts.scheme, parts.netloc, parts.path, "", ""))
+    return url
+
+
+def validator(url, info: RemoteInfo):
+    """ what pins down the content behind url for caching, cdn attachments
+        never change, other urls need an ETag or Last-Modified. None when
+        nothing does and results must not be cached
+    """
+    if urlsplit(url).netloc.lower() in CDN_HOSTS:
+        return "cdn"
+    if info.etag:
+        return f"etag:{info.etag}"
+    if info.last_modified:
+        return f"modified:{info.last_modified}"
+    return None
+
+
+async def check_host(url):
+    """ FetchError unless url is http(s) and every address its host
+        resolves to is public, user urls must not reach the bot's own
+        network (loopback, private ranges, cloud metadata)
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise FetchError("only http(s) urls work")
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    try:
+        addrs = await asyncio.get_running_loop().getaddrinfo(
+            parts.hostname, port, type=socket.SOCK_STREAM)
+    except (socket.gaierror, UnicodeError):
+        raise FetchError("couldn't find that host")
+    for *_, sockaddr in addrs:
+        ip = ipaddress.ip_address(sockaddr[0].split("%", 1)[0])
+        if not ip.is_global or ip.is_multicast:
+            raise FetchError("that address isn't allowed")
+
+
+@asynccontextmanager
+async def _get(url, method="GET", headers=None):
+    """ a request that follows redirects itself so every hop's host is
+        checked, not only the one the user gave
+    """
+    se = _network.network_se
+    for _ in range(MAX_REDIRECTS + 1):
+        await check_host(url)
+        async with se.request(method, url, headers=headers,
+            allow_redirects=False) as resp:
+            location = resp.headers.get("Location")
+            if resp.status not in REDIRECT_STATUSES or not location:
+                yield resp
+                return
+            url = str(resp.url.join(URL(location)))
+    raise FetchError("too many redirects")
+
+
+def _info(resp, size, ranges):
+    return RemoteInfo(str(resp.url), size, resp.content_type, ranges,
+        resp.headers.get("ETag"), resp.headers.get("Last-Modified"))
+
+
+def _content_range_total(value):
+    """'bytes 0-0/1234' -> 1234, None if unknown"""
+    total = (value or "").rpartition("/")[2]
+    return int(total) if total.isdigit() else None
+
+
+async def inspect(url) -> RemoteInfo:
+    """ HEAD the url for its size and type, servers that refuse HEAD or
+        leave out the length get a one byte ranged GET instead, which
+        also tells whether ranges work
+    """
+    try:
+        async with _get(url, "HEAD") as resp:
+            if resp.status < 400 and resp.content_length is not None:
+                return _info(resp, resp.content_length,
+                    resp.headers.get("Accept-Ranges") == "bytes")
+    except (ClientError, asyncio.TimeoutError):
+        pass
+    try:
+        async with _get(url, headers={"Range": "bytes=0-0"}) as resp:
+            if resp.status >= 400:
+                raise FetchError(f"couldn't get that file ({resp.status})")
+            if resp.status == 206:
+                return _info(resp,
+                    _content_range_total(resp.headers.get("Content-Range")), True)
+            # the whole body is coming, leaving the block drops it
+            return _info(resp, resp.content_length, False)
+    except (ClientError, asyncio.TimeoutError) as e:
+        raise FetchError(f"couldn't reach that url ({e.__class__.__name__})")
+
+
+def check(info: RemoteInfo, max_bytes):
+    ctype = (info.content_type or "").lower()
+    ext = os.path.splitext(urlsplit(info.url).path)[1].lower()
+    if any(t in ctype for t in PLAYLIST_TYPES) or ext in PLAYLIST_EXTS:
+        raise FetchError("playlists aren't supported")
+    if ctype and not ctype.startswith(MEDIA_TYPES) and ctype not in GENERIC_TYPES:
+        raise FetchError(f"that's not a media file ({ctype})")
+    if info.size is not None and info.size > max_bytes:
+        raise FetchError(f"file is too large ({info.size // 1024**2}MB, "
+            f"max {max_bytes // 1024**2}MB)")
+
+
+async def download(url, dst, max_bytes, chunk_size=CHUNK_SIZE):
+    """ stream url to dst a chunk at a time, stops as soon as it goes over
+        max_bytes whatever Content-Length said
+    """
+    io = executors.get().io
+    size = 0
+    try:
+        async with _get(url) as resp:
+            if resp.status != 200:
+                raise FetchError(f"couldn't get that file ({resp.status})")
+            if resp.content_length and resp.content_length > max_bytes:
+                raise FetchError("file is too large")
+            f = await io.run(open, dst, "wb")
+            try:
+                async for chunk in resp.content.iter_chunked(chunk_size):
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise FetchError("file is too large")
+                    await io.run(f.write, chunk)
+            finally:
+                await io.run(f.close)
+    except (ClientError, asyncio.TimeoutError) as e:
+        io.fire(executors.unlink_quiet, dst)
+        raise FetchError(f"download failed ({e.__class__.__name__})")
+    except BaseException:
+        io.fire(executors.unlink_quiet, dst)
+        raise
+    return dst
+
+
+class MediaFetcher:
+    """ Checks an input and hands ffmpeg something to read.
+
+        Sources that take range requests are passed to ffmpeg as the url,
+        it seeks with ranges and nothing is written to disk. The rest is
+        downloaded into cache first, concurrent fetches of the same file
+        share one download. Attachments are always downloaded, the same
+        one tends to be edited a few times in a row.
+    """
+
+    def __init__(self, cache, max_bytes, direct=True):
+        self.cache = cache
+        self.max_bytes = max_bytes
+        self.direct = direct
+        self.streamed = 0
+        self.downloaded = 0
+        self.rejected = 0
+
+    async def inspect(self, url, info: RemoteInfo = None):
+        """ RemoteInfo for url once it passed the checks, FetchError if it
+            can't or shouldn't be used. info skips the HEAD when the size
+            and type are known already (attachments)
+        """
+        await check_host(url)
+        info = info or await inspect(url)
+        try:
+            check(info, self.max_bytes)
+        except FetchError:
+            self.rejected += 1
+            raise
+        return info
+
+    @asynccontextmanager
+    async def open(self, url, info: RemoteInfo = None):
+        """yield an ffmpeg input (url or path) for url, see inspect()"""
+        info = await self.inspect(url, info)
+        cdn = urlsplit(url).netloc.lower() in CDN_HOSTS
+        if self.direct and info.ranges and info.size and not cdn:
+            self.streamed += 1
+            yield info.url
+            return
+
+        async def fetch():
+            self.downloaded += 1
+            ext = os.path.splitext(urlsplit(info.url).path)[1][:8]
+            dst = f"/tmp/{random.randint(0, 30000000000000)}{ext}"
+            return await download(info.url, dst, self.max_bytes)
+
+        tag = validator(url, info)
+        # a file that may have changed is downloaded again
+        key = cache_key(stable_url(url), ["fetch", tag]) if tag else None
+        async with self.cache.use(key, fetch) as path:
+            if not path:
+                raise FetchError("couldn't get that file")
+            yield path
+
+    def stats(self):
+        return {"streamed": self.streamed, "downloaded": self.downloaded,
+            "rejected": self.rejected}
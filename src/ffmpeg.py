@@ -1,12 +1,349 @@
-from dataclasses import dataclass
+"""
+ ffprobe/ffmpeg helpers for shrinking media to fit upload limits
+"""
+import asyncio
+import json
+import os
+import random
+import shutil
+from collections import deque
+from dataclasses import dataclass, field
 from enum import Enum
 
+from settings import FFMPEG_LOCATION
+from jobs import JobScheduler
+
+# leave room for container overhead and bitrate overshoot
+SIZE_MARGIN = 0.92
+AUDIO_BITRATE = 96_000
+MIN_VIDEO_BITRATE = 100_000
+ERR_LINES = 8
+# what ffmpeg may open for a url input: no file:, no hls/concat pulling
+# in other urls
+URL_PROTOCOLS = "http,https,tcp,tls"
+
 
 class CodecType(Enum):
     VIDEO='video'
     AUDIO='audio'
 
 
+class FFmpegError(Exception):
+    pass
+
+
+class TranscodeMode(Enum):
+    TWO_PASS='two_pass'
+    CRF='crf'
+
+
+@dataclass
+class Stream:
+    codec_type: str
+    codec_name: str = None
+    width: int = None
+    height: int = None
+    bit_rate: int = None
+
+
 @dataclass
 class Video:
-    pass
\ No newline at end of file
+    path: str
+    duration: float = 0.0
+    size: int = 0
+    bit_rate: int = 0
+    streams: list[Stream] = field(default_factory=list)
+
+    def stream(self, codec_type: CodecType):
+        for s in self.streams:
+            if s.codec_type == codec_type.value:
+                return s
+
+
+def binary(name):
+    """ find ffmpeg/ffprobe from FFMPEG_LOCATION, which like yt-dlp's
+        --ffmpeg-location can be a directory or the ffmpeg binary
+    """
+    loc = FFMPEG_LOCATION
+    if not loc:
+        return name
+    if os.path.isdir(loc):
+        return os.path.join(loc, name)
+    return os.path.join(os.path.dirname(loc), name)
+
+
+def _lower_priority(nice):
+    def set_nice():
+        os.nice(nice)
+    return set_nice
+
+
+async def run_proc(*args, stdout=asyncio.subprocess.DEVNULL, nice=0):
+    """ run a process, stderr is read in chunks and only the last lines
+        are kept so long encodes don't pile up output in memory. ffmpeg
+        ends its progress lines with \r, a readline would never see them
+    """
+    preexec = None
+    if nice:
+        preexec = _lower_priority(nice)
+        ionice = shutil.which('ionice')
+        if ionice:
+            # idle io class, disk reads won't starve downloads
+            args = (ionice, '-c', '3', *args)
+    proc = await asyncio.create_subprocess_exec(
+        *args, stdout=stdout, stderr=asyncio.subprocess.PIPE,
+        preexec_fn=preexec)
+    tail = deque(maxlen=ERR_LINES)
+    out = bytearray()
+
+    async def read_out():
+        if proc.stdout:
+            while chunk := await proc.stdout.read(2**16):
+                out.extend(chunk)
+
+    async def read_err():
+        partial = b''
+        while chunk := await proc.stderr.read(2**16):
+            lines = (partial + chunk).replace(b'\r', b'\n').split(b'\n')
+            # the last piece may be cut off, kept for the next chunk
+            partial = lines.pop()[-2**16:]
+            for ln in lines:
+                if ln.strip():
+                    tail.append(ln.decode(errors='replace').rstrip())
+        if partial.strip():
+            tail.append(partial.decode(errors='replace').rstrip())
+
+    try:
+        await asyncio.gather(read_out(), read_err())
+        await proc.wait()
+    except BaseException as e:
+        # nothing reads the pipes anymore, don't leave the child running
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        if isinstance(e, Exception):
+            raise FFmpegError(f"reading {os.path.basename(args[0])} output "
+                f"failed: {e!r}") from e
+        raise
+    if proc.returncode:
+        raise FFmpegError('\n'.join(tail) or f"exit code {proc.returncode}")
+    return bytes(out)
+
+
+def input_args(src):
+    """options that go right before -i src, urls are kept to plain http(s)"""
+    if "://" in str(src):
+        return ['-protocol_whitelist', URL_PROTOCOLS]
+    return []
+
+
+def _int(v):
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return None
+
+
+async def probe(path) -> Video:
+    """read duration, size and streams with ffprobe"""
+    out = await run_proc(
+        binary('ffprobe'), '-v', 'error', '-print_format', 'json',
+        '-show_format', '-show_streams', *input_args(path), path,
+        stdout=asyncio.subprocess.PIPE)
+    info = json.loads(out)
+    fmt = info.get('format', {})
+    return Video(
+        path=path,
+        duration=float(fmt.get('duration') or 0),
+        # urls (streamed inputs) have no local file to fall back on
+        size=_int(fmt.get('size')) or (0 if "://" in str(path)
+            else os.path.getsize(path)),
+        bit_rate=_int(fmt.get('bit_rate')) or 0,
+        streams=[Stream(
+            codec_type=s.get('codec_type'),
+            codec_name=s.get('codec_name'),
+            width=_int(s.get('width')),
+            height=_int(s.get('height')),
+            bit_rate=_int(s.get('bit_rate')),
+        ) for s in info.get('streams', [])],
+    )
+
+
+def target_bitrates(video: Video, max_bytes: int):
+    """ split the bit budget for max_bytes between video and audio,
+        returns (video_bitrate, audio_bitrate)
+    """
+    if not video.duration:
+        raise FFmpegError("unknown duration, can't pick a bitrate")
+    total = int(max_bytes * 8 * SIZE_MARGIN / video.duration)
+    has_audio = video.stream(CodecType.AUDIO) is not None
+    if not video.stream(CodecType.VIDEO):
+        return None, total
+    audio = min(AUDIO_BITRATE, total // 4) if has_audio else None
+    v_rate = total - (audio or 0)
+    if v_rate < MIN_VIDEO_BITRATE:
+        raise FFmpegError("too long to fit in the upload limit")
+    return v_rate, audio
+
+
+def _scale_for(v_rate, stream: Stream):
+    """smaller frames look better than blocky ones at low bitrates"""
+    if not stream.height:
+        return []
+    if v_rate < 400_000:
+        height = 480
+    elif v_rate < 1_000_000:
+        height = 720
+    else:
+        return []
+    if stream.height <= height:
+        return []
+    return ['-vf', f'scale=-2:{height}']
+
+
+async def transcode(video: Video, dst, max_bytes,
+        mode: TranscodeMode=TranscodeMode.TWO_PASS, threads=0, nice=0):
+    """encode video into dst so it lands under max_bytes"""
+    v_rate, a_rate = target_bitrates(video, max_bytes)
+    run = lambda *args: run_proc(*args, nice=nice)
+    ffmpeg = binary('ffmpeg')
+    base = [ffmpeg, '-hide_banner', '-nostats', '-nostdin', '-y',
+        *input_args(video.path), '-i', video.path,
+        '-threads', str(threads)]
+    audio = ['-c:a', 'aac', '-b:a', str(a_rate)] if a_rate else ['-an']
+
+    if v_rate is None:
+        await run(*base, '-vn', *audio, dst)
+        return
+
+    v_opts = ['-c:v', 'libx264', '-preset', 'veryfast',
+        *_scale_for(v_rate, video.stream(CodecType.VIDEO))]
+    if mode == TranscodeMode.CRF:
+        await run(*base, *v_opts, '-crf', '26', '-maxrate', str(v_rate),
+            '-bufsize', str(v_rate * 2), *audio,
+            '-movflags', '+faststart', dst)
+        return
+
+    log = f"/tmp/ffpass{random.randint(0, 30000000000000)}"
+    try:
+        await run(*base, *v_opts, '-b:v', str(v_rate), '-pass', '1',
+            '-passlogfile', log, '-an', '-f', 'null', os.devnull)
+        await run(*base, *v_opts, '-b:v', str(v_rate), '-pass', '2',
+            '-passlogfile', log, *audio, '-movflags', '+faststart', dst)
+    finally:
+        for suffix in ('-0.log', '-0.log.mbtree'):
+            try:
+                os.unlink(log + suffix)
+            except FileNotFoundError:
+                pass
+
+
+async def fit_to_size(path, max_bytes, mode: TranscodeMode=TranscodeMode.TWO_PASS,
+        threads=0, nice=0):
+    """ return path unchanged if it fits, otherwise a transcoded copy
+        that does. the original is removed once the copy is done
+    """
+    if os.path.getsize(path) <= max_bytes:
+        return path
+    video = await probe(path)
+    dst = os.path.splitext(path)[0] + '.small.mp4'
+    try:
+        await transcode(video, dst, max_bytes, mode=mode, threads=threads,
+            nice=nice)
+        if os.path.getsize(dst) > max_bytes:
+            raise FFmpegError("still too large after transcoding")
+    except BaseException:
+        try:
+            os.unlink(dst)
+        except FileNotFoundError:
+            pass
+        raise
+    os.unlink(path)
+    return dst
+
+
+class WorkerFarm:
+    """ Limits how many ffmpeg jobs run at once.
+
+        Sized from the cpu count so workers * threads doesn't oversubscribe
+        cores, jobs get a -threads value and a lower cpu/io priority.
+        functions passed to submit must accept threads= and nice=
+    """
+
+    def __init__(self, workers=None, threads=None, nice=10, max_queued=64,
+        cpus=None):
+        # cpus this farm may use, shard processes split the machine
+        cpus = cpus or os.cpu_count() or 1
+        self.threads = threads or min(cpus, 2)
+        self.workers = workers or max(1, cpus // self.threads)
+        self.nice = nice
+        self.jobs = JobScheduler(max_jobs=self.workers,
+            max_guild_jobs=self.workers, max_queued=max_queued, name="ffmpeg")
+
+    async def _call(self, func, args, kwargs):
+        return await func(*args, threads=self.threads, nice=self.nice, **kwargs)
+
+    async def submit(self, func, *args, key=None, timeout=None, **kwargs):
+        """ run func in a free slot, key spreads slots fairly (guild id).
+            timeout counts the wait for a slot too, when it runs out the job
+            leaves the queue or its ffmpeg process is killed and TimeoutError
+            is raised
+        """
+        run = self.jobs.run(key, self._call, func, args, kwargs)
+        if timeout is None:
+            return await run
+        return await asyncio.wait_for(run, timeout)
+
+    def stats(self):
+        return {"workers": self.workers, "threads": self.threads,
+            **self.jobs.stats()}
+
+
+def benchmark(jobs=16, seconds=3):
+    """ wall time and per job latency of jobs encodes started all at once
+        (every one with ffmpeg's default threads) vs queued through a
+        WorkerFarm. without ffmpeg a cpu bound python loop stands in
+    """
+    import sys
+    import time
+
+    if shutil.which(binary('ffmpeg')):
+        def command(threads):
+            return [binary('ffmpeg'), '-hide_banner', '-nostats', '-nostdin',
+                '-f', 'lavfi', '-i', f'testsrc=duration={seconds}:size=1280x720:rate=30',
+                '-threads', str(threads), '-c:v', 'libx264', '-preset', 'veryfast',
+                '-f', 'null', os.devnull]
+        stand_in = False
+    else:
+        def command(threads):
+            # threads are ignored, a single core's worth of work
+            return [sys.executable, '-c', 'import time\n'
+                f'end = time.process_time() + {seconds / 4}\n'
+                'while time.process_time() < end: pass']
+        stand_in = True
+
+    async def encode(start, threads=0, nice=0):
+        await run_proc(*command(threads), nice=nice)
+        return time.perf_counter() - start
+
+    async def measure(farm):
+        start = time.perf_counter()
+        if farm:
+            runs = [farm.submit(encode, start) for _ in range(jobs)]
+        else:
+            runs = [encode(start) for _ in range(jobs)]
+        took = await asyncio.gather(*runs)
+        return {"seconds": time.perf_counter() - start,
+            "avg_latency": sum(took) / jobs, "first_done": min(took)}
+
+    async def main():
+        farm = WorkerFarm(max_queued=jobs)
+        return {"jobs": jobs, "stand_in": stand_in, "workers": farm.workers,
+            "threads": farm.threads, "unbounded": await measure(None),
+            "farm": await measure(farm)}
+
+    return asyncio.run(main())
+
+
+if __name__ == "__main__":
+    print(benchmark())
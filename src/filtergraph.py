@@ -0,0 +1,149 @@
+"""
+ Turns /edit options into a single ffmpeg -filter_complex run
+"""
+import os
+from dataclasses import dataclass
+
+import ffmpeg
+from ffmpeg import CodecType
+
+MIN_SPEED = 0.25
+MAX_SPEED = 4.0
+MIN_HEIGHT = 16
+MAX_HEIGHT = 2160
+# reverse/areverse keep every decoded frame of the clip in memory
+MAX_REVERSE_SECONDS = 60
+
+# name -> (extension, video args, audio args), None means drop the stream
+FORMATS = {
+    'mp4': ('mp4', ['-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p'],
+        ['-c:a', 'aac'], ),
+    'webm': ('webm', ['-c:v', 'libvpx-vp9', '-deadline', 'realtime', '-cpu-used', '8'],
+        ['-c:a', 'libopus']),
+    'gif': ('gif', [], None),
+    'mp3': ('mp3', None, ['-c:a', 'libmp3lame', '-q:a', '4']),
+}
+
+
+class EditError(Exception):
+    pass
+
+
+@dataclass
+class Edit:
+    start: float = None
+    end: float = None
+    scale: int = None
+    speed: float = 1.0
+    reverse: bool = False
+    format: str = 'mp4'
+
+    def validate(self):
+        if self.format not in FORMATS:
+            raise EditError(f"format must be one of {', '.join(FORMATS)}")
+        if self.start is not None and self.start < 0:
+            raise EditError("start can't be negative")
+        if self.end is not None and self.end <= (self.start or 0):
+            raise EditError("end has to be after start")
+        if not MIN_SPEED <= self.speed <= MAX_SPEED:
+            raise EditError(f"speed has to be between {MIN_SPEED} and {MAX_SPEED}")
+        if self.scale is not None and not MIN_HEIGHT <= self.scale <= MAX_HEIGHT:
+            raise EditError(f"scale has to be between {MIN_HEIGHT} and {MAX_HEIGHT}")
+        if self.reverse and self.end is not None:
+            self.check_reverse(self.end - (self.start or 0))
+        return self
+
+    def check_reverse(self, length):
+        """length is the clip in seconds, 0 when it isn't known"""
+        if not self.reverse:
+            return
+        if not 0 < length <= MAX_REVERSE_SECONDS:
+            raise EditError(f"reverse works on clips up to {MAX_REVERSE_SECONDS}"
+                " seconds, use start and end to cut it down")
+
+    @property
+    def ext(self):
+        return FORMATS[self.format][0]
+
+    def key(self):
+        """options that change the output, used for result caching"""
+        return [self.start, self.end, self.scale, self.speed, self.reverse,
+            self.format]
+
+
+def _atempo(speed):
+    """atempo only takes 0.5-2.0 so bigger changes are chained"""
+    parts = []
+    while speed > 2.0:
+        parts.append('atempo=2.0')
+        speed /= 2.0
+    while speed < 0.5:
+        parts.append('atempo=0.5')
+        speed /= 0.5
+    if speed != 1.0:
+        parts.append(f'atempo={speed:g}')
+    return parts
+
+
+def build(edit: Edit, video: ffmpeg.Video):
+    """ returns (input args, output args) for one ffmpeg invocation,
+        trimming is done with input seeking so it doesn't decode the
+        skipped part
+    """
+    ext, v_codec, a_codec = FORMATS[edit.format]
+    has_video = v_codec is not None and video.stream(CodecType.VIDEO)
+    has_audio = a_codec is not None and video.stream(CodecType.AUDIO)
+    if not has_video and not has_audio:
+        raise EditError("nothing to output in that format")
+
+    inp = []
+    if edit.start:
+        inp += ['-ss', f'{edit.start:g}']
+    if edit.end is not None:
+        inp += ['-t', f'{edit.end - (edit.start or 0):g}']
+
+    graph = []
+    out = []
+    if has_video:
+        v = []
+        if edit.reverse:
+            v.append('reverse')
+        if edit.speed != 1.0:
+            v.append(f'setpts=PTS/{edit.speed:g}')
+        if edit.scale:
+            v.append(f'scale=-2:{edit.scale}')
+        if edit.format == 'gif':
+            v.append('split[g1][g2];[g1]palettegen[p];[g2][p]paletteuse')
+        graph.append(f"[0:v]{','.join(v) or 'null'}[v]")
+        out += ['-map', '[v]', *v_codec]
+    if has_audio:
+        a = []
+        if edit.reverse:
+            a.append('areverse')
+        a += _atempo(edit.speed)
+        graph.append(f"[0:a]{','.join(a) or 'anull'}[a]")
+        out += ['-map', '[a]', *a_codec]
+    if ext == 'mp4':
+        out += ['-movflags', '+faststart']
+    return inp, ['-filter_complex', ';'.join(graph), *out]
+
+
+async def render(src, dst, edit: Edit, threads=0, nice=0):
+    """probe src and run the whole edit as one decode/encode pass"""
+    video = await ffmpeg.probe(src)
+    if edit.reverse:
+        # end is checked already, the probe tells when it's left out or
+        # past the end of the file
+        ends = [t for t in (edit.end, video.duration) if t]
+        edit.check_reverse(min(ends) - (edit.start or 0) if ends else 0)
+    inp, out = build(edit, video)
+    try:
+        await ffmpeg.run_proc(
+            ffmpeg.binary('ffmpeg'), '-hide_banner', '-nostats', '-nostdin',
+            '-y', *inp, *ffmpeg.input_args(src), '-i', src,
+            '-threads', str(threads), *out, dst, nice=nice)
+    except BaseException:
+        if os.path.exists(dst):
+            os.unlink(dst)
+        raise
+    return dst
@@ -0,0 +1,105 @@
+"""
+ Single frame extraction with input side seeking and an in memory LRU
+"""
+import asyncio
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+import ffmpeg
+
+
+class FrameCache:
+    """LRU of encoded frames keyed by (source, timestamp, height), bounded by bytes"""
+
+    def __init__(self, max_bytes=64 * 1024**2):
+        self.max_bytes = max_bytes
+        self.frames = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        pic = self.frames.get(key)
+        if pic is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.frames.move_to_end(key)
+        return pic
+
+    def put(self, key, pic):
+        old = self.frames.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.frames[key] = pic
+        self.size += len(pic)
+        while self.size > self.max_bytes and len(self.frames) > 1:
+            _, dropped = self.frames.popitem(last=False)
+            self.size -= len(dropped)
+
+    def stats(self):
+        return {"frames": len(self.frames), "bytes": self.size,
+            "hits": self.hits, "misses": self.misses}
+
+
+cache = FrameCache()
+
+
+def _input(src, ts):
+    """ -ss before -i seeks to the nearest keyframe without decoding up to
+        it, for http inputs ffmpeg does the seek with a range request
+    """
+    return ['-ss', f'{ts:g}', *ffmpeg.input_args(src), '-i', src]
+
+
+def _scale(height):
+    return ['-vf', f'scale=-2:{height}'] if height else []
+
+
+async def grab(src, ts: float, height=None, threads=0, nice=0):
+    """jpeg bytes of the frame at ts seconds"""
+    pic = cache.get((src, ts, height))
+    if pic is not None:
+        return pic
+    pic = await ffmpeg.run_proc(
+        ffmpeg.binary('ffmpeg'), '-hide_banner', '-nostats', '-nostdin',
+        *_input(src, ts), '-threads', str(threads), '-frames:v', '1',
+        *_scale(height), '-f', 'image2pipe', '-c:v', 'mjpeg', 'pipe:1',
+        stdout=asyncio.subprocess.PIPE, nice=nice)
+    if not pic:
+        raise ffmpeg.FFmpegError(f"no frame at {ts:g}s")
+    cache.put((src, ts, height), pic)
+    return pic
+
+
+async def grab_many(src, timestamps, height=None, threads=0, nice=0):
+    """ jpeg bytes for every timestamp, frames not cached are pulled by one
+        ffmpeg process with an input per timestamp
+    """
+    pics = {}
+    missing = []
+    for ts in dict.fromkeys(timestamps):
+        pics[ts] = cache.get((src, ts, height))
+        if pics[ts] is None:
+            missing.append(ts)
+    if missing:
+        tmp = tempfile.mkdtemp(prefix='frames')
+        try:
+            args = []
+            for ts in missing:
+                args += _input(src, ts)
+            args += ['-threads', str(threads)]
+            for i in range(len(missing)):
+                args += ['-map', f'{i}:v:0', '-frames:v', '1',
+                    *_scale(height), os.path.join(tmp, f'{i}.jpg')]
+            await ffmpeg.run_proc(ffmpeg.binary('ffmpeg'), '-hide_banner',
+                '-nostats', '-nostdin', '-y', *args, nice=nice)
+            for i, ts in enumerate(missing):
+                with open(os.path.join(tmp, f'{i}.jpg'), 'rb') as f:
+                    pics[ts] = f.read()
+                cache.put((src, ts, height), pics[ts])
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+    return [pics[ts] for ts in timestamps]
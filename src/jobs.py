@@ -0,0 +1,146 @@
+"""
+ Bounded job scheduler shared fairly between guilds
+"""
+import asyncio
+import time
+from collections import OrderedDict, deque
+
+from discord import metrics
+
+
+class SchedulerFull(Exception):
+    """raised when a job can't be queued because of backpressure"""
+    pass
+
+
+class JobScheduler:
+    """Runs coroutines with a global and a per guild concurrency limit.
+
+        Waiting jobs are kept in one queue per guild, free slots are handed
+        out round-robin between guilds so one busy guild can't starve others.
+    """
+
+    def __init__(self, max_jobs=4, max_guild_jobs=2, max_queued=32, name="jobs"):
+        # metrics label
+        self.name = name
+        self.max_jobs = max_jobs
+        self.max_guild_jobs = max_guild_jobs
+        self.max_queued = max_queued
+        self.running = 0
+        self.guild_running = {}
+        # guild_id -> deque of (future, enqueue time)
+        self.queues = OrderedDict()
+        self.queued = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.waited = 0
+        metrics.JOB_QUEUED.track(lambda: self.queued, name)
+        metrics.JOB_RUNNING.track(lambda: self.running, name)
+
+    def _can_run(self, guild_id):
+        return self.running < self.max_jobs and \
+            self.guild_running.get(guild_id, 0) < self.max_guild_jobs
+
+    def _take_slot(self, guild_id, queued_at):
+        self.running += 1
+        self.guild_running[guild_id] = self.guild_running.get(guild_id, 0) + 1
+        waited = time.monotonic() - queued_at
+        self.waited += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        metrics.JOB_WAIT_SECONDS.observe(waited, self.name)
+
+    def _release(self, guild_id, finished=True):
+        self.running -= 1
+        left = self.guild_running[guild_id] - 1
+        if left:
+            self.guild_running[guild_id] = left
+        else:
+            del self.guild_running[guild_id]
+        if finished:
+            self.completed += 1
+        self._wake()
+
+    def _wake(self):
+        """hand free slots to waiting guilds in round-robin order"""
+        served = True
+        while served and self.running < self.max_jobs:
+            served = False
+            for guild_id in list(self.queues):
+                if self.running >= self.max_jobs:
+                    return
+                if not self._can_run(guild_id):
+                    continue
+                q = self.queues[guild_id]
+                fut, queued_at = q.popleft()
+                self.queued -= 1
+                # a cancelled waiter is only dropped, the next one gets a go
+                if not fut.done():
+                    self._take_slot(guild_id, queued_at)
+                    fut.set_result(None)
+                served = True
+                if q:
+                    # served guild goes to the back of the line
+                    self.queues.move_to_end(guild_id)
+                else:
+                    del self.queues[guild_id]
+
+    async def _acquire(self, guild_id):
+        now = time.monotonic()
+        if not self.queues and self._can_run(guild_id):
+            self._take_slot(guild_id, now)
+            return
+        if self.queued >= self.max_queued:
+            self.rejected += 1
+            raise SchedulerFull(f"{self.queued} jobs already waiting")
+        fut = asyncio.get_running_loop().create_future()
+        entry = (fut, now)
+        self.queues.setdefault(guild_id, deque()).append(entry)
+        self.queued += 1
+        # a slot may be free for this guild even if others are waiting
+        self._wake()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if not fut.cancelled():
+                # got a slot right as we were cancelled, give it back
+                self._release(guild_id, finished=False)
+            else:
+                # _wake may have dropped it already
+                q = self.queues.get(guild_id)
+                if q is not None and entry in q:
+                    q.remove(entry)
+                    self.queued -= 1
+                    if not q:
+                        del self.queues[guild_id]
+            raise
+
+    async def run(self, guild_id, func, *args, **kwargs):
+        """wait for a slot then await func(*args, **kwargs)"""
+        await self._acquire(guild_id)
+        start = time.monotonic()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            self._release(guild_id)
+            metrics.JOB_SECONDS.observe(time.monotonic() - start, self.name)
+
+    def depth(self, guild_id=None):
+        """number of waiting jobs, for one guild or overall"""
+        if guild_id is None:
+            return self.queued
+        q = self.queues.get(guild_id)
+        return len(q) if q else 0
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "queued": self.queued,
+            "guilds_waiting": len(self.queues),
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "wait_avg": self.wait_total / self.waited if self.waited else 0.0,
+            "wait_max": self.wait_max,
+        }
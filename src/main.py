@@ -1,22 +1,46 @@
 import asyncio
 import discord.discord as discord
+from discord.shards import ShardManager
+from discord import metrics
+from discord.profiler import ProfileConfig
 import settings
 import cmds 
 
 intents = discord.intents(
+    # GUILD_CREATE/GUILD_DELETE, the guild cache is trimmed on leave
+    GUILDS=True,
     GUILD_MESSAGES=True,
     GUILD_VOICE_STATES=True,
     DIRECT_MESSAGES=True,
     GUILD_MESSAGE_REACTIONS=True,
 )
 TOKEN = settings.BOT_KEY
-bot = discord.Bot(cmd_prefix=".", token=TOKEN, intents=intents)
+profiling = ProfileConfig(handlers=settings.PROFILE_HANDLERS,
+    sample_rate=settings.PROFILE_SAMPLE_RATE, stall_ms=settings.STALL_MS,
+    stack_sample_ms=settings.STACK_SAMPLE_MS)
+bot = discord.Bot(cmd_prefix=".", token=TOKEN, intents=intents,
+    prefix_db=settings.PREFIX_DB or None, profiling=profiling)
 
 
 async def main():
-    await bot.start()
+    runner = None
+    if settings.METRICS_PORT:
+        runner = await metrics.serve(settings.METRICS_HOST, settings.METRICS_PORT)
+    try:
+        await bot.start()
+    finally:
+        if runner:
+            await runner.cleanup()
 
 
 if __name__ == "__main__":
-    while True:
+    if settings.SHARD_PROCESSES:
+        ShardManager(TOKEN, intents, cmd_prefix=".",
+            shard_count=settings.SHARD_COUNT or None,
+            processes=settings.SHARD_PROCESSES, setup_module="cmds",
+            prefix_db=settings.PREFIX_DB or None, profiling=profiling,
+            metrics_addr=(settings.METRICS_HOST, settings.METRICS_PORT)
+                if settings.METRICS_PORT else None).run()
+    else:
+        # the bot reconnects by itself, it only returns on fatal close codes
         asyncio.run(main())
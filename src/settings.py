@@ -9,3 +9,67 @@ BOT_KEY = os.getenv("BOT_KEY")
 FFMPEG_LOCATION = os.getenv("FFMPEG_LOCATION")
 YT_DL_LOCATION = os.getenv("YT_DL_LOCATION")
 COOKIES = os.getenv("COOKIES_LOCATION")
+
+# set by discord.shards for shard processes, every process builds its own
+# job limits and caches, limits marked per machine are split between them
+PROCESS_INDEX = int(os.getenv("SHARD_PROCESS_INDEX", 0))
+PROCESS_COUNT = int(os.getenv("SHARD_PROCESS_COUNT", 1))
+
+
+def per_process(total):
+    """this process' share of a per machine limit"""
+    return max(1, total // PROCESS_COUNT)
+
+
+def process_dir(path):
+    """a directory of its own per shard process, caches don't share an index"""
+    if PROCESS_COUNT > 1:
+        return os.path.join(path, f"p{PROCESS_INDEX}")
+    return path
+
+# yt-dlp job limits, jobs and queue per machine, guild jobs per guild
+YT_DL_MAX_JOBS = int(os.getenv("YT_DL_MAX_JOBS", 4))
+YT_DL_MAX_GUILD_JOBS = int(os.getenv("YT_DL_MAX_GUILD_JOBS", 2))
+YT_DL_MAX_QUEUED = int(os.getenv("YT_DL_MAX_QUEUED", 32))
+
+# download cache, size per machine, each shard process gets a subdirectory
+DL_CACHE_DIR = os.getenv("DL_CACHE_DIR", "/tmp/myau-cache")
+DL_CACHE_MAX_BYTES = int(os.getenv("DL_CACHE_MAX_BYTES", 2 * 1024**3))
+DL_CACHE_TTL = int(os.getenv("DL_CACHE_TTL", 6 * 60 * 60))
+
+# largest file discord accepts from the bot
+UPLOAD_LIMIT = int(os.getenv("UPLOAD_LIMIT", 25 * 1024**2))
+
+# ffmpeg worker farm per machine, 0 sizes from the cpu count
+FFMPEG_WORKERS = int(os.getenv("FFMPEG_WORKERS", 0))
+FFMPEG_THREADS = int(os.getenv("FFMPEG_THREADS", 0))
+FFMPEG_NICE = int(os.getenv("FFMPEG_NICE", 10))
+
+# largest input /edit downloads or streams
+FETCH_MAX_BYTES = int(os.getenv("FETCH_MAX_BYTES", 200 * 1024**2))
+
+# /edit result cache, like the download cache
+EDIT_CACHE_DIR = os.getenv("EDIT_CACHE_DIR", "/tmp/myau-edits")
+EDIT_CACHE_MAX_BYTES = int(os.getenv("EDIT_CACHE_MAX_BYTES", 1024**3))
+
+# sharding, 0 processes runs a single unsharded connection
+SHARD_PROCESSES = int(os.getenv("SHARD_PROCESSES", 0))
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", 0))
+
+# per-guild prefixes, empty keeps them in memory only
+PREFIX_DB = os.getenv("PREFIX_DB", "prefixes.db")
+
+# local /metrics endpoint, 0 turns it off. shard processes use port + index
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+
+# profiling, all off by default. PROFILE_SAMPLE_RATE < 1 times only some calls
+PROFILE_HANDLERS = os.getenv("PROFILE_HANDLERS", "") not in ("", "0")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 1.0))
+STALL_MS = int(os.getenv("STALL_MS", 0))
+STACK_SAMPLE_MS = int(os.getenv("STACK_SAMPLE_MS", 0))
+
+# thread pools for blocking work, 0 sizes from the cpu count
+EXECUTOR_CPU_WORKERS = int(os.getenv("EXECUTOR_CPU_WORKERS", 0))
+EXECUTOR_IO_WORKERS = int(os.getenv("EXECUTOR_IO_WORKERS", 0))
+EXECUTOR_MAX_QUEUED = int(os.getenv("EXECUTOR_MAX_QUEUED", 256))
@@ -0,0 +1,135 @@
+"""
+ Incremental parser for yt-dlp output
+"""
+import asyncio
+import re
+from dataclasses import dataclass
+from enum import Enum
+
+PROGRESS_RE = re.compile(r"^\[download\]\s+([\d.]+)%")
+ITEM_RE = re.compile(r"^\[download\] Downloading (?:item|video) (\d+) of (\d+)")
+ALREADY_RE = re.compile(r"^\[download\] (.+) has already been downloaded")
+
+
+class EventType(Enum):
+    DESTINATION='destination'
+    MERGER='merger'
+    PROGRESS='progress'
+    ITEM='item'
+    FINISHED='finished'
+    ABORT='abort'
+    ERROR='error'
+
+
+@dataclass
+class Event:
+    type: EventType
+    path: str = None
+    percent: float = None
+    index: int = None
+    total: int = None
+    line: str = None
+
+
+class YtDlParser:
+    """ Turns yt-dlp lines into events.
+
+        yt-dlp downloads playlist entries one after the other, so the output
+        of an entry is complete once the next entry starts or the process
+        exits. FINISHED is emitted with the final path (merged file if any).
+    """
+
+    def __init__(self):
+        self.current = None
+
+    def _finish(self):
+        if not self.current:
+            return []
+        ev = Event(EventType.FINISHED, path=self.current)
+        self.current = None
+        return [ev]
+
+    def feed(self, ln):
+        """parse one stdout line, returns a list of events"""
+        ln = ln.rstrip()
+        if not ln:
+            return []
+        if ln.find('Aborting') > -1:
+            return [Event(EventType.ABORT, line=ln)]
+        if ln.startswith('[download]'):
+            if ln[11:23] == 'Destination:':
+                self.current = ln[24:]
+                return [Event(EventType.DESTINATION, path=self.current)]
+            m = PROGRESS_RE.match(ln)
+            if m:
+                return [Event(EventType.PROGRESS, percent=float(m.group(1)),
+                    line=ln)]
+            m = ITEM_RE.match(ln)
+            if m:
+                return self._finish() + [Event(EventType.ITEM,
+                    index=int(m.group(1)), total=int(m.group(2)))]
+            m = ALREADY_RE.match(ln)
+            if m:
+                self.current = m.group(1)
+                return [Event(EventType.DESTINATION, path=self.current)]
+        elif ln.startswith('[Merger]'):
+            self.current = ln.split(' into ', 1)[-1].strip('"')
+            return [Event(EventType.MERGER, path=self.current)]
+        return []
+
+    def feed_err(self, ln):
+        """parse one stderr line"""
+        ln = ln.rstrip()
+        if not ln:
+            return []
+        if ln.find('Aborting') > -1:
+            return [Event(EventType.ABORT, line=ln)]
+        return [Event(EventType.ERROR, line=ln)]
+
+    def close(self):
+        """process exited, flush the last entry"""
+        return self._finish()
+
+
+async def _pump(stream, feed, queue):
+    while True:
+        ln = await stream.readline()
+        if not ln:
+            break
+        # progress updates can be separated by \r instead of \n
+        for part in ln.decode(errors='replace').split('\r'):
+            for ev in feed(part):
+                await queue.put(ev)
+
+
+async def events(proc, parser=None):
+    """ async iterator of events from a running yt-dlp process, stdout
+        and stderr are read as lines arrive so neither is buffered whole
+    """
+    parser = parser or YtDlParser()
+    queue = asyncio.Queue()
+    pumps = [
+        asyncio.ensure_future(_pump(proc.stdout, parser.feed, queue)),
+        asyncio.ensure_future(_pump(proc.stderr, parser.feed_err, queue)),
+    ]
+    try:
+        while True:
+            running = [p for p in pumps if not p.done()]
+            if not running and queue.empty():
+                break
+            getter = asyncio.ensure_future(queue.get())
+            await asyncio.wait([getter, *running],
+                return_when=asyncio.FIRST_COMPLETED)
+            if getter.done():
+                yield getter.result()
+            else:
+                getter.cancel()
+        for p in pumps:
+            p.result()
+        await proc.wait()
+        for ev in parser.close():
+            yield ev
+    finally:
+        # stops reading when the caller is done early
+        for p in pumps:
+            p.cancel()
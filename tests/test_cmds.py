@@ -0,0 +1,42 @@
+import asyncio
+
+import cmds
+
+
+class FakeContext:
+    guild_id = "1"
+
+    def __init__(self, options):
+        self.options = options
+        self.content = None
+        self.deferred = False
+        self.responses = []
+
+    def get_option(self, name):
+        if name in self.options:
+            return {"name": name, "value": self.options[name]}
+
+    def add_content(self, content):
+        self.content = content
+
+    async def defer_msg_with_src(self):
+        self.deferred = True
+
+    async def progress(self, content, force=False):
+        return True
+
+    def time_left(self):
+        return 15 * 60
+
+    async def respond(self, file=None, filename=None):
+        self.responses.append(self.content)
+
+
+def test_edit_answers_after_unexpected_errors(monkeypatch):
+    async def inspect(url, info=None):
+        raise FileNotFoundError(url)
+
+    monkeypatch.setattr(cmds.fetcher, "inspect", inspect)
+    ctx = FakeContext({"url": "https://example.com/a.mp4"})
+    asyncio.run(cmds._edit_files(ctx))
+    assert ctx.deferred and ctx.responses == ["edit failed :("]
@@ -0,0 +1,141 @@
+import asyncio
+import re
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from discord import codec
+from discord import contexts
+from discord import rest as rest_module
+from discord.contexts import InteractionContext
+from discord.interaction_enums import InteractionCallbackType
+from discord.network import _network
+from discord.rest import rest
+
+INTERACTION = {"d": {"id": "111", "token": "tok", "application_id": "222",
+    "type": 2, "guild_id": "5", "data": {"name": "edit", "options": []},
+    "member": {"user": {"id": "9"}}}}
+
+
+def parse_form(body, content_type):
+    """ name -> bytes, by hand since the parts say multipart/formdata and
+        aiohttp's reader takes them for nested multiparts
+    """
+    boundary = re.search(r'boundary="?([^";]+)', content_type).group(1)
+    fields = {}
+    for part in body.split(b"--" + boundary.encode())[1:-1]:
+        head, _, value = part.strip(b"\r\n").partition(b"\r\n\r\n")
+        name = re.search(rb'name="([^"]+)"', head).group(1).decode()
+        fields[name] = value
+    return fields
+
+
+class FakeDiscord:
+    """records (method, path, payload) of every request"""
+
+    def __init__(self, status=200):
+        self.status = status
+        self.calls = []
+        self.app = web.Application()
+        self.app.router.add_route("*", "/{path:.*}", self.handle)
+
+    async def handle(self, request):
+        if request.content_type == "application/json":
+            payload = await request.json()
+        else:
+            form = parse_form(await request.read(),
+                request.headers["Content-Type"])
+            payload = codec.loads(form["payload_json"])
+            if "file" in form:
+                payload["file"] = form["file"]
+        self.calls.append((request.method, request.path, payload))
+        return web.json_response({}, status=self.status)
+
+
+def run_against(monkeypatch, interact, status=200):
+    fake = FakeDiscord(status)
+
+    async def main():
+        async with TestServer(fake.app) as server:
+            link = str(server.make_url("/"))
+            monkeypatch.setattr(contexts, "API_LINK", link)
+            monkeypatch.setattr(rest_module, "API_LINK", link)
+            await _network.create_session()
+            try:
+                await interact(InteractionContext(None, INTERACTION))
+            finally:
+                await _network.close_session()
+                rest.reset()
+
+    asyncio.run(main())
+    return fake.calls
+
+
+def test_respond_without_defer_answers_the_callback(monkeypatch):
+    async def interact(ctx):
+        ctx.add_content("hi")
+        await ctx.respond()
+
+    calls = run_against(monkeypatch, interact)
+    assert calls == [("POST", "/interactions/111/tok/callback", {
+        "type": InteractionCallbackType.CHANNEL_MESSAGE_WITH_SOURCE.value,
+        "data": {"content": "hi"}})]
+
+
+def test_defer_then_respond_edits_original(monkeypatch):
+    async def interact(ctx):
+        await ctx.defer_msg_with_src()
+        ctx.add_content("done")
+        await ctx.respond(file=b"data", filename="out.mp4")
+        await ctx.followup(data={"content": "more"})
+
+    calls = run_against(monkeypatch, interact)
+    assert [(m, p) for m, p, _ in calls] == [
+        ("POST", "/interactions/111/tok/callback"),
+        ("PATCH", "/webhooks/222/tok/messages/@original"),
+        ("POST", "/webhooks/222/tok"),
+    ]
+    assert calls[0][2] == {"type":
+        InteractionCallbackType.DEFERRED_CHANNEL_MESSAGE_WITH_SOURCE.value}
+    assert calls[1][2] == {"content": "done", "file": b"data"}
+    assert calls[2][2] == {"content": "more"}
+
+
+def test_progress_is_throttled(monkeypatch):
+    sent = []
+
+    async def interact(ctx):
+        # nothing to edit before the defer
+        sent.append(await ctx.progress("early"))
+        await ctx.defer_msg_with_src()
+        sent.append(await ctx.progress("1"))
+        sent.append(await ctx.progress("2"))
+        sent.append(await ctx.progress("3", force=True))
+        ctx.last_progress -= contexts.PROGRESS_INTERVAL
+        sent.append(await ctx.progress("4"))
+
+    calls = run_against(monkeypatch, interact)
+    assert sent == [False, True, False, True, True]
+    edits = [payload["content"] for m, _, payload in calls if m == "PATCH"]
+    assert edits == ["1", "3", "4"]
+
+
+def test_failed_defer_isnt_deferred(monkeypatch):
+    statuses = []
+
+    async def interact(ctx):
+        status, _ = await ctx.defer_msg_with_src()
+        statuses.append(status)
+        assert not ctx.deferred and not ctx.responded
+        # nothing to edit, progress stays quiet
+        assert not await ctx.progress("1", force=True)
+        ctx.add_content("done")
+        status, _ = await ctx.respond()
+        statuses.append(status)
+
+    calls = run_against(monkeypatch, interact, status=404)
+    # the answer goes to the callback again, not to a missing @original
+    assert [(m, p) for m, p, _ in calls] == [
+        ("POST", "/interactions/111/tok/callback"),
+        ("POST", "/interactions/111/tok/callback")]
+    assert statuses == [404, 404]
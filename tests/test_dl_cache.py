@@ -0,0 +1,58 @@
+import asyncio
+import os
+import time
+
+from dl_cache import DownloadCache
+
+
+def _producer(tmp_path, size, name="src.mp4"):
+    async def produce():
+        path = tmp_path / name
+        path.write_bytes(b"x" * size)
+        return str(path)
+    return produce
+
+
+def test_no_key_bypasses_cache(tmp_path):
+    cache = DownloadCache(str(tmp_path / "cache"))
+
+    async def main():
+        async with cache.use(None, _producer(tmp_path, 10)) as path:
+            assert os.path.exists(path)
+        return path
+
+    path = asyncio.run(main())
+    assert cache.entries == {} and cache.misses == 0
+    # the unlink is fired on the io pool
+    for _ in range(100):
+        if not os.path.exists(path):
+            break
+        time.sleep(0.01)
+    assert not os.path.exists(path)
+
+
+def test_new_entry_survives_its_own_eviction(tmp_path):
+    cache = DownloadCache(str(tmp_path / "cache"), max_bytes=50)
+
+    async def main():
+        async with cache.use("big", _producer(tmp_path, 60)) as path:
+            # over max_bytes, but in use
+            assert os.path.exists(path) and "big" in cache.entries
+
+    asyncio.run(main())
+    # evicted once released
+    assert "big" not in cache.entries
+
+
+def test_pinned_older_entries_dont_evict_the_new_one(tmp_path):
+    cache = DownloadCache(str(tmp_path / "cache"), max_bytes=50)
+
+    async def main():
+        async with cache.use("old", _producer(tmp_path, 40, "a.mp4")):
+            async with cache.use("new", _producer(tmp_path, 40, "b.mp4")) as path:
+                assert os.path.exists(path)
+                async with cache.use("new", _producer(tmp_path, 40, "c.mp4")):
+                    # served from the cache, not produced again
+                    assert cache.hits == 1
+
+    asyncio.run(main())
@@ -0,0 +1,113 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import fetch
+from discord.network import _network
+
+
+def test_validator():
+    cdn = "https://cdn.discordapp.com/attachments/1/2/a.mp4?ex=1&hm=2"
+    assert fetch.validator(cdn, fetch.RemoteInfo(cdn)) == "cdn"
+    url = "https://example.com/a.mp4"
+    assert fetch.validator(url, fetch.RemoteInfo(url)) is None
+    assert fetch.validator(url, fetch.RemoteInfo(url, etag='"v1"')) == 'etag:"v1"'
+    info = fetch.RemoteInfo(url, last_modified="Sat, 01 Jan 2000 00:00:00 GMT")
+    assert fetch.validator(url, info).startswith("modified:")
+
+
+def test_inspect_reads_validators(monkeypatch):
+    async def head(request):
+        return web.Response(body=b"x" * 10, content_type="video/mp4",
+            headers={"ETag": '"abc"', "Accept-Ranges": "bytes"})
+
+    async def allow(url):
+        pass
+
+    # the test server is on loopback
+    monkeypatch.setattr(fetch, "check_host", allow)
+
+    async def main():
+        app = web.Application()
+        app.router.add_get("/a.mp4", head)
+        async with TestServer(app) as server:
+            await _network.create_session()
+            try:
+                return await fetch.inspect(str(server.make_url("/a.mp4")))
+            finally:
+                await _network.close_session()
+
+    info = asyncio.run(main())
+    assert info.etag == '"abc"' and info.size == 10 and info.ranges
+
+
+@pytest.mark.parametrize("url", [
+    "http://127.0.0.1/a.mp4",
+    "http://localhost:8080/a.mp4",
+    "http://10.1.2.3/a.mp4",
+    "http://192.168.0.1/a.mp4",
+    "http://169.254.169.254/latest/meta-data",
+    "http://[::1]/a.mp4",
+    "http://[::ffff:127.0.0.1]/a.mp4",
+    "http://0.0.0.0/a.mp4",
+    "http://224.0.0.1/a.mp4",
+    "file:///etc/passwd",
+    "ftp://93.184.216.34/a.mp4",
+])
+def test_check_host_rejects(url):
+    with pytest.raises(fetch.FetchError):
+        asyncio.run(fetch.check_host(url))
+
+
+def test_check_host_allows_public():
+    asyncio.run(fetch.check_host("https://93.184.216.34/a.mp4"))
+
+
+def test_redirects_are_checked(monkeypatch):
+    real_check = fetch.check_host
+
+    async def check(url):
+        # the first hop is the test server, anything after it is checked
+        if not url.startswith(first):
+            await real_check(url)
+
+    async def redirect(request):
+        port = request.host.rpartition(":")[2]
+        raise web.HTTPFound(f"http://localhost:{port}/b.mp4")
+
+    async def main():
+        nonlocal first
+        app = web.Application()
+        app.router.add_get("/a.mp4", redirect)
+        async with TestServer(app) as server:
+            first = str(server.make_url("/a.mp4"))
+            await _network.create_session()
+            try:
+                await fetch.inspect(first)
+            finally:
+                await _network.close_session()
+
+    first = None
+    monkeypatch.setattr(fetch, "check_host", check)
+    with pytest.raises(fetch.FetchError, match="isn't allowed"):
+        asyncio.run(main())
+
+
+@pytest.mark.parametrize("url, ctype", [
+    ("https://example.com/live", "audio/x-mpegurl"),
+    ("https://example.com/live", "application/vnd.apple.mpegurl"),
+    ("https://example.com/live.m3u8", "application/octet-stream"),
+    ("https://example.com/radio.pls", None),
+])
+def test_check_rejects_playlists(url, ctype):
+    with pytest.raises(fetch.FetchError):
+        fetch.check(fetch.RemoteInfo(url, 10, ctype), 100)
+
+
+def test_url_inputs_get_a_protocol_whitelist():
+    import ffmpeg
+    assert ffmpeg.input_args("/tmp/a.mp4") == []
+    assert ffmpeg.input_args("https://example.com/a.mp4") == \
+        ["-protocol_whitelist", "http,https,tcp,tls"]
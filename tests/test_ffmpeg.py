@@ -0,0 +1,75 @@
+import asyncio
+import sys
+
+import pytest
+
+import ffmpeg
+
+# ffmpeg style progress, \r between updates and no newline until the end
+PROGRESS = ("import sys\n"
+    "for i in range(1200):\n"
+    "    sys.stderr.write('frame=%5d fps=30 q=28.0 size=1024kB time=00:00:10 '\n"
+    "        'bitrate=800kbits/s speed=1x' % i + chr(13) + ' ' * 40)\n"
+    "sys.stderr.write('\\nconversion failed' + chr(13))\n"
+    "sys.exit(int(sys.argv[1]))\n")
+
+
+def test_carriage_return_progress():
+    out = asyncio.run(ffmpeg.run_proc(sys.executable, "-c", PROGRESS, "0"))
+    assert out == b""
+
+
+def test_error_tail_after_progress():
+    with pytest.raises(ffmpeg.FFmpegError) as e:
+        asyncio.run(ffmpeg.run_proc(sys.executable, "-c", PROGRESS, "1"))
+    assert str(e.value).splitlines()[-1] == "conversion failed"
+    assert len(str(e.value).splitlines()) <= ffmpeg.ERR_LINES
+
+
+def test_child_killed_when_cancelled(monkeypatch):
+    procs = []
+    create = asyncio.create_subprocess_exec
+
+    async def spy(*args, **kwargs):
+        procs.append(await create(*args, **kwargs))
+        return procs[-1]
+
+    async def main():
+        task = asyncio.create_task(ffmpeg.run_proc(sys.executable, "-c",
+            "import time; time.sleep(30)"))
+        await asyncio.sleep(0.2)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    monkeypatch.setattr(asyncio, "create_subprocess_exec", spy)
+    asyncio.run(main())
+    assert procs[0].returncode is not None
+
+
+def test_farm_timeout_covers_the_queue():
+    farm = ffmpeg.WorkerFarm(workers=1, threads=1)
+
+    async def job(delay, threads=None, nice=None):
+        await asyncio.sleep(delay)
+        return delay
+
+    async def main():
+        busy = asyncio.create_task(farm.submit(job, 0.3))
+        await asyncio.sleep(0)
+        with pytest.raises(asyncio.TimeoutError):
+            await farm.submit(job, 0, timeout=0.05)
+        assert farm.jobs.queued == 0
+        assert await busy == 0.3
+
+    asyncio.run(main())
+
+
+def test_probe_url_without_size(monkeypatch):
+    async def run_proc(*args, stdout=None, nice=0):
+        assert "-protocol_whitelist" in args
+        return b'{"format": {"duration": "12.5"}, "streams": []}'
+
+    monkeypatch.setattr(ffmpeg, "run_proc", run_proc)
+    video = asyncio.run(ffmpeg.probe("https://example.com/a.mp4"))
+    assert video.duration == 12.5 and video.size == 0
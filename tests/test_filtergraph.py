@@ -0,0 +1,113 @@
+import asyncio
+
+import pytest
+
+import ffmpeg
+import filtergraph
+from filtergraph import Edit, EditError, MAX_REVERSE_SECONDS, build
+
+
+def video(v=True, a=True):
+    streams = []
+    if v:
+        streams.append(ffmpeg.Stream(codec_type="video", width=1280, height=720))
+    if a:
+        streams.append(ffmpeg.Stream(codec_type="audio"))
+    return ffmpeg.Video("in.mp4", duration=30.0, streams=streams)
+
+
+def graph(out):
+    return out[out.index("-filter_complex") + 1]
+
+
+def test_plain_copy_is_one_graph():
+    inp, out = build(Edit().validate(), video())
+    assert inp == []
+    assert graph(out) == "[0:v]null[v];[0:a]anull[a]"
+    assert out[out.index("[v]") - 1] == "-map" and "[a]" in out
+    assert out[-2:] == ["-movflags", "+faststart"]
+
+
+def test_trim_seeks_on_the_input():
+    inp, _ = build(Edit(start=2.5, end=10).validate(), video())
+    assert inp == ["-ss", "2.5", "-t", "7.5"]
+    inp, _ = build(Edit(end=4).validate(), video())
+    assert inp == ["-t", "4"]
+    inp, _ = build(Edit(start=3).validate(), video())
+    assert inp == ["-ss", "3"]
+
+
+def test_options_chain_in_one_filter_complex():
+    _, out = build(Edit(speed=2, scale=480, reverse=True).validate(), video())
+    assert graph(out) == ("[0:v]reverse,setpts=PTS/2,scale=-2:480[v];"
+        "[0:a]areverse,atempo=2[a]")
+    assert out.count("-filter_complex") == 1
+
+
+def test_atempo_is_chained_outside_its_range():
+    _, out = build(Edit(speed=4).validate(), video())
+    assert graph(out).endswith("[0:a]atempo=2.0,atempo=2[a]")
+    _, out = build(Edit(speed=0.25).validate(), video())
+    assert graph(out).endswith("[0:a]atempo=0.5,atempo=0.5[a]")
+    _, out = build(Edit(speed=3).validate(), video())
+    assert graph(out).endswith("[0:a]atempo=2.0,atempo=1.5[a]")
+
+
+def test_gif_uses_a_palette_and_drops_audio():
+    _, out = build(Edit(format="gif", scale=240).validate(), video())
+    assert graph(out) == ("[0:v]scale=-2:240,split[g1][g2];[g1]palettegen[p];"
+        "[g2][p]paletteuse[v]")
+    assert "[a]" not in out and "+faststart" not in out
+
+
+def test_mp3_drops_video():
+    _, out = build(Edit(format="mp3", speed=0.5).validate(), video())
+    assert graph(out) == "[0:a]atempo=0.5[a]"
+    assert "[v]" not in out
+    assert out[out.index("-c:a") + 1] == "libmp3lame"
+
+
+def test_missing_streams():
+    _, out = build(Edit().validate(), video(a=False))
+    assert graph(out) == "[0:v]null[v]"
+    with pytest.raises(EditError):
+        build(Edit(format="mp3").validate(), video(a=False))
+    with pytest.raises(EditError):
+        build(Edit(format="gif").validate(), video(v=False))
+
+
+def test_reverse_capped_by_start_and_end():
+    Edit(start=10, end=10 + MAX_REVERSE_SECONDS, reverse=True).validate()
+    with pytest.raises(EditError):
+        Edit(start=10, end=11 + MAX_REVERSE_SECONDS, reverse=True).validate()
+    # without reverse any length goes
+    Edit(end=10 * MAX_REVERSE_SECONDS).validate()
+
+
+@pytest.mark.parametrize("edit, duration, ok", [
+    (Edit(reverse=True), MAX_REVERSE_SECONDS * 2, False),
+    (Edit(reverse=True), MAX_REVERSE_SECONDS, True),
+    (Edit(start=MAX_REVERSE_SECONDS, reverse=True), MAX_REVERSE_SECONDS * 2, True),
+    # unknown duration and no end, can't tell how much would be buffered
+    (Edit(reverse=True), 0, False),
+    (Edit(end=5, reverse=True), 0, True),
+])
+def test_reverse_capped_by_probed_duration(monkeypatch, edit, duration, ok):
+    ran = []
+
+    async def probe(src):
+        return ffmpeg.Video(src, duration=duration)
+
+    async def run_proc(*args, nice=0):
+        ran.append(args)
+
+    monkeypatch.setattr(ffmpeg, "probe", probe)
+    monkeypatch.setattr(ffmpeg, "run_proc", run_proc)
+    monkeypatch.setattr(filtergraph, "build", lambda edit, video: ([], []))
+    if ok:
+        asyncio.run(filtergraph.render("in.mp4", "out.mp4", edit.validate()))
+        assert ran
+    else:
+        with pytest.raises(EditError):
+            asyncio.run(filtergraph.render("in.mp4", "out.mp4", edit.validate()))
+        assert not ran
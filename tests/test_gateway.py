@@ -0,0 +1,149 @@
+import asyncio
+
+import pytest
+from websockets.exceptions import ConnectionClosed
+from websockets.frames import Close
+
+from discord import codec
+from discord import discord as gateway
+from discord.discord import Bot, State, GatewayError, CLOSE_ACTIONS, \
+    RESUME, IDENTIFY, FATAL, GATE_WAY
+
+RESUME_URL = "wss://resume.example"
+
+
+def closed(code, by_server=True):
+    frame = Close(code, "")
+    if by_server:
+        return ConnectionClosed(frame, None)
+    return ConnectionClosed(None, frame)
+
+
+def test_close_actions():
+    for code in (4004, 4010, 4011, 4012, 4013, 4014):
+        assert CLOSE_ACTIONS[code] == FATAL
+    for code in (4003, 4007, 4009):
+        assert CLOSE_ACTIONS[code] == IDENTIFY
+    bot = Bot(intents=0)
+    assert bot.close_action(closed(4000)) == RESUME
+    # unknown codes and drops without a close frame resume
+    assert bot.close_action(closed(4999)) == RESUME
+    assert bot.close_action(None) == RESUME
+    assert bot.close_action(closed(4004)) == FATAL
+
+
+def test_close_code():
+    assert Bot.close_code(None) is None
+    assert Bot.close_code(ConnectionClosed(None, None)) is None
+    assert Bot.close_code(closed(4009)) == 4009
+    assert Bot.close_code(closed(1002, by_server=False)) == 1002
+    # both sent one, the first close wins
+    err = ConnectionClosed(Close(4000, ""), Close(1000, ""), rcvd_then_sent=True)
+    assert Bot.close_code(err) == 4000
+    err = ConnectionClosed(Close(4000, ""), Close(1000, ""), rcvd_then_sent=False)
+    assert Bot.close_code(err) == 1000
+
+
+def test_connect_url():
+    bot = Bot(intents=0)
+    bot.gateway = GATE_WAY
+    assert bot.connect_url() == GATE_WAY
+    bot.session, bot.resume_url = "abc", RESUME_URL + "/"
+    assert bot.connect_url() == f"{RESUME_URL}/?{GATE_WAY.partition('?')[2]}"
+    bot.reset_session()
+    assert bot.connect_url() == GATE_WAY
+
+
+class FakeSocket:
+
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, data):
+        self.sent.append(codec.loads(data)["op"])
+
+    async def close(self, code=1000, reason=""):
+        pass
+
+
+class FakeGateway:
+    """ Plays one scripted connection per _connect: hello, then an
+        optional READY/RESUMED, then the close (or raise) that ends it
+    """
+
+    def __init__(self, bot, script):
+        self.bot = bot
+        self.script = list(script)
+        # (url, ops the bot sent) per connection
+        self.connections = []
+
+    async def connect(self, uri):
+        bot = self.bot
+        reply, end = self.script.pop(0)
+        bot.socket = FakeSocket()
+        self.connections.append((uri, bot.socket.sent))
+        await bot.op_10({"d": {"heartbeat_interval": 45000}})
+        if reply == "ready":
+            bot.seq_num = 1
+            await bot.on_ready({"d": {"user": {"id": "1"}, "session_id": "s",
+                "resume_gateway_url": RESUME_URL}})
+        elif reply == "resumed":
+            await bot.on_resume({})
+        bot.socket = None
+        if isinstance(end, OSError):
+            raise end
+        return end
+
+
+def test_run_transitions(monkeypatch):
+    bot = Bot(intents=0)
+    fake = FakeGateway(bot, [
+        # identify, READY, then discord asks for a resume
+        ("ready", closed(1002)),
+        # the resume fails twice in a row, the wait grows
+        (None, None),
+        (None, OSError("refused")),
+        # resumed fine, the backoff starts over
+        ("resumed", closed(4000)),
+        # session timed out, identify again on the main gateway
+        (None, closed(4009)),
+        ("ready", closed(4004)),
+    ])
+    waits = []
+    monkeypatch.setattr(bot, "_connect", fake.connect)
+    monkeypatch.setattr(gateway, "backoff", lambda attempt: waits.append(attempt) or 0)
+
+    with pytest.raises(GatewayError) as e:
+        asyncio.run(bot.run(GATE_WAY))
+    assert e.value.code == 4004
+    assert bot.state is State.CLOSED
+
+    urls = [url for url, _ in fake.connections]
+    resume = f"{RESUME_URL}/?{GATE_WAY.partition('?')[2]}"
+    assert urls == [GATE_WAY, resume, resume, resume, resume, GATE_WAY]
+    # op 2 identifies, op 6 resumes
+    ops = [sent for _, sent in fake.connections]
+    assert ops == [[2], [6], [6], [6], [6], [2]]
+    assert waits == [0, 1, 2, 0, 1]
+
+
+def test_run_stops_on_close(monkeypatch):
+    bot = Bot(intents=0)
+
+    async def connect(uri):
+        await bot.close()
+        return closed(1000, by_server=False)
+
+    monkeypatch.setattr(bot, "_connect", connect)
+    asyncio.run(bot.run(GATE_WAY))
+    assert bot.state is State.CLOSED
+
+
+def test_listener_returns_the_function(monkeypatch):
+    monkeypatch.setattr(Bot, "listeners", {})
+
+    async def on_typing(bot, msg):
+        pass
+
+    assert Bot.listener("TYPING_START", "TYPING_STOP")(on_typing) is on_typing
+    assert Bot.listeners == {"TYPING_START": [on_typing], "TYPING_STOP": [on_typing]}
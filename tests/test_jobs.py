@@ -0,0 +1,164 @@
+import asyncio
+import os
+
+import pytest
+
+import jobs
+from jobs import JobScheduler, SchedulerFull
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_guild_limit_and_round_robin():
+    async def main():
+        s = JobScheduler(max_jobs=1, max_guild_jobs=1, max_queued=8)
+        order = []
+        gate = asyncio.Event()
+
+        async def job(name):
+            order.append(name)
+            await gate.wait()
+
+        first = asyncio.create_task(s.run(1, job, "a1"))
+        await asyncio.sleep(0)
+        rest = [asyncio.create_task(s.run(g, job, n))
+            for g, n in ((1, "a2"), (1, "a3"), (2, "b1"))]
+        await asyncio.sleep(0)
+        gate.set()
+        await asyncio.gather(first, *rest)
+        return order, s.stats()
+
+    order, stats = run(main())
+    # guild 2 doesn't wait behind all of guild 1's jobs
+    assert order == ["a1", "a2", "b1", "a3"]
+    assert stats["running"] == 0 and stats["queued"] == 0
+
+
+def test_full_queue_rejects():
+    async def main():
+        s = JobScheduler(max_jobs=1, max_guild_jobs=1, max_queued=1)
+        gate = asyncio.Event()
+        a = asyncio.create_task(s.run(1, gate.wait))
+        await asyncio.sleep(0)
+        b = asyncio.create_task(s.run(1, gate.wait))
+        await asyncio.sleep(0)
+        with pytest.raises(SchedulerFull):
+            await s.run(1, gate.wait)
+        gate.set()
+        await asyncio.gather(a, b)
+        return s.stats()
+
+    assert run(main())["rejected"] == 1
+
+
+def test_cancel_while_slot_is_released():
+    """a waiter cancelled in the same tick a slot frees up doesn't take it"""
+    async def main():
+        s = JobScheduler(max_jobs=1, max_guild_jobs=1, max_queued=8)
+        gate_a = asyncio.Event()
+        a = asyncio.create_task(s.run(1, gate_a.wait))
+        await asyncio.sleep(0)
+        b = asyncio.create_task(s.run(2, asyncio.sleep, 0))
+        await asyncio.sleep(0)
+        # b's waiter future is cancelled right away, a's release runs in
+        # the same tick before b gets to clean up
+        gate_a.set()
+        b.cancel()
+        await a
+        with pytest.raises(asyncio.CancelledError):
+            await b
+        assert s.running == 0
+        assert s.guild_running == {}
+        assert not s.queues and s.queued == 0
+        # nothing leaked, the scheduler still runs jobs
+        assert await asyncio.wait_for(s.run(3, asyncio.sleep, 0, "ok"), 1) == "ok"
+
+    run(main())
+
+
+def test_cancel_queued_job():
+    async def main():
+        s = JobScheduler(max_jobs=1, max_guild_jobs=1, max_queued=8)
+        gate = asyncio.Event()
+        a = asyncio.create_task(s.run(1, gate.wait))
+        await asyncio.sleep(0)
+        b = asyncio.create_task(s.run(2, gate.wait))
+        c = asyncio.create_task(s.run(2, asyncio.sleep, 0, "c"))
+        await asyncio.sleep(0)
+        b.cancel()
+        await asyncio.sleep(0)
+        assert s.queued == 1
+        gate.set()
+        await a
+        assert await c == "c"
+        assert s.running == 0 and not s.queues
+
+    run(main())
+
+
+class FakeStream:
+    def __init__(self, lines):
+        self.lines = [ln.encode() + b"\n" for ln in lines]
+
+    async def readline(self):
+        await asyncio.sleep(0)
+        return self.lines.pop(0) if self.lines else b""
+
+
+class FakeProc:
+    def __init__(self, out, err=(), returncode=0):
+        self.stdout = FakeStream(out)
+        self.stderr = FakeStream(err)
+        self.returncode = None
+        self._rc = returncode
+
+    async def wait(self):
+        self.returncode = self._rc
+        return self._rc
+
+    def terminate(self):
+        self.returncode = -15
+
+
+def test_yt_dl_res_with_fake_process(tmp_path, monkeypatch):
+    import cmds
+    from dl_cache import DownloadCache
+
+    monkeypatch.setattr(cmds, "dl_cache", DownloadCache(str(tmp_path / "cache")))
+    media = tmp_path / "video.mp4"
+    media.write_bytes(b"x" * 100)
+    sent = []
+
+    async def respond(msg=None, file=None):
+        sent.append((msg, file and os.path.exists(file)))
+        return 200, {}
+
+    async def spawn(*args, **kwargs):
+        return FakeProc([
+            f"[download] Destination: {media}",
+            "[download]  50.0% of 100B",
+            "[download] 100% of 100B",
+        ])
+
+    run(cmds._yt_dl_res(respond, "https://example.com/v", spawn=spawn))
+    assert sent == [(None, True)]
+
+
+def test_yt_dl_res_reports_errors(tmp_path, monkeypatch):
+    import cmds
+    from dl_cache import DownloadCache
+
+    monkeypatch.setattr(cmds, "dl_cache", DownloadCache(str(tmp_path / "cache")))
+    sent = []
+
+    async def respond(msg=None, file=None):
+        sent.append(msg)
+        return 200, {}
+
+    async def spawn(*args, **kwargs):
+        return FakeProc([], ["ERROR: Unsupported URL"], returncode=1)
+
+    run(cmds._yt_dl_res(respond, "https://example.com/v", spawn=spawn))
+    assert sent == ["ERROR: Unsupported URL"]
@@ -0,0 +1,194 @@
+import asyncio
+import time
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from discord.links import API_LINK
+from discord.network import _network
+from discord import rest as rest_module
+from discord.rest import RestClient, route_key, metric_route
+
+
+def test_route_key_keeps_major_ids_and_tokens():
+    key = route_key("POST", f"{API_LINK}interactions/111/tok/callback")
+    assert key == "POST interactions/111/tok/callback"
+    assert metric_route(key) == "POST interactions/:id/:token/callback"
+    key = route_key("PATCH", f"{API_LINK}webhooks/1/tok/messages/@original")
+    assert key == "PATCH webhooks/1/tok/messages/@original"
+    assert metric_route(key) == "PATCH webhooks/:id/:token/messages/@original"
+    key = route_key("DELETE", f"{API_LINK}channels/5/messages/77")
+    assert key == "DELETE channels/5/messages/:id"
+    assert metric_route(key) == "DELETE channels/:id/messages/:id"
+
+
+def test_slow_interaction_doesnt_block_others():
+    async def callback(request):
+        if request.match_info["id"] == "1":
+            await asyncio.sleep(0.5)
+        return web.json_response({})
+
+    async def main():
+        app = web.Application()
+        app.router.add_post("/interactions/{id}/{token}/callback", callback)
+        async with TestServer(app) as server:
+            await _network.create_session()
+            try:
+                client = RestClient()
+                done = {}
+
+                async def call(i):
+                    await client.request("POST",
+                        str(server.make_url(f"/interactions/{i}/tok/callback")), json={})
+                    done[i] = time.monotonic()
+
+                await asyncio.gather(call(1), call(2))
+                # routes nobody waits on are forgotten
+                assert client.locks == {} and client.users == {}
+                return done
+            finally:
+                await _network.close_session()
+
+    done = asyncio.run(main())
+    assert done[2] < done[1]
+
+
+def test_streamed_upload_isnt_resent(monkeypatch):
+    from discord import contexts
+    from discord.rest import rest
+    monkeypatch.setattr(rest, "_backoff", lambda attempt: 0)
+    calls = []
+
+    async def upload(request):
+        calls.append(len(await request.read()))
+        return web.json_response({}, status=500)
+
+    async def stream():
+        yield b"x" * 100
+
+    async def main():
+        app = web.Application()
+        app.router.add_post("/upload", upload)
+        async with TestServer(app) as server:
+            await _network.create_session()
+            try:
+                url = str(server.make_url("/upload"))
+                status, _ = await contexts._send_msg(url, stream(), "a.mp4", {})
+                assert status == 500 and len(calls) == 1
+                # bytes can be sent again
+                status, _ = await contexts._send_msg(url, b"x" * 100, "a.mp4", {})
+                assert len(calls) == 2 + rest.max_retries
+            finally:
+                await _network.close_session()
+                rest.reset()
+
+    asyncio.run(main())
+
+
+def run_client(monkeypatch, handlers, calls):
+    """ run calls(client, url) against a server with the given
+        (method, path, handler) routes, standing in for the api
+    """
+    client = RestClient()
+
+    async def main():
+        app = web.Application()
+        for method, path, handler in handlers:
+            app.router.add_route(method, path, handler)
+        async with TestServer(app) as server:
+            monkeypatch.setattr(rest_module, "API_LINK", str(server.make_url("/")))
+            await _network.create_session()
+            try:
+                return await calls(client, lambda p: str(server.make_url(p)))
+            finally:
+                await _network.close_session()
+
+    return client, asyncio.run(main())
+
+
+def test_finished_interaction_buckets_are_dropped(monkeypatch):
+    async def webhook(request):
+        return web.json_response({}, headers={"X-RateLimit-Bucket": "h1",
+            "X-RateLimit-Remaining": "4", "X-RateLimit-Reset-After": "0.2"})
+
+    async def calls(client, url):
+        await client.request("PATCH", url("/webhooks/1/tok_a/messages/@original"))
+        # still limited until the reset
+        assert "h1:webhooks/1/tok_a" in client.buckets
+        await asyncio.sleep(0.25)
+        await client.request("PATCH", url("/webhooks/1/tok_b/messages/@original"))
+
+    client, _ = run_client(monkeypatch,
+        [("PATCH", "/webhooks/{app}/{token}/messages/@original", webhook)], calls)
+    assert "h1:webhooks/1/tok_a" not in client.buckets
+    assert list(client.idle) == ["PATCH webhooks/1/tok_b/messages/@original"]
+    assert list(client.buckets) == ["h1:webhooks/1/tok_b"]
+
+
+def test_waits_for_an_exhausted_bucket(monkeypatch):
+    sent = []
+
+    async def message(request):
+        sent.append(time.monotonic())
+        return web.json_response({}, headers={"X-RateLimit-Bucket": "m",
+            "X-RateLimit-Remaining": "0", "X-RateLimit-Reset-After": "0.3"})
+
+    async def calls(client, url):
+        for _ in range(2):
+            status, _ = await client.request("POST", url("/channels/5/messages"))
+            assert status == 200
+
+    run_client(monkeypatch, [("POST", "/channels/{id}/messages", message)], calls)
+    assert sent[1] - sent[0] >= 0.28
+
+
+def test_retries_after_429(monkeypatch):
+    sent = []
+
+    async def message(request):
+        sent.append(time.monotonic())
+        if len(sent) == 1:
+            return web.json_response({"retry_after": 0.2, "global": False},
+                status=429)
+        return web.json_response({"id": "1"})
+
+    async def calls(client, url):
+        return await client.request("POST", url("/channels/5/messages"))
+
+    client, (status, body) = run_client(monkeypatch,
+        [("POST", "/channels/{id}/messages", message)], calls)
+    assert (status, body) == (200, {"id": "1"})
+    assert sent[1] - sent[0] >= 0.18
+    assert client.ratelimited == 1 and client.retries == 1
+    assert client.global_reset == 0.0
+
+
+def test_global_429_holds_every_route(monkeypatch):
+    sent = []
+
+    async def limited(request):
+        sent.append(("a", time.monotonic()))
+        if len(sent) == 1:
+            return web.json_response({"retry_after": 0.3, "global": True},
+                status=429)
+        return web.json_response({})
+
+    async def other(request):
+        sent.append(("b", time.monotonic()))
+        return web.json_response({})
+
+    async def calls(client, url):
+        first = asyncio.create_task(client.request("POST", url("/channels/1/messages")))
+        while not sent:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+        # another route, but the global limit covers it
+        await client.request("POST", url("/channels/2/typing"))
+        await first
+
+    client, _ = run_client(monkeypatch, [("POST", "/channels/1/messages", limited),
+        ("POST", "/channels/2/typing", other)], calls)
+    start = sent[0][1]
+    assert [name for name, _ in sent] == ["a", "b", "a"] or \
+        [name for name, _ in sent] == ["a", "a", "b"]
+    assert all(t - start >= 0.28 for _, t in sent[1:])
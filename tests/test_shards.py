@@ -0,0 +1,153 @@
+import asyncio
+import importlib
+import multiprocessing
+import os
+import sys
+import time
+
+from websockets.exceptions import ConnectionClosed
+from websockets.frames import Close
+
+from discord import codec
+from discord import shards
+from discord.shards import ShardManager, IdentifyGate, GATEWAY_QUERY, FATAL_EXIT
+from discord.discord import Bot, GATE_WAY
+from discord.network import _network
+from discord.rest import rest
+
+
+def test_gateway_query_matches_single_connection():
+    assert GATE_WAY.endswith(GATEWAY_QUERY)
+
+
+def _child(runs_dir, i):
+    runs = os.path.join(runs_dir, str(i))
+    with open(runs, "a") as f:
+        f.write("x")
+    with open(runs) as f:
+        count = len(f.read())
+    if i == 0:
+        # crashes twice, then shuts down cleanly
+        sys.exit(1 if count < 3 else 0)
+    sys.exit(FATAL_EXIT)
+
+
+def test_manager_restarts_crashed_processes(monkeypatch, tmp_path):
+    fork = multiprocessing.get_context("fork")
+
+    def start(self, ctx, i, shard_ids, shard_count, gateway, gate):
+        proc = fork.Process(target=_child, args=(str(tmp_path), i))
+        proc.start()
+        self.procs[i] = proc
+
+    async def fetch_gateway(self):
+        return {"shards": 2, "url": "wss://gateway.example",
+            "session_start_limit": {"max_concurrency": 1}}
+
+    waits = []
+    monkeypatch.setattr(ShardManager, "_start", start)
+    monkeypatch.setattr(ShardManager, "fetch_gateway", fetch_gateway)
+    monkeypatch.setattr(shards, "backoff", lambda attempt: waits.append(attempt) or 0)
+    manager = ShardManager("token", 0, processes=2)
+    manager.run()
+    # the fatal one isn't started again
+    assert (tmp_path / "0").read_text() == "xxx"
+    assert (tmp_path / "1").read_text() == "x"
+    assert manager.restarts == 2 and waits == [0, 1]
+    assert manager.procs == {}
+
+
+def test_plan_spreads_shards_round_robin():
+    assert ShardManager("t", 0, processes=3).plan(8) == [[0, 3, 6], [1, 4, 7], [2, 5]]
+    # never more processes than shards
+    assert ShardManager("t", 0, processes=4).plan(2) == [[0], [1]]
+
+
+def test_identify_gate_spaces_same_bucket(monkeypatch):
+    monkeypatch.setattr(shards, "IDENTIFY_INTERVAL", 0.2)
+    gate = IdentifyGate(multiprocessing.get_context("spawn"), 2)
+    done = {}
+
+    async def identify(shard_id):
+        await gate(shard_id)
+        done[shard_id] = time.monotonic()
+
+    async def main():
+        start = time.monotonic()
+        # 0 and 2 share a bucket with max_concurrency 2, 1 has its own
+        await asyncio.gather(*(identify(i) for i in (0, 1, 2)))
+        return start
+
+    start = asyncio.run(main())
+    assert done[1] - start < 0.15
+    assert abs(done[2] - done[0]) >= 0.19
+
+
+class FakeShardBot(Bot):
+    """ connects to nothing: says hello, records the IDENTIFY it gets and
+        closes the bot
+    """
+    identifies = []
+
+    async def _connect(self, uri):
+        sent = []
+
+        class Socket:
+            async def send(self, data):
+                sent.append(codec.loads(data))
+
+            async def close(self, code=1000, reason=""):
+                pass
+
+        self.socket = Socket()
+        await self.op_10({"d": {"heartbeat_interval": 45000}})
+        FakeShardBot.identifies += [m["d"] for m in sent if m["op"] == 2]
+        await self.close()
+        return ConnectionClosed(None, Close(1000, ""))
+
+
+def test_shards_identify_through_the_gate():
+    gated = []
+
+    async def gate(shard_id):
+        gated.append(shard_id)
+
+    FakeShardBot.identifies = []
+    asyncio.run(shards._run_shards(FakeShardBot, [1, 3], 4, GATE_WAY, gate,
+        {"intents": 513, "token": "t"}))
+    assert sorted(d["shard"] for d in FakeShardBot.identifies) == [[1, 4], [3, 4]]
+    assert all(d["intents"] == 513 for d in FakeShardBot.identifies)
+    assert sorted(gated) == [1, 3]
+    assert _network.network_se is None
+
+
+def test_last_shard_out_resets_rest():
+    async def main():
+        await _network.create_session()
+        await _network.create_session()
+        rest.users["POST channels/1/messages"] = 1
+        try:
+            # another shard is still using both
+            assert not await _network.close_session()
+            assert rest.users
+            assert await _network.close_session()
+        finally:
+            rest.reset()
+
+    asyncio.run(main())
+
+
+def test_limits_split_between_processes(monkeypatch):
+    import settings
+    monkeypatch.setenv("SHARD_PROCESS_INDEX", "2")
+    monkeypatch.setenv("SHARD_PROCESS_COUNT", "4")
+    try:
+        importlib.reload(settings)
+        assert settings.per_process(10) == 2
+        assert settings.per_process(2) == 1
+        assert settings.process_dir("/tmp/cache") == "/tmp/cache/p2"
+    finally:
+        monkeypatch.undo()
+        importlib.reload(settings)
+    assert settings.per_process(10) == 10
+    assert settings.process_dir("/tmp/cache") == "/tmp/cache"
@@ -0,0 +1,87 @@
+import pytest
+
+from ytdl import YtDlParser, EventType, Event
+
+
+def feed(parser, lines):
+    events = []
+    for ln in lines:
+        events += parser.feed(ln)
+    return events
+
+
+def test_single_video_with_merge():
+    p = YtDlParser()
+    events = feed(p, [
+        "[youtube] abc: Downloading webpage",
+        "[info] abc: Downloading 1 format(s): 137+140",
+        "[download] Destination: /tmp/dl/clip.f137.mp4",
+        "[download]   0.0% of   10.00MiB at  1.00MiB/s ETA 00:10",
+        "[download]  42.5% of   10.00MiB at  1.00MiB/s ETA 00:05",
+        "[download] 100% of   10.00MiB in 00:00:10 at 1.00MiB/s",
+        "[download] Destination: /tmp/dl/clip.f140.m4a",
+        "[download] 100% of    1.00MiB in 00:00:01 at 1.00MiB/s",
+        '[Merger] Merging formats into "/tmp/dl/clip.mp4"',
+        "Deleting original file /tmp/dl/clip.f137.mp4",
+    ])
+    assert [e.type for e in events] == [
+        EventType.DESTINATION, EventType.PROGRESS, EventType.PROGRESS,
+        EventType.PROGRESS, EventType.DESTINATION, EventType.PROGRESS,
+        EventType.MERGER]
+    assert events[0].path == "/tmp/dl/clip.f137.mp4"
+    assert [e.percent for e in events if e.type is EventType.PROGRESS] == \
+        [0.0, 42.5, 100.0, 100.0]
+    assert events[-1].path == "/tmp/dl/clip.mp4"
+    # the merged file is what's finished, not the last destination
+    assert p.close() == [Event(EventType.FINISHED, path="/tmp/dl/clip.mp4")]
+    assert p.close() == []
+
+
+def test_newline_progress_split_on_carriage_returns():
+    # without --newline progress comes as \r separated updates, the pump
+    # splits them, with it every update is its own line
+    p = YtDlParser()
+    events = feed(p, "[download]  10.0% of 5MiB\r[download]  20.0% of 5MiB\n"
+        .split("\r"))
+    assert [e.percent for e in events] == [10.0, 20.0]
+    assert events[1].line == "[download]  20.0% of 5MiB"
+
+
+def test_playlist_items_finish_the_previous_one():
+    p = YtDlParser()
+    events = feed(p, [
+        "[download] Downloading item 1 of 2",
+        "[download] Destination: /tmp/dl/one.mp4",
+        "[download] 100% of 1.00MiB",
+        "[download] Downloading item 2 of 2",
+        "[download] /tmp/dl/two.mp4 has already been downloaded",
+    ])
+    types = [e.type for e in events]
+    assert types == [EventType.ITEM, EventType.DESTINATION, EventType.PROGRESS,
+        EventType.FINISHED, EventType.ITEM, EventType.DESTINATION]
+    assert (events[0].index, events[0].total) == (1, 2)
+    assert events[3].path == "/tmp/dl/one.mp4"
+    assert (events[4].index, events[4].total) == (2, 2)
+    assert events[5].path == "/tmp/dl/two.mp4"
+    assert p.close() == [Event(EventType.FINISHED, path="/tmp/dl/two.mp4")]
+
+
+def test_older_video_n_of_m():
+    events = YtDlParser().feed("[download] Downloading video 3 of 10")
+    assert events == [Event(EventType.ITEM, index=3, total=10)]
+
+
+@pytest.mark.parametrize("method", ["feed", "feed_err"])
+def test_aborting(method):
+    ln = "ERROR: Interrupted by user, Aborting..."
+    assert getattr(YtDlParser(), method)(ln) == [Event(EventType.ABORT, line=ln)]
+
+
+def test_stderr_and_noise():
+    p = YtDlParser()
+    assert p.feed_err("ERROR: [generic] Unsupported URL\n") == \
+        [Event(EventType.ERROR, line="ERROR: [generic] Unsupported URL")]
+    assert p.feed_err("\n") == []
+    assert feed(p, ["", "   ", "[youtube] abc: Downloading webpage"]) == []
+    # nothing was downloaded, nothing to finish
+    assert p.close() == []